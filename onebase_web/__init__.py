@@ -16,12 +16,21 @@ You should have received a copy of the GNU General Public License
 along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from onebase_web.settings import TEMPLATES_DIR
+from onebase_web.settings import (
+    TEMPLATES_DIR,
+    ONEBASE_SESSION_BACKEND,
+    ONEBASE_SESSION_PATH,
+    ONEBASE_SESSION_TTL,
+)
+from onebase_web.sessions import make_session_interface
 from onebase_common.settings import FLASK_SECRET, CONFIG
 from flask import Flask
 
 app = Flask(__name__,
             template_folder=TEMPLATES_DIR)
 app.secret_key = FLASK_SECRET
+app.session_interface = make_session_interface(ONEBASE_SESSION_BACKEND,
+                                               ONEBASE_SESSION_TTL,
+                                               path=ONEBASE_SESSION_PATH)
 
 import onebase_web.views
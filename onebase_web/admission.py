@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Admission control for expensive endpoints.
+
+Each endpoint wrapped with `admission_required` may run at most
+`concurrency` requests at once in this process, and each user (or client
+address) may start them at `rate` per second with bursts of `burst`.
+Anything beyond that is refused at once with 429 and a Retry-After header
+instead of queueing for a worker, so a burst of writers can't take every
+worker away from cheap reads. Only the methods in `methods` are limited.
+"""
+
+import logging
+import math
+import threading
+
+from collections import (
+    Counter,
+    OrderedDict,
+)
+from functools import wraps
+
+from flask import (
+    g,
+    make_response,
+    request,
+    session,
+)
+
+from onebase_web.ratelimit import RateLimiter
+from onebase_web import settings as web_settings
+
+logger = logging.getLogger(__name__)
+
+REJECTED_BUSY = 'rejected_busy'
+REJECTED_RATE = 'rejected_rate'
+ADMITTED = 'admitted'
+
+# name -> AdmissionController, for reporting.
+CONTROLLERS = OrderedDict()
+
+
+class AdmissionController(object):
+    """ Concurrency limit plus per-client token buckets for one endpoint.
+
+    :param concurrency: Requests allowed to run at once.
+
+    :param rate: Requests per second each client may start.
+
+    :param burst: Requests a client may start at once.
+
+    """
+
+    def __init__(self, name, concurrency, rate, burst):
+        self.name = name
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate, burst)
+        self.counters = Counter()
+        self.in_flight = 0
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+
+    def admit(self, client):
+        """ Try to admit a request from `client`.
+
+        :return: 0 if admitted (call `release` when done), otherwise the
+            seconds the client should wait before retrying.
+        """
+        # Concurrency first, so a request refused as busy doesn't also
+        # spend one of the client's tokens.
+        if not self._slots.acquire(blocking=False):
+            self.count(REJECTED_BUSY)
+            return 1
+        wait = self.limiter.take(client)
+        if wait:
+            self._slots.release()
+            self.count(REJECTED_RATE)
+            return wait
+        with self._lock:
+            self.in_flight += 1
+            self.counters[ADMITTED] += 1
+        return 0
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def count(self, counter, n=1):
+        """ Bump one of the counters reported by `metrics`. """
+        with self._lock:
+            self.counters[counter] += n
+
+
+def controller(name, concurrency=None, rate=None, burst=None):
+    """ Get (or create) the controller called `name`. """
+    if name not in CONTROLLERS:
+        CONTROLLERS[name] = AdmissionController(
+            name,
+            concurrency or web_settings.ONEBASE_WRITE_CONCURRENCY,
+            rate or web_settings.ONEBASE_WRITE_RATE,
+            burst or web_settings.ONEBASE_WRITE_BURST)
+    return CONTROLLERS[name]
+
+
+def retry_after(seconds):
+    return {'Retry-After': str(max(int(math.ceil(seconds)), 1)), }
+
+
+def _client():
+    # API requests authenticate per request and only set `g.user`.
+    user = g.get('user')
+    if user is not None:
+        return 'user:{}'.format(user.id)
+    user = session.get('user')
+    if user:
+        return 'user:{}'.format(user['id'])
+    return 'addr:{}'.format(request.remote_addr)
+
+
+def admission_required(name=None, methods=('POST', 'PUT', 'PATCH', 'DELETE'),
+                       concurrency=None, rate=None, burst=None):
+    """ Refuse requests to a view with 429 when it is over capacity.
+
+    Use below `login_required` / `permissions_required` so refused requests
+    are already known to be authenticated.
+
+    :param name: Controller name (the view's name by default); views with
+        the same name share their limits.
+
+    """
+    def decorator(f):
+        admission = controller(name or f.__name__, concurrency, rate, burst)
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method not in methods:
+                return f(*args, **kwargs)
+            wait = admission.admit(_client())
+            if wait:
+                logger.info('Refused {} ({}s)'.format(admission.name, wait))
+                return make_response(
+                    ('Too many requests. Try again later.\n', 429,
+                     retry_after(wait)))
+            try:
+                return f(*args, **kwargs)
+            finally:
+                admission.release()
+        return decorated_function
+    return decorator
+
+
+def metrics():
+    """ Admission counters in the Prometheus text format. """
+    lines = [
+        '# TYPE onebase_admission_total counter',
+        '# TYPE onebase_admission_in_flight gauge',
+    ]
+    for c in CONTROLLERS.values():
+        for (counter, value) in sorted(c.counters.items()):
+            lines.append('onebase_admission_total{{endpoint="{}",'
+                         'result="{}"}} {}'.format(c.name, counter, value))
+        lines.append('onebase_admission_in_flight{{endpoint="{}"}} {}'.format(
+            c.name, c.in_flight))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+ASGI entry point, for deployments that only run an ASGI server. Requires
+`asgiref`; serve with e.g.::
+
+    uvicorn onebase_web.asgi:application --workers 4
+
+The app is still synchronous: `WsgiToAsgi` runs each request on a thread,
+and asgiref serialises those calls within a process, so a worker serves one
+request at a time. Scale with `--workers`; serving the WSGI app with a
+threaded WSGI server handles at least as many requests. This mode adds no
+concurrency of its own (the overlapping of database calls done by
+`onebase_web.concurrency.gather` happens under either server).
+"""
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    raise ImportError('The ASGI serving mode requires `asgiref` '
+                      '(pip install asgiref)')
+
+from onebase_web import app
+
+application = WsgiToAsgi(app)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Fingerprinted static assets.
+
+Every file under the static directory gets a name containing a hash of its
+contents (`js/fragments.js` -> `js/fragments.3f2a9c1d.js`). Templates use
+`asset_url('js/fragments.js')`, so a changed file gets a new URL and the
+old one can be cached forever.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from flask import (
+    Blueprint,
+    abort,
+    send_from_directory,
+    url_for,
+)
+
+from onebase_web import settings as web_settings
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def _fingerprint(name, digest):
+    (base, ext) = os.path.splitext(name)
+    return '{}.{}{}'.format(base, digest[:8], ext)
+
+
+class AssetManifest(object):
+    """ Map logical asset names to fingerprinted names.
+
+    :param directory: Directory holding the assets.
+
+    :param base_url: If set, asset URLs are built on this prefix (e.g. a
+        CDN that was populated with `build`) instead of the app's route.
+
+    """
+
+    def __init__(self, directory, base_url=None):
+        self.directory = directory
+        self.base_url = base_url
+        self.names = {}
+        self.sources = {}
+        self.scan()
+
+    def scan(self):
+        """ Hash every file in the asset directory. """
+        self.names = {}
+        self.sources = {}
+        if not os.path.isdir(self.directory):
+            return
+        for (root, dirs, files) in os.walk(self.directory):
+            for f in files:
+                path = os.path.join(root, f)
+                name = os.path.relpath(path, self.directory).replace(
+                    os.sep, '/')
+                with open(path, 'rb') as fh:
+                    digest = hashlib.sha256(fh.read()).hexdigest()
+                fingerprinted = _fingerprint(name, digest)
+                self.names[name] = fingerprinted
+                self.sources[fingerprinted] = name
+        logger.debug('Fingerprinted {} assets'.format(len(self.names)))
+
+    def url(self, name):
+        """ URL of the fingerprinted version of asset `name`. """
+        fingerprinted = self.names.get(name, name)
+        if self.base_url:
+            return '{}/{}'.format(self.base_url.rstrip('/'), fingerprinted)
+        return url_for('assets.asset', filename=fingerprinted)
+
+    def build(self, out_dir):
+        """ Copy fingerprinted assets (and a manifest) to `out_dir`.
+
+        :return: Number of files written.
+        """
+        for (fingerprinted, name) in self.sources.items():
+            target = os.path.join(out_dir, fingerprinted)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(os.path.join(self.directory, name), target)
+        with open(os.path.join(out_dir, 'manifest.json'), 'w') as fh:
+            json.dump(self.names, fh, indent=2, sort_keys=True)
+        return len(self.sources)
+
+
+asset_manifest = AssetManifest(web_settings.ONEBASE_STATIC_DIR,
+                               base_url=web_settings.ONEBASE_ASSET_URL)
+
+asset_views = Blueprint('assets', __name__, url_prefix='/assets')
+
+
+@asset_views.route('/<path:filename>', methods=['GET', ])
+def asset(filename):
+    """ Serve a fingerprinted asset with immutable caching. """
+    if filename not in asset_manifest.sources:
+        return abort(404)
+    response = send_from_directory(asset_manifest.directory,
+                                   asset_manifest.sources[filename])
+    response.headers['Cache-Control'] = IMMUTABLE
+    # Let the compressor stream text assets.
+    response.direct_passthrough = False
+    return response
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Caches with a common interface (`get`, `set`, `delete`, `clear`, `stats`)
+and three backends, picked with `make_cache`:
+
+`process`
+    `TTLCache`, an LRU dict private to the worker. Can hold any object.
+
+`shared`
+    `SharedMemoryCache`, a fixed-size table in a memory-mapped file (under
+    /dev/shm by default) shared by every worker on the host. Values must
+    fit in a slot.
+
+`memcached`
+    `MemcachedCache`, a memcached server shared by every host (needs
+    `pymemcache`).
+
+The shared backends store values as (MongoDB extended) JSON, so reading an
+entry written by another process never runs code: values must be plain
+data (dicts, lists, strings, numbers, ObjectIds, datetimes), and tuples
+come back as lists. `DocumentCache` keeps mongoengine documents that way.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from bson import json_util
+
+try:
+    from pymemcache.client.base import PooledClient
+except ImportError:
+    PooledClient = None
+
+from onebase_web import settings as web_settings
+
+BACKEND_PROCESS = 'process'
+BACKEND_SHARED = 'shared'
+BACKEND_MEMCACHED = 'memcached'
+
+# name -> cache, for reporting.
+CACHES = OrderedDict()
+
+
+class CacheStats(object):
+    """ Hit/miss/eviction counters of one cache (per process). """
+
+    __slots__ = ('hits', 'misses', 'evictions', 'rejected')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Values too large for the backend.
+        self.rejected = 0
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class TTLCache(object):
+    """ Thread-safe, size-bounded LRU cache whose entries expire.
+
+    :param max_size: Maximum number of entries kept.
+
+    :param ttl: Default lifetime of an entry in seconds.
+
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Get `key`, or `default` if it is missing or expired. """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return default
+            (expires, value) = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                self.stats.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ Store `value` under `key` for `ttl` (or the default) seconds. """
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.stats.evictions += 1
+
+    def delete(self, key):
+        """ Remove `key` if present. """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """ Remove every entry. """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _dumps(value):
+    return json_util.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _loads(data):
+    return json_util.loads(bytes(data).decode('utf-8'))
+
+
+def _key_bytes(key):
+    return repr(key).encode('utf-8')
+
+
+def _key_hash(data):
+    h = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                       'little')
+    # 0 marks an empty slot.
+    return h or 1
+
+
+class SharedMemoryCache(object):
+    """ Cache in a memory-mapped file shared by the processes of a host.
+
+    The file is a set-associative table: a key hashes to one set of `ways`
+    slots of `slot_size` bytes each, and when the set is full its least
+    recently used entry is evicted. Each set is guarded by a lock that
+    covers both the threads of a process and the other processes.
+
+    :param max_size: Number of entries (slots) in the table.
+
+    :param slot_size: Bytes per entry, including key and encoded value;
+        larger values are not cached.
+
+    """
+
+    # key hash, expires, last used, key length, value length
+    HEADER = struct.Struct('<QddII')
+
+    def __init__(self, name, max_size=1024, ttl=60, slot_size=4096, ways=4,
+                 directory='/dev/shm'):
+        self.ttl = ttl
+        self.ways = ways
+        self.slot_size = slot_size
+        self.sets = max(1, max_size // ways)
+        self.max_size = self.sets * ways
+        self.stats = CacheStats()
+        # The geometry is part of the name so workers configured differently
+        # never share a file.
+        self.path = os.path.join(directory, 'onebase-{}-{}x{}x{}.cache'.format(
+            name, self.sets, ways, slot_size))
+        size = self.max_size * slot_size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._locks = [threading.Lock() for i in range(min(self.sets, 64))]
+
+    @contextmanager
+    def _locked(self, index):
+        """ Lock set `index` against other threads and processes. """
+        set_bytes = self.ways * self.slot_size
+        with self._locks[index % len(self._locks)]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, set_bytes, index * set_bytes)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, set_bytes,
+                            index * set_bytes)
+
+    def _slots(self, index):
+        start = index * self.ways * self.slot_size
+        return range(start, start + self.ways * self.slot_size, self.slot_size)
+
+    def _find(self, index, h, kb):
+        for offset in self._slots(index):
+            header = self.HEADER.unpack_from(self._map, offset)
+            if header[0] != h or header[3] != len(kb):
+                continue
+            start = offset + self.HEADER.size
+            if self._map[start:start+len(kb)] == kb:
+                return (offset, header)
+        return (None, None)
+
+    def get(self, key, default=None):
+        kb = _key_bytes(key)
+        h = _key_hash(kb)
+        index = h % self.sets
+        with self._locked(index):
+            (offset, header) = self._find(index, h, kb)
+            if offset is None:
+                self.stats.misses += 1
+                return default
+            (h, expires, used, key_len, value_len) = header
+            now = time.time()
+            if expires < now:
+                self._map[offset:offset+self.HEADER.size] = bytes(
+                    self.HEADER.size)
+                self.stats.misses += 1
+                return default
+            self.HEADER.pack_into(self._map, offset, h, expires, now,
+                                  key_len, value_len)
+            start = offset + self.HEADER.size + key_len
+            data = self._map[start:start+value_len]
+        self.stats.hits += 1
+        return _loads(data)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        kb = _key_bytes(key)
+        data = _dumps(value)
+        if self.HEADER.size + len(kb) + len(data) > self.slot_size:
+            self.stats.rejected += 1
+            self.delete(key)
+            return
+        h = _key_hash(kb)
+        index = h % self.sets
+        now = time.time()
+        with self._locked(index):
+            (offset, header) = self._find(index, h, kb)
+            if offset is None:
+                # An empty or expired slot, else the least recently used.
+                victim = None
+                for o in self._slots(index):
+                    header = self.HEADER.unpack_from(self._map, o)
+                    if header[0] == 0 or header[1] < now:
+                        (victim, header) = (o, None)
+                        break
+                    if victim is None or header[2] < oldest:
+                        (victim, oldest) = (o, header[2])
+                if header is not None:
+                    self.stats.evictions += 1
+                offset = victim
+            start = offset + self.HEADER.size
+            self._map[start:start+len(kb)] = kb
+            self._map[start+len(kb):start+len(kb)+len(data)] = data
+            # The header goes last so a slot never points at partial data.
+            self.HEADER.pack_into(self._map, offset, h, now + ttl, now,
+                                  len(kb), len(data))
+
+    def delete(self, key):
+        kb = _key_bytes(key)
+        h = _key_hash(kb)
+        index = h % self.sets
+        with self._locked(index):
+            (offset, header) = self._find(index, h, kb)
+            if offset is not None:
+                self._map[offset:offset+self.HEADER.size] = bytes(
+                    self.HEADER.size)
+
+    def clear(self):
+        empty = bytes(self.HEADER.size)
+        for index in range(self.sets):
+            with self._locked(index):
+                for offset in self._slots(index):
+                    self._map[offset:offset+self.HEADER.size] = empty
+
+    def __len__(self):
+        now = time.time()
+        n = 0
+        for offset in range(0, self.max_size * self.slot_size,
+                            self.slot_size):
+            header = self.HEADER.unpack_from(self._map, offset)
+            if header[0] and header[1] >= now:
+                n += 1
+        return n
+
+
+class MemcachedCache(object):
+    """ Cache on a memcached server.
+
+    memcached evicts by size on its own; `max_size` is not used. `clear`
+    only drops this cache's entries: every key carries a generation number
+    that `clear` bumps.
+
+    :param url: `host:port` of the server.
+
+    :param generation_ttl: Seconds the generation number is reused before
+        it is read again, so a `clear` in another process takes up to this
+        long to show here.
+
+    """
+
+    def __init__(self, name, url, ttl=60, max_size=None, generation_ttl=1.0):
+        if PooledClient is None:
+            raise RuntimeError('The memcached cache backend needs pymemcache')
+        (host, port) = url.rsplit(':', 1)
+        self.name = name
+        self.ttl = ttl
+        self.generation_ttl = generation_ttl
+        self.stats = CacheStats()
+        self._client = PooledClient((host, int(port)), connect_timeout=1,
+                                    timeout=1, no_delay=True)
+        self._gen_key = 'onebase:{}:gen'.format(name)
+        # (generation, monotonic time it was read)
+        self._gen = (0, None)
+
+    def _generation(self):
+        (generation, read) = self._gen
+        now = time.monotonic()
+        if read is None or now - read >= self.generation_ttl:
+            generation = int(self._client.get(self._gen_key) or 0)
+            self._gen = (generation, now)
+        return generation
+
+    def _key(self, key):
+        return 'onebase:{}:{}:{}'.format(
+            self.name, self._generation(),
+            hashlib.blake2b(_key_bytes(key), digest_size=16).hexdigest())
+
+    def get(self, key, default=None):
+        data = self._client.get(self._key(key))
+        if data is None:
+            self.stats.misses += 1
+            return default
+        self.stats.hits += 1
+        return _loads(data)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if not self._client.set(self._key(key), _dumps(value),
+                                expire=int(ttl), noreply=False):
+            self.stats.rejected += 1
+
+    def delete(self, key):
+        self._client.delete(self._key(key))
+
+    def clear(self):
+        generation = self._client.incr(self._gen_key, 1)
+        if generation is None:
+            generation = 1
+            self._client.set(self._gen_key, b'1')
+        self._gen = (int(generation), time.monotonic())
+
+
+def make_cache(name, max_size=1024, ttl=60, backend=None):
+    """ Create a named cache on `backend` (`ONEBASE_CACHE_BACKEND` by
+    default) and register it for `metrics`. """
+    backend = backend or web_settings.ONEBASE_CACHE_BACKEND
+    if backend == BACKEND_PROCESS:
+        cache = TTLCache(max_size=max_size, ttl=ttl)
+    elif backend == BACKEND_SHARED:
+        cache = SharedMemoryCache(
+            name, max_size=max_size, ttl=ttl,
+            slot_size=web_settings.ONEBASE_CACHE_SLOT_SIZE,
+            directory=web_settings.ONEBASE_CACHE_DIR)
+    elif backend == BACKEND_MEMCACHED:
+        cache = MemcachedCache(name, web_settings.ONEBASE_CACHE_URL, ttl=ttl)
+    else:
+        raise ValueError('Unknown cache backend `{}`'.format(backend))
+    CACHES[name] = cache
+    return cache
+
+
+class DocumentCache(object):
+    """ Cache of mongoengine documents of one class.
+
+    Documents are stored as their BSON data and rebuilt on every `get`, so
+    they work with every backend and no instance is shared between threads
+    or requests. References are not followed: they are loaded (and not
+    cached) when accessed, as usual.
+
+    :param document: The document class.
+
+    """
+
+    def __init__(self, name, document, max_size=1024, ttl=60, backend=None):
+        self.document = document
+        self.cache = make_cache(name, max_size=max_size, ttl=ttl,
+                                backend=backend)
+
+    def get(self, key):
+        """ A fresh instance of the document cached under `key`, or None. """
+        son = self.cache.get(str(key))
+        if son is None:
+            return None
+        return self.document._from_son(son)
+
+    def set(self, key, document):
+        self.cache.set(str(key), document.to_mongo().to_dict())
+
+    def delete(self, key):
+        self.cache.delete(str(key))
+
+    def clear(self):
+        self.cache.clear()
+
+    def forget(self, key=None):
+        """ Invalidation handler: drop `key`, or everything if it is None.
+        """
+        if key is None:
+            self.clear()
+        else:
+            self.delete(key)
+
+
+def metrics():
+    """ Cache counters in the Prometheus text format. """
+    lines = ['# TYPE onebase_cache_total counter', ]
+    for (name, cache) in CACHES.items():
+        for (counter, value) in sorted(cache.stats.as_dict().items()):
+            lines.append('onebase_cache_total{{cache="{}",result="{}"}} {}'
+                         .format(name, counter, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Maintenance commands, run through the flask CLI, e.g.::
+
+    FLASK_APP=onebase_web flask indexes --explain
+"""
+
+import click
+
+from onebase_api.models.auth import (
+    User,
+)
+from onebase_api.models.main import (
+    Path,
+)
+
+from onebase_web.indexes import (
+    ensure_indexes,
+    explain_queries,
+)
+from onebase_web.stats import recompute_all
+from onebase_web.search import reindex_all
+from onebase_web.snapshots import snapshot_store
+from onebase_web.routing import (
+    read_from_secondaries,
+    reads,
+)
+from onebase_web import settings as web_settings
+from onebase_web.assets import asset_manifest
+from onebase_web.profiling import make_token
+from onebase_web.views.auth import deactivate_user
+from onebase_web import app
+
+
+@app.cli.command('indexes')
+@click.option('--explain', is_flag=True,
+              help='Explain the views\' query shapes after indexing.')
+def indexes_command(explain):
+    """ Create the indexes the views rely on. """
+    for (collection, name) in ensure_indexes():
+        click.echo('{}: {}'.format(collection, name))
+    if not explain:
+        return
+    failed = False
+    for (name, stages, problems) in explain_queries():
+        status = 'OK' if not problems else ', '.join(problems)
+        click.echo('[{}] {} ({})'.format(status, name, ' <- '.join(stages)))
+        failed = failed or bool(problems)
+    if failed:
+        raise SystemExit(1)
+
+
+@app.cli.command('deactivate-user')
+@click.argument('email')
+def deactivate_user_command(email):
+    """ Deactivate the account of EMAIL and end its sessions.
+
+    Sessions are shared with the running workers only with
+    ONEBASE_SESSION_BACKEND=sqlite; in-memory sessions end when they expire
+    or the workers restart.
+    """
+    user = User.objects(email=email).first()
+    if user is None:
+        raise click.BadParameter('No user {}'.format(email))
+    click.echo('Deactivated {}; revoked {} sessions'.format(
+        email, deactivate_user(user)))
+
+
+@app.cli.command('node-stats')
+def node_stats_command():
+    """ Recompute every node's row count and key statistics. """
+    click.echo('Recomputed statistics for {} nodes'.format(recompute_all()))
+
+
+@app.cli.command('search-index')
+def search_index_command():
+    """ Rebuild the search entry of every node. """
+    click.echo('Indexed {} nodes'.format(reindex_all()))
+
+
+@app.cli.command('snapshot')
+@click.argument('path')
+@click.option('--drop', is_flag=True, help='Remove the node\'s snapshot.')
+def snapshot_command(path, drop):
+    """ Serve the node at PATH from a local columnar snapshot.
+
+    The snapshot is rebuilt automatically whenever the node changes.
+    """
+    node = getattr(Path.find(path), 'node', None)
+    if node is None:
+        raise click.BadParameter('No node at {}'.format(path))
+    if drop:
+        snapshot_store.drop(node)
+        click.echo('Dropped the snapshot of {}'.format(path))
+        return
+    click.echo('Wrote {} rows of {} to {}'.format(
+        snapshot_store.build(node), path, snapshot_store.path(node)))
+
+
+@app.cli.command('read-check')
+def read_check_command():
+    """ Show which server answers primary and routed reads.
+
+    Run with ONEBASE_READ_ROUTING=1 against a replica set; routed reads
+    should be answered by a secondary.
+    """
+    if not web_settings.ONEBASE_READ_ROUTING:
+        raise click.UsageError('Read routing is off (ONEBASE_READ_ROUTING)')
+    for (label, routed) in (('primary', False), ('routed', True)):
+        if routed:
+            with read_from_secondaries():
+                queryset = reads(Path.objects.limit(1))
+        else:
+            queryset = Path.objects.limit(1)
+        list(queryset)
+        click.echo('{}: {}'.format(label, queryset._cursor.address))
+
+
+@app.cli.command('assets')
+@click.argument('out_dir')
+def assets_command(out_dir):
+    """ Write fingerprinted static assets to OUT_DIR. """
+    click.echo('Wrote {} assets to {}'.format(asset_manifest.build(out_dir),
+                                               out_dir))
+
+
+@app.cli.command('profile-token')
+def profile_token_command():
+    """ Print a token that enables profiling of a request.
+
+    Send it as the X-Onebase-Profile header (or the _profile argument) on a
+    request made as an admin.
+    """
+    click.echo(make_token(app.secret_key))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gzip
+import logging
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import request
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+)
+
+
+def _quality(encoding):
+    """ The client's preference (q-value) for `encoding`; 0 if refused. """
+    return request.accept_encodings[encoding]
+
+
+def _gzip_stream(chunks, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _brotli_stream(chunks, quality):
+    compressor = brotli.Compressor(quality=quality)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.process(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class Compressor(object):
+    """ Compress responses with brotli (when installed) or gzip.
+
+    Only complete (200) responses are compressed, in the encoding the
+    client prefers. Buffered responses smaller than `min_size` bytes are
+    sent as-is.
+    Streamed responses are compressed chunk by chunk as they are produced.
+
+    :param min_size: Minimum body size worth compressing.
+
+    :param level: gzip level (brotli uses `brotli_quality`).
+
+    """
+
+    def __init__(self, app=None, min_size=1024, level=6, brotli_quality=4):
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+
+    def _encoding(self):
+        br = _quality('br') if brotli is not None else 0
+        gz = _quality('gzip')
+        if br and br >= gz:
+            return 'br'
+        if gz:
+            return 'gzip'
+        return None
+
+    def after_request(self, response):
+        # Partial content (ranges) must be sent as the bytes requested.
+        if (response.status_code != 200
+                or 'Content-Range' in response.headers
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or not response.mimetype.startswith(COMPRESSIBLE_TYPES)):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self._encoding()
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            if encoding == 'br':
+                response.response = _brotli_stream(response.response,
+                                                   self.brotli_quality)
+            else:
+                response.response = _gzip_stream(response.response,
+                                                 self.level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            if encoding == 'br':
+                data = brotli.compress(data, quality=self.brotli_quality)
+            else:
+                data = gzip.compress(data, self.level)
+            response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        (etag, weak) = response.get_etag()
+        if etag and not weak:
+            # Same content, different bytes: only weakly equal.
+            response.set_etag(etag, weak=True)
+        return response
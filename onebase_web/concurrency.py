@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from onebase_web import settings as web_settings
+
+io_executor = ThreadPoolExecutor(max_workers=web_settings.ONEBASE_IO_WORKERS,
+                                 thread_name_prefix='onebase-io')
+
+
+def gather(*calls):
+    """ Run independent (blocking) database calls concurrently.
+
+    The first call runs on the current thread; the rest are handed to the
+    shared I/O pool. PyMongo releases the GIL while waiting on the server,
+    so the round trips overlap. Each call runs in a copy of the caller's
+    context, so per-request state such as read routing carries over.
+
+    :param calls: Zero-argument callables.
+
+    :return: List of results, in the same order as `calls`.
+    """
+    if not calls:
+        return []
+    futures = [io_executor.submit(copy_context().run, c) for c in calls[1:]]
+    first = calls[0]()
+    return [first, ] + [f.result() for f in futures]
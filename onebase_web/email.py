@@ -14,21 +14,268 @@ GNU General Public License for more details.
 
 You should have received a copy of the GNU General Public License
 along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+To try delivery locally, point `CONFIG['email']['smtp']` at a debugging
+SMTP server, e.g.::
+
+    python -m aiosmtpd -n -l localhost:1025
 """
 
+import atexit
+import heapq
+import itertools
+import logging
+import queue
 import smtplib
-
-import imghdr
+import threading
+import time
 
 from email.message import EmailMessage
 from email.policy import SMTP
 
 from onebase_common.settings import CONFIG
 
+logger = logging.getLogger(__name__)
+
 EMAIL = CONFIG['email']['smtp']
 
+VERIFICATION_BODY = """Welcome to 1Base!
+
+Please verify your account by visiting the link below:
+
+    {verify_url}
+
+If you did not register, you can safely ignore this email.
+"""
+
+
 class UserVerificationEmail(EmailMessage):
+    """ Email sent to a newly registered user to verify their address. """
 
     def __init__(self, user, verify_url='/verify',
                  email_config=EMAIL):
-        super(UserVerificationEmail, self).__init__(*args, **kwargs)
+        super(UserVerificationEmail, self).__init__(policy=SMTP)
+        self['Subject'] = email_config.get('verification_subject',
+                                           '1Base Account Verification')
+        self['From'] = email_config.get('from', 'noreply@localhost')
+        self['To'] = user.email
+        self.set_content(VERIFICATION_BODY.format(verify_url=verify_url))
+
+
+class SMTPPool(object):
+    """ Pool of reusable SMTP connections.
+
+    Connections are checked with `NOOP` before being handed out again and
+    are dropped (rather than returned) after an error.
+    """
+
+    def __init__(self, email_config=EMAIL, size=2):
+        self.email_config = email_config
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        c = self.email_config
+        host = c.get('host', 'localhost')
+        port = int(c.get('port', 25))
+        timeout = float(c.get('timeout', 10))
+        if c.get('ssl', False):
+            conn = smtplib.SMTP_SSL(host, port, timeout=timeout)
+        else:
+            conn = smtplib.SMTP(host, port, timeout=timeout)
+            if c.get('starttls', False):
+                conn.starttls()
+        if c.get('username'):
+            conn.login(c['username'], c.get('password', ''))
+        return conn
+
+    def acquire(self):
+        """ Get a live connection from the pool (or open a new one). """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            try:
+                if conn.noop()[0] == 250:
+                    return conn
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self.discard(conn)
+
+    def release(self, conn):
+        """ Return a healthy connection to the pool. """
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            self.discard(conn)
+
+    def discard(self, conn):
+        """ Close a connection without returning it to the pool. """
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def close(self):
+        """ Close every idle connection. """
+        while True:
+            try:
+                self.discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+class EmailQueue(object):
+    """ Background queue that builds and delivers emails.
+
+    Requests only enqueue a message factory and its arguments; worker
+    threads build the messages, send them in batches over pooled SMTP
+    connections, and retry failures with exponential backoff.
+
+    :param email_config: SMTP configuration (`CONFIG['email']['smtp']`).
+
+    """
+
+    def __init__(self, email_config=EMAIL):
+        self.email_config = email_config
+        self.workers = int(email_config.get('workers', 2))
+        self.batch_size = int(email_config.get('batch_size', 20))
+        self.max_retries = int(email_config.get('max_retries', 5))
+        self.retry_backoff = float(email_config.get('retry_backoff', 2))
+        self.pool = SMTPPool(email_config, size=self.workers)
+        self._queue = queue.Queue()
+        self._delayed = []
+        self._delayed_lock = threading.Lock()
+        self._counter = itertools.count()
+        self._threads = []
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """ Start the worker threads (idempotent). """
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(0, self.workers):
+                t = threading.Thread(target=self._run,
+                                     name='onebase-email-{}'.format(i),
+                                     daemon=True)
+                t.start()
+                self._threads.append(t)
+            atexit.register(self.stop)
+
+    def enqueue(self, factory, *args, **kwargs):
+        """ Queue an email for delivery.
+
+        :param factory: Callable returning an `EmailMessage`, called on the
+            worker thread with `args` and `kwargs`.
+
+        """
+        self.start()
+        self._queue.put((factory, args, kwargs, 0))
+
+    def stop(self, timeout=10):
+        """ Stop the workers once the queue has drained. """
+        self._stopping.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+        self.pool.close()
+
+    def _release_due(self):
+        """ Move retries whose backoff has elapsed back onto the queue.
+
+        :return: Seconds until the next retry is due (or None).
+        """
+        now = time.time()
+        with self._delayed_lock:
+            while self._delayed and self._delayed[0][0] <= now:
+                (_, _, job) = heapq.heappop(self._delayed)
+                self._queue.put(job)
+            if self._delayed:
+                return self._delayed[0][0] - now
+        return None
+
+    def _retry(self, job):
+        (factory, args, kwargs, attempt) = job
+        attempt += 1
+        if attempt > self.max_retries:
+            logger.error('Giving up on email after {} attempts'.format(
+                attempt))
+            return
+        due = time.time() + self.retry_backoff * 2 ** (attempt - 1)
+        with self._delayed_lock:
+            heapq.heappush(self._delayed, (due, next(self._counter),
+                                           (factory, args, kwargs, attempt)))
+
+    def _next_batch(self, wait):
+        try:
+            batch = [self._queue.get(timeout=wait)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            next_due = self._release_due()
+            wait = 1.0 if next_due is None else min(1.0, next_due)
+            batch = self._next_batch(wait)
+            if not batch:
+                if self._stopping.is_set() and self._queue.empty():
+                    return
+                continue
+            self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        messages = []
+        for job in batch:
+            (factory, args, kwargs, attempt) = job
+            try:
+                messages.append((job, factory(*args, **kwargs)))
+            except Exception:
+                logger.exception('Could not build email')
+        if not messages:
+            return
+        try:
+            conn = self.pool.acquire()
+        except (smtplib.SMTPException, OSError) as e:
+            logger.warning('SMTP connection failed: {}'.format(e))
+            for (job, _) in messages:
+                self._retry(job)
+            return
+        healthy = True
+        for (job, message) in messages:
+            if not healthy:
+                self._retry(job)
+                continue
+            try:
+                conn.send_message(message)
+                logger.debug('Sent email to {}'.format(message['To']))
+            except smtplib.SMTPRecipientsRefused:
+                logger.error('Recipient refused: {}'.format(message['To']))
+            except (smtplib.SMTPException, OSError) as e:
+                logger.warning('Sending to {} failed: {}'.format(
+                    message['To'], e))
+                healthy = False
+                self._retry(job)
+        if healthy:
+            self.pool.release(conn)
+        else:
+            self.pool.discard(conn)
+
+
+verification_queue = EmailQueue(EMAIL)
+
+
+def send_verification_email(user, verify_url):
+    """ Queue the verification email for `user` without blocking. """
+    verification_queue.enqueue(UserVerificationEmail, user,
+                               verify_url=verify_url)
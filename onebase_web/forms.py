@@ -16,6 +16,8 @@ You should have received a copy of the GNU General Public License
 along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import csv
+import io
 import requests
 import logging
 from http import HTTPStatus as STATUS
@@ -31,10 +33,17 @@ from onebase_api.models.main import (
     Slot,
 )
 
+from onebase_api.models.history import (
+    Action,
+)
 from onebase_api.exceptions import (
     OneBaseException,
 )
 
+from bson import ObjectId
+from mongoengine.queryset.visitor import Q
+from pymongo import UpdateOne
+
 from wtforms import (
     Form,
     StringField,
@@ -46,6 +55,16 @@ from wtforms import (
 from wtforms.fields.html5 import EmailField
 
 from onebase_web.fields import ReadOnlyField
+from onebase_web.history import save_actions
+from onebase_web.invalidation import invalidate
+from onebase_web.lookups import key_type
+from onebase_web.search import index_node
+from onebase_web.stats import (
+    record_insert,
+    record_update,
+    record_updates,
+    row_inserted,
+)
 
 
 class LoginForm(Form):
@@ -67,6 +86,20 @@ class RegisterForm(Form):
         return False
 
 
+class ChangePasswordForm(Form):
+    current_password = PasswordField()
+    password = PasswordField(label='New Password')
+    password_confirm = PasswordField(label='Confirm New Password')
+
+    def validate(self):
+        if self.data['password'] == self.data['password_confirm']:
+            return True
+        errors = ('Passwords do not match', )
+        self.password.errors = errors
+        self.password_confirm.errors = errors
+        return False
+
+
 class CreateTypeForm(Form):
     """ Form to create database types. """
     name = StringField()
@@ -84,7 +117,7 @@ class SlotInsertForm(Form):
             if k not in self.ext_keys:
                 continue
             ext_key = self.ext_keys[k]
-            t = ext_key.soft_type.fetch()
+            t = key_type(ext_key)
             try:
                 t.validate_value(v, ext_key.size)
             except OneBaseException as e:
@@ -104,7 +137,11 @@ class SlotInsertForm(Form):
         :return: List of saved slots.
         """
         _saved = []
-        row = node.row_count
+        values = {str(self.ext_keys[k].id): v
+                  for (k, v) in self.data.items() if k in self.ext_keys}
+        old_values = {}
+        if update_row is None:
+            row = record_insert(node, values)
         for (data_key, data_value) in self.data.items():
             if data_key not in self.ext_keys:
                 continue
@@ -112,6 +149,7 @@ class SlotInsertForm(Form):
             # t = doc_key.soft_type.fetch()
             if update_row is not None:
                 slot = Slot.objects(key=doc_key, row=update_row).first()
+                old_values[str(doc_key.id)] = slot.value
                 slot.value = data_value
                 slot.save()
                 continue
@@ -119,9 +157,224 @@ class SlotInsertForm(Form):
             logger.debug("INSERT: saving {}".format(slot.to_json()))
             slot.save(user)
             _saved.append(slot)
+        if update_row is not None:
+            record_update(node, old_values, values)
+        else:
+            row_inserted(node)
         return _saved
 
 
+def _as_text(value):
+    return '' if value is None else str(value)
+
+
+def parse_grid_form(form):
+    """ Changed cells of a grid edit form.
+
+    Each cell is posted as `cell-<row>-<key id>`, along with the value it
+    had when the page was rendered as `orig-<row>-<key id>`.
+
+    :return: `{row: {key_id: (old, new)}}` of the cells that were changed.
+        Fields with a malformed name are ignored.
+    """
+    edits = {}
+    for (name, new) in form.items():
+        if not name.startswith('cell-'):
+            continue
+        try:
+            (row, key_id) = name[len('cell-'):].split('-', 1)
+            row = int(row)
+        except ValueError:
+            logger.debug('Ignoring grid field {!r}'.format(name))
+            continue
+        old = form.get('orig-{}-{}'.format(row, key_id), '')
+        if new != old:
+            edits.setdefault(row, {})[key_id] = (old, new)
+    return edits
+
+
+def apply_grid_edits(node, edits):
+    """ Validate and apply edits to many rows of `node` at once.
+
+    Every value is validated against its key's type, and every cell is
+    compared with the value the editor started from. A row with an invalid
+    value or a conflicting cell is skipped entirely; the cells of all other
+    rows are written with one `bulk_write`.
+
+    :param edits: `{row: {key_id: (old, new)}}`, as from `parse_grid_form`.
+
+    :return: `{'updated': [row, ...], 'conflicts': {row: [key name, ...]},
+        'errors': {row: {key name: message}}}`.
+    """
+    keys = {str(k.id): k for k in node.get_keys()}
+    types = {}
+    result = {'updated': [], 'conflicts': {}, 'errors': {}}
+    if not edits:
+        return result
+    found = Slot._get_collection().find(
+        {'key': {'$in': [ObjectId(k) for k in keys]},
+         'row': {'$in': list(edits)}},
+        {'key': 1, 'row': 1, 'value': 1})
+    current = {(c['row'], str(c['key'])): c['value'] for c in found}
+    existing = {row for (row, key_id) in current}
+    ops = []
+    changes = []
+    for (row, cells) in sorted(edits.items()):
+        errors = {}
+        conflicts = []
+        if row not in existing:
+            result['errors'][row] = {'row': 'No such row'}
+            continue
+        for (key_id, (old, new)) in cells.items():
+            key = keys.get(key_id)
+            if key is None:
+                # There is no key name to report the error under.
+                errors['key'] = 'Unknown key `{}`'.format(key_id)
+                continue
+            type_id = str(key.soft_type.id)
+            if type_id not in types:
+                types[type_id] = key_type(key)
+            try:
+                types[type_id].validate_value(new, key.size)
+            except OneBaseException as e:
+                errors[key.name] = '{} - {}'.format(e.error_code, e)
+            if _as_text(current.get((row, key_id))) != _as_text(old):
+                conflicts.append(key.name)
+        if errors:
+            result['errors'][row] = errors
+            continue
+        if conflicts:
+            result['conflicts'][row] = conflicts
+            continue
+        for (key_id, (old, new)) in cells.items():
+            if (row, key_id) in current:
+                # Only overwrite the value the editor started from.
+                ops.append(UpdateOne({'key': keys[key_id].id, 'row': row,
+                                      'value': current[(row, key_id)]},
+                                     {'$set': {'value': new}}))
+            else:
+                # Only create the cell if nobody else did meanwhile.
+                slot = Slot(key=keys[key_id], row=row, value=new).to_mongo()
+                ops.append(UpdateOne(
+                    {'key': keys[key_id].id, 'row': row},
+                    {'$setOnInsert': {k: v for (k, v) in slot.items()
+                                      if k not in ('_id', 'key', 'row')}},
+                    upsert=True))
+        changes.append((row, {k: current.get((row, k)) for k in cells},
+                        {k: new for (k, (old, new)) in cells.items()}))
+    if not ops:
+        return result
+    written = Slot._get_collection().bulk_write(ops, ordered=False)
+    if written.modified_count + written.upserted_count < len(ops):
+        # Another write got in between; find the rows that lost the race.
+        after = Slot._get_collection().find(
+            {'key': {'$in': [ObjectId(k) for k in keys]},
+             'row': {'$in': [row for (row, old, new) in changes]}},
+            {'key': 1, 'row': 1, 'value': 1})
+        after = {(c['row'], str(c['key'])): c['value'] for c in after}
+        for (i, (row, old, new)) in enumerate(changes):
+            lost = [k for (k, v) in new.items() if after.get((row, k)) != v]
+            if lost:
+                result['conflicts'][row] = [keys[k].name for k in lost]
+                # Only count the cells that were written.
+                new = {k: v for (k, v) in new.items() if k not in lost}
+                changes[i] = (row, {k: old[k] for k in new}, new)
+    record_updates(node, [(old, new) for (row, old, new) in changes])
+    result['updated'] = [row for (row, old, new) in changes
+                         if row not in result['conflicts']]
+    logger.debug('Grid edit of {}: {} rows updated, {} conflicts'.format(
+        node.id, len(result['updated']), len(result['conflicts'])))
+    return result
+
+
+class SchemaError(ValueError):
+    """ Raised for an invalid node schema. """
+
+
+def parse_schema_header(header):
+    """ Parse a CSV header with type hints into key specs.
+
+    Each column is `name:type` or `name:type:size`, where `type` is a Type
+    name or id, e.g. ``title:string:200,year:integer``.
+
+    :return: List of `{'name': ..., 'type': ..., 'size': ...}`.
+    """
+    specs = []
+    for row in csv.reader(io.StringIO(header.strip())):
+        for column in row:
+            parts = [p.strip() for p in column.split(':')]
+            if len(parts) not in (2, 3) or not all(parts):
+                raise SchemaError('Invalid column `{}`; expected '
+                                  'name:type[:size]'.format(column))
+            size = None
+            if len(parts) == 3:
+                try:
+                    size = int(parts[2])
+                except ValueError:
+                    raise SchemaError('Invalid size for `{}`'.format(
+                        parts[0]))
+            specs.append({'name': parts[0], 'type': parts[1],
+                          'size': size})
+    return specs
+
+
+def create_keys(specs, user):
+    """ Create the keys described by `specs` in bulk.
+
+    All types are resolved (by id or name) with a single query, the keys
+    are written with a single insert, and so are their history actions.
+
+    :param specs: List of `{'name': ..., 'type': ..., 'size': ...}`.
+
+    :param user: User creating the keys.
+
+    :return: List of saved keys.
+    """
+    if (not isinstance(specs, list)
+            or not all(isinstance(s, dict) for s in specs)):
+        raise SchemaError('Keys must be a list of objects')
+    names = [s.get('name') for s in specs]
+    if not all(isinstance(n, str) and n for n in names):
+        raise SchemaError('Every key needs a name')
+    for s in specs:
+        size = s.get('size')
+        if size is not None and (not isinstance(size, int)
+                                 or isinstance(size, bool)):
+            raise SchemaError('Invalid size for `{}`'.format(s['name']))
+    if len(set(names)) != len(names):
+        raise SchemaError('Key names must be unique')
+    refs = list({str(s.get('type')) for s in specs})
+    ids = [r for r in refs if ObjectId.is_valid(r)]
+    types = {}
+    for t in Type.objects(Q(id__in=ids) | Q(name__in=refs)):
+        types[str(t.id)] = t
+        types.setdefault(t.name, t)
+    missing = sorted(r for r in refs if r not in types)
+    if missing:
+        raise SchemaError('Unknown types: {}'.format(', '.join(missing)))
+    keys = [Key(name=s['name'], size=s.get('size'),
+                soft_type=types[str(s['type'])]) for s in specs]
+    if keys:
+        for (key, key_id) in zip(keys, Key.objects.insert(keys,
+                                                          load_bulk=False)):
+            key.id = key_id
+        # What `key.save(user)` would have recorded for each key.
+        save_actions([Action(user=user, action='create', document=key)
+                      for key in keys])
+    return keys
+
+
+def create_node_from_schema(user, path, title, description, specs):
+    """ Create a node and all of its keys at `path`. """
+    keys = create_keys(specs, user)
+    node = Node(title=title, description=description, keys=keys)
+    node.save(user)
+    created = create_node_at_path(user, path, node)
+    invalidate('path', path)
+    index_node(node, path, keys)
+    return created
+
+
 class CreateNodeForm(Form):
     """ Form that allows users to create a new node. """
 
@@ -130,28 +383,25 @@ class CreateNodeForm(Form):
     path = HiddenField()
     title = StringField()
     description = TextAreaField()
+    schema = TextAreaField(label='Keys as a CSV header (name:type[:size])')
 
-    def create_keys_from_fields(self, user):
-        """ Helper function to create node keys from fields. """
-        keys = []
+    def key_specs_from_fields(self):
+        """ Collect the key specs from the `key_N_*` fields. """
+        specs = []
         for i in range(0, self.maximum_keys):
             f1 = 'key_{}_name'.format(i)
             f2 = 'key_{}_type'.format(i)
             f3 = 'key_{}_size'.format(i)
-            if f1 not in self.data:
+            if f1 not in self.data or not self.data[f1]:
                 break
-            key_name = self.data[f1]
-            key_size = self.data[f3]
-            _key_type = self.data[f2]
-            if key_name is None:
-                return keys
-            key_type = Type.objects(id=_key_type).first()
-            key = Key(name=key_name,
-                      size=key_size,
-                      soft_type=key_type)
-            key.save(user)
-            keys.append(key)
-        return keys
+            specs.append({'name': self.data[f1],
+                          'type': self.data[f2],
+                          'size': self.data[f3]})
+        return specs
+
+    def create_keys_from_fields(self, user):
+        """ Helper function to create node keys from fields. """
+        return create_keys(self.key_specs_from_fields(), user)
 
     def validate(self):
         for (k, v) in self.data.items():
@@ -161,11 +411,13 @@ class CreateNodeForm(Form):
 
     def submit(self, user):
         """ Submit the form to create the node. """
-        keys = self.create_keys_from_fields(user)
-        node = Node(title=self.title.data, description=self.description.data,
-                    keys=keys)
-        node.save(user)
-        return create_node_at_path(user, self.data['path'], node)
+        if self.schema.data:
+            specs = parse_schema_header(self.schema.data)
+        else:
+            specs = self.key_specs_from_fields()
+        return create_node_from_schema(user, self.data['path'],
+                                       self.title.data,
+                                       self.description.data, specs)
 
 
 class ChangeApiKeyForm(Form):
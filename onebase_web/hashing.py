@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hmac
+import logging
+import threading
+
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    TimeoutError,
+)
+
+from onebase_common.util import hashpass
+
+logger = logging.getLogger(__name__)
+
+
+class HashingOverloaded(Exception):
+    """ Raised when too many passwords are already waiting to be hashed, or
+    a hash took longer than the timeout. """
+
+
+class PasswordHasher(object):
+    """ Hash passwords on a bounded pool instead of the request thread.
+
+    At most `max_pending` hashes may be queued or running at once; any more
+    are refused immediately with `HashingOverloaded` so a burst of logins
+    can't pile up behind the hashing.
+
+    :param workers: Number of hashing threads.
+
+    :param max_pending: Admission limit (running + queued hashes).
+
+    :param timeout: Seconds to wait for a hash before giving up.
+
+    """
+
+    def __init__(self, workers=2, max_pending=16, timeout=10):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='onebase-hash')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def hash(self, password):
+        """ Hash `password`.
+
+        :raises HashingOverloaded: if the pool is full or the hash timed out.
+        """
+        if not self._slots.acquire(blocking=False):
+            logger.warning('Password hashing pool is full')
+            raise HashingOverloaded()
+        future = self._executor.submit(hashpass, password)
+        future.add_done_callback(lambda f: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # The hash keeps its slot until it finishes.
+            logger.warning('Password hash took over {}s'.format(self.timeout))
+            raise HashingOverloaded()
+
+    def verify(self, password, hashed):
+        """ Check `password` against the stored `hashed` value.
+
+        The password is hashed even when `hashed` is None (unknown user) so
+        the response time doesn't reveal whether an account exists.
+        """
+        candidate = self.hash(password or '')
+        if hashed is None:
+            return False
+        return hmac.compare_digest(str(candidate), str(hashed))
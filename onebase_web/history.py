@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Write-behind buffering of history `Action` records.
+
+Saving a model with a user (`slot.save(user)`, `node.save(user)`, ...) also
+saves an `Action`. In `buffered` mode `Action.save` only queues the record
+(with a client-side id, so references to it stay valid) and the queue is
+written with one `insert_many` when it reaches `size` records, after
+`interval` seconds, and when the process exits. `sync` mode (the default)
+leaves `Action.save` untouched, which is what tests should use.
+
+A batch that fails is retried, but only for the actions that weren't
+written: duplicate-key errors mean the action already made it to Mongo. An
+action is dropped (and logged) after `max_retries` failed flushes, and the
+oldest actions are dropped once more than `max_pending` are queued.
+"""
+
+import atexit
+import logging
+import threading
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from onebase_api.models.history import (
+    Action,
+)
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SYNC = 'sync'
+HISTORY_BUFFERED = 'buffered'
+DUPLICATE_KEY = 11000
+
+
+class HistoryBuffer(object):
+    """ Buffer `Action` writes and flush them in batches.
+
+    :param size: Flush once this many actions are queued.
+
+    :param interval: Flush at least every `interval` seconds.
+
+    :param max_pending: Most actions kept queued while Mongo is failing.
+
+    :param max_retries: Failed flushes after which an action is dropped.
+
+    """
+
+    def __init__(self, size=500, interval=1.0, max_pending=100000,
+                 max_retries=10):
+        self.size = size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self._pending = []
+        # action id -> failed flushes
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._original_save = None
+
+    def add(self, action):
+        """ Queue an unsaved action. """
+        if action.id is None:
+            action.id = ObjectId()
+        action.validate()
+        with self._lock:
+            self._pending.append(action)
+            full = len(self._pending) >= self.size
+        if full:
+            self._wakeup.set()
+        return action
+
+    def flush(self):
+        """ Write every queued action now.
+
+        :return: Number of actions written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                (batch, self._pending) = (self._pending, [])
+            if not batch:
+                return 0
+            try:
+                Action._get_collection().insert_many(
+                    [a.to_mongo() for a in batch], ordered=False)
+            except BulkWriteError as e:
+                # With ordered=False everything but the failed documents
+                # was written; retrying those would only add duplicates.
+                failed = [batch[err['index']]
+                          for err in e.details.get('writeErrors', [])
+                          if err.get('code') != DUPLICATE_KEY]
+                written = len(batch) - len(e.details.get('writeErrors', []))
+                if failed:
+                    logger.error('Could not write {} history actions: {}'
+                                 .format(len(failed), e.details))
+                failed_ids = {a.id for a in failed}
+                self._forget(a for a in batch if a.id not in failed_ids)
+                self._requeue(failed)
+                return written
+            except Exception:
+                logger.exception('Could not write {} history actions'.format(
+                    len(batch)))
+                self._requeue(batch)
+                return 0
+            self._forget(batch)
+            logger.debug('Wrote {} history actions'.format(len(batch)))
+            return len(batch)
+
+    def _forget(self, actions):
+        for a in actions:
+            self._attempts.pop(a.id, None)
+
+    def _requeue(self, actions):
+        """ Put failed actions back at the front of the queue, dropping
+        those out of retries and, if the queue is over `max_pending`, the
+        oldest ones. """
+        retry = []
+        dropped = 0
+        for a in actions:
+            attempts = self._attempts.get(a.id, 0) + 1
+            if attempts > self.max_retries:
+                self._attempts.pop(a.id, None)
+                dropped += 1
+            else:
+                self._attempts[a.id] = attempts
+                retry.append(a)
+        with self._lock:
+            self._pending[:0] = retry
+            overflow = len(self._pending) - self.max_pending
+            if overflow > 0:
+                self._forget(self._pending[:overflow])
+                del self._pending[:overflow]
+                dropped += overflow
+        if dropped:
+            logger.error('Dropped {} history actions'.format(dropped))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def install(self):
+        """ Route `Action.save` through the buffer and start flushing. """
+        if self._original_save is not None:
+            return
+        buffer = self
+        self._original_save = Action.save
+
+        def save(action, *args, **kwargs):
+            return buffer.add(action)
+
+        Action.save = save
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='onebase-history')
+        self._thread.start()
+        atexit.register(self.uninstall)
+
+    def uninstall(self):
+        """ Restore `Action.save` and write whatever is still queued. """
+        if self._original_save is None:
+            return
+        Action.save = self._original_save
+        self._original_save = None
+        self._stopping.set()
+        self._wakeup.set()
+        self.flush()
+
+
+history_buffer = None
+
+
+def configure_history(mode, size=500, interval=1.0, max_pending=100000,
+                      max_retries=10):
+    """ Set up history writes for `mode` (`sync` or `buffered`). Buffering
+    begins with `start_history`. """
+    global history_buffer
+    if mode == HISTORY_SYNC:
+        return None
+    if mode != HISTORY_BUFFERED:
+        raise ValueError('Unknown history mode `{}`'.format(mode))
+    history_buffer = HistoryBuffer(size=size, interval=interval,
+                                   max_pending=max_pending,
+                                   max_retries=max_retries)
+    return history_buffer
+
+
+def start_history():
+    """ Start buffering history in this process, if configured to. """
+    if history_buffer is not None:
+        history_buffer.install()
+
+
+def stop_history():
+    """ Stop buffering history and write what is queued. """
+    if history_buffer is not None:
+        history_buffer.uninstall()
+
+
+def save_actions(actions):
+    """ Save several actions with one write (or queue them, when buffering).
+    """
+    if not actions:
+        return
+    if (history_buffer is not None
+            and history_buffer._original_save is not None):
+        for action in actions:
+            history_buffer.add(action)
+        return
+    Action.objects.insert(actions, load_bulk=False)
+
+
+def flush_history():
+    """ Flush buffered history, if buffering is enabled. """
+    if history_buffer is not None:
+        history_buffer.flush()
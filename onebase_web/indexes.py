@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Indexes the web views rely on, and the query shapes they issue.
+"""
+
+import logging
+
+from bson import ObjectId
+
+from onebase_api.models.auth import (
+    User,
+)
+from onebase_api.models.main import (
+    Path,
+    Slot,
+)
+
+logger = logging.getLogger(__name__)
+
+# (model, fields, options). Field names are the stored (db) names.
+INDEXES = (
+    (Slot, ['key', 'row'], {}),
+    (Slot, ['key', 'value', 'row'], {}),
+    (Path, ['parent', 'string2'], {}),
+    (User, ['email'], {'unique': True}),
+    (User, ['verification'], {}),
+    (User, ['groups'], {}),
+    (User, ['api_key'], {'sparse': True}),
+)
+
+# (name, model, filter, sort) for the hot lookups in the views.
+QUERY_SHAPES = (
+    ('drop_slot / update_slow_row: Slot(key, row)',
+     Slot, {'key': ObjectId(), 'row': 0}, None),
+    ('view_node filter: Slot(key, value)',
+     Slot, {'key': ObjectId(), 'value': ''}, None),
+    ('view_node sort: Slot(key) by value',
+     Slot, {'key': ObjectId()}, [('value', 1)]),
+    ('child_paths: Path(parent) by string2',
+     Path, {'parent': None}, [('string2', 1)]),
+    ('login / register: User(email)',
+     User, {'email': 'someone@example.com'}, None),
+    ('validate: User(verification)',
+     User, {'verification': ''}, None),
+    ('ensure_admin_exists: User(groups)',
+     User, {'groups': {'$in': [ObjectId()]}}, None),
+    ('api: User(api_key)',
+     User, {'api_key': ''}, None),
+)
+
+
+def ensure_indexes(*models):
+    """ Create the declared indexes (for `models`, or for every model).
+
+    :return: List of `(collection, index_name)` created or confirmed.
+    """
+    created = []
+    for (model, fields, options) in INDEXES:
+        if models and model not in models:
+            continue
+        collection = model._get_collection()
+        name = collection.create_index([(f, 1) for f in fields],
+                                       background=True, **options)
+        logger.debug('Index {}.{} ok'.format(collection.name, name))
+        created.append((collection.name, name))
+    return created
+
+
+def _stages(plan):
+    """ Yield every stage name in an explain plan tree. """
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for (k, v) in plan.items():
+            if k in ('inputStage', 'queryPlan', 'winningPlan'):
+                for stage in _stages(v):
+                    yield stage
+            elif k == 'inputStages':
+                for child in v:
+                    for stage in _stages(child):
+                        yield stage
+
+
+def explain_queries():
+    """ Explain each query shape and flag collection scans and sorts.
+
+    :return: List of `(name, stages, problems)`.
+    """
+    report = []
+    for (name, model, query, sort) in QUERY_SHAPES:
+        cursor = model._get_collection().find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+        stages = list(_stages(plan))
+        problems = []
+        if 'COLLSCAN' in stages:
+            problems.append('COLLSCAN')
+        if 'SORT' in stages:
+            problems.append('in-memory SORT')
+        report.append((name, stages, problems))
+    return report
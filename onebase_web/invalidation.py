@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Cache invalidation across worker processes.
+
+In-process caches subscribe to a topic (`node`, `type`, `user`, `path`,
+`api_key`) with `bus.subscribe(topic, handler)`; `invalidate(topic, key)`
+runs the local handlers at once and records the invalidation in the
+`onebase_web_invalidations` capped collection so every other worker runs
+its handlers as well.
+
+Workers follow that collection with a change stream, which also reports
+writes made directly to the types, users, paths and nodes collections
+(from the API or a script, say). Such writes are dispatched twice: under
+their topic, and under `<topic>.written` for subscribers that only care
+about edits to the documents themselves (the search index, say). Change streams need a replica set; on a
+standalone server the collection is polled every `interval` seconds
+instead. A failing change stream is retried with backoff, polling in the
+meantime; failures and the current mode are reported by `metrics`.
+
+Following workers record a heartbeat in `onebase_web_workers`, and nothing
+is written to the capped collection while no other worker is alive (a
+single-worker deployment only runs its own handlers).
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+
+from datetime import (
+    datetime,
+    timedelta,
+)
+
+from bson import ObjectId
+from pymongo.errors import (
+    CollectionInvalid,
+    OperationFailure,
+    PyMongoError,
+)
+
+from onebase_api.models.auth import (
+    User,
+)
+from onebase_api.models.main import (
+    Node,
+    Path,
+    Type,
+)
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_COLLECTION = 'onebase_web_invalidations'
+# Heartbeats of the workers following invalidations.
+WORKERS_COLLECTION = 'onebase_web_workers'
+
+MODE_AUTO = 'auto'
+MODE_CHANGE_STREAM = 'changestream'
+MODE_POLL = 'poll'
+MODE_LOCAL = 'local'
+
+# Model collections whose writes invalidate a topic directly.
+WATCHED_MODELS = (
+    ('type', Type),
+    ('user', User),
+    ('path', Path),
+    ('node', Node),
+)
+
+
+def written(topic):
+    """ Topic of the direct writes to `topic`'s model collection. """
+    return '{}.written'.format(topic)
+
+
+class InvalidationBus(object):
+    """ Deliver invalidations to every worker's caches.
+
+    :param mode: `changestream`, `poll`, `auto` (change streams when the
+        server supports them, polling otherwise) or `local` (this process
+        only).
+
+    :param interval: Seconds between polls in `poll` mode, and the first
+        delay before a failed change stream is retried (doubling up to
+        `MAX_BACKOFF`).
+
+    :param size: Size in bytes of the capped invalidation collection.
+
+    :param heartbeat: Seconds between the heartbeats a started bus records
+        in the workers collection. Invalidations are only written to the
+        capped collection while another worker's heartbeat is recent.
+
+    """
+
+    MAX_BACKOFF = 60
+
+    def __init__(self, mode=MODE_AUTO, interval=1.0, size=8*1024*1024,
+                 heartbeat=5.0):
+        self.mode = mode
+        self.interval = interval
+        self.size = size
+        self.heartbeat = heartbeat
+        # How invalidations are being followed right now (for `metrics`).
+        self.following = None
+        self.counters = {'published': 0, 'unshared': 0, 'failed': 0,
+                         'follow_failures': 0}
+        self._handlers = {}
+        self._ready = False
+        self._thread = None
+        self._heartbeat_thread = None
+        self._stopping = threading.Event()
+        # (other workers seen, monotonic time of the check)
+        self._peers = (True, None)
+
+    @property
+    def origin(self):
+        # Computed each time so a forked worker doesn't pass as its parent.
+        return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def subscribe(self, topic, handler):
+        """ Call `handler(key)` whenever `key` of `topic` is invalidated.
+        `key` is None when the whole topic should be dropped. """
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def dispatch(self, topic, key):
+        """ Run the local handlers for an invalidation. """
+        for handler in self._handlers.get(topic, []):
+            try:
+                handler(key)
+            except Exception:
+                logger.exception('Invalidation handler for {} failed'.format(
+                    topic))
+
+    def dispatch_all(self):
+        """ Drop everything: for when invalidations may have been missed. """
+        for topic in list(self._handlers):
+            self.dispatch(topic, None)
+
+    def publish(self, topic, key=None):
+        """ Invalidate `key` of `topic` in this and every other worker. """
+        key = None if key is None else str(key)
+        self.dispatch(topic, key)
+        if self.mode == MODE_LOCAL:
+            return
+        if not self._has_peers():
+            self.counters['unshared'] += 1
+            return
+        try:
+            self._ensure_collection()
+            self._collection().insert_one({'topic': topic, 'key': key,
+                                           'origin': self.origin,
+                                           'created': datetime.utcnow()})
+            self.counters['published'] += 1
+        except PyMongoError:
+            self.counters['failed'] += 1
+            logger.exception('Could not publish invalidation {}:{}'.format(
+                topic, key))
+
+    def _collection(self):
+        return Type._get_db()[INVALIDATION_COLLECTION]
+
+    def _workers(self):
+        return Type._get_db()[WORKERS_COLLECTION]
+
+    def _ensure_collection(self):
+        """ Create the capped collection before it is first written, so it
+        isn't implicitly created uncapped. """
+        if self._ready:
+            return
+        try:
+            Type._get_db().create_collection(INVALIDATION_COLLECTION,
+                                             capped=True, size=self.size)
+        except CollectionInvalid:
+            pass
+        self._ready = True
+
+    def _has_peers(self):
+        """ Whether another worker has recorded a heartbeat lately (checked
+        at most once per heartbeat; assumed on errors). """
+        (peers, checked) = self._peers
+        now = time.monotonic()
+        if checked is not None and now - checked < self.heartbeat:
+            return peers
+        try:
+            since = datetime.utcnow() - timedelta(seconds=3*self.heartbeat)
+            peers = bool(self._workers().count_documents(
+                {'_id': {'$ne': self.origin}, 'seen': {'$gte': since}},
+                limit=1))
+        except PyMongoError:
+            logger.exception('Could not count workers')
+            peers = True
+        self._peers = (peers, now)
+        return peers
+
+    def _beat(self):
+        """ Record this worker's heartbeat until the bus is stopped. """
+        first = True
+        while True:
+            try:
+                self._workers().update_one(
+                    {'_id': self.origin},
+                    {'$set': {'seen': datetime.utcnow()}}, upsert=True)
+            except PyMongoError:
+                logger.exception('Could not record heartbeat')
+            if self._stopping.wait(self.heartbeat):
+                break
+            if first:
+                # Until the other workers noticed this one they didn't
+                # share their invalidations with it.
+                self.dispatch_all()
+                first = False
+        try:
+            self._workers().delete_one({'_id': self.origin})
+        except PyMongoError:
+            pass
+
+    def _receive(self, doc):
+        if doc.get('origin') != self.origin:
+            self.dispatch(doc['topic'], doc.get('key'))
+
+    def _watch(self):
+        """ Follow changes with a database change stream. """
+        topics = {model._get_collection_name(): topic
+                  for (topic, model) in WATCHED_MODELS}
+        names = list(topics) + [INVALIDATION_COLLECTION, ]
+        pipeline = [{'$match': {'ns.coll': {'$in': names}}}]
+        with Type._get_db().watch(pipeline) as stream:
+            logger.info('Following invalidations with a change stream')
+            self.following = MODE_CHANGE_STREAM
+            for change in stream:
+                if self._stopping.is_set():
+                    return
+                coll = change['ns']['coll']
+                if coll == INVALIDATION_COLLECTION:
+                    if change['operationType'] == 'insert':
+                        self._receive(change['fullDocument'])
+                    continue
+                key = str(change.get('documentKey', {}).get('_id'))
+                self.dispatch(topics[coll], key)
+                self.dispatch(written(topics[coll]), key)
+
+    def _poll(self, until=None):
+        """ Follow the invalidation collection by polling it, for ever or
+        until the monotonic time `until`.
+
+        :return: True if the bus was stopped.
+        """
+        logger.info('Polling for invalidations every {}s'.format(
+            self.interval))
+        self.following = MODE_POLL
+        collection = self._collection()
+        last = ObjectId()
+        while not self._stopping.wait(self.interval):
+            try:
+                for doc in collection.find({'_id': {'$gt': last}}).sort(
+                        '_id', 1):
+                    last = doc['_id']
+                    self._receive(doc)
+            except PyMongoError:
+                logger.exception('Could not poll invalidations')
+            if until is not None and time.monotonic() >= until:
+                return False
+        return True
+
+    def _run(self):
+        delay = self.interval
+        while self.mode in (MODE_AUTO, MODE_CHANGE_STREAM):
+            started = time.monotonic()
+            try:
+                self._watch()
+                return
+            except OperationFailure as e:
+                # A stream that ran for a while starts the backoff over.
+                if time.monotonic() - started > self.MAX_BACKOFF:
+                    delay = self.interval
+                self.counters['follow_failures'] += 1
+                if self.mode == MODE_AUTO:
+                    logger.info('Change streams unavailable ({}); '
+                                'polling'.format(e))
+                    break
+                # Keep receiving published invalidations while waiting;
+                # direct writes to the models are missed until the stream
+                # is back, hence the `dispatch_all` on every retry.
+                logger.exception('Change stream failed; polling for {}s '
+                                 'before retrying'.format(delay))
+                self.dispatch_all()
+                if self._poll(until=time.monotonic() + delay):
+                    return
+            except PyMongoError:
+                if time.monotonic() - started > self.MAX_BACKOFF:
+                    delay = self.interval
+                self.counters['follow_failures'] += 1
+                logger.exception('Change stream interrupted; resuming in '
+                                 '{}s'.format(delay))
+                self.following = None
+                # Anything missed while reconnecting may be stale.
+                self.dispatch_all()
+                if self._stopping.wait(delay):
+                    return
+            delay = min(delay * 2, self.MAX_BACKOFF)
+        self._poll()
+
+    def start(self):
+        """ Start following other workers' invalidations (idempotent). """
+        if self.mode == MODE_LOCAL or self._thread is not None:
+            return
+        self._stopping.clear()
+        self._ensure_collection()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='onebase-invalidation')
+        self._thread.start()
+        self._heartbeat_thread = threading.Thread(
+            target=self._beat, daemon=True, name='onebase-heartbeat')
+        self._heartbeat_thread.start()
+
+    def stop(self, timeout=5):
+        """ Stop following invalidations and remove the heartbeat. """
+        self._stopping.set()
+        for t in (self._thread, self._heartbeat_thread):
+            if t is not None:
+                t.join(timeout)
+        self._thread = None
+        self._heartbeat_thread = None
+
+
+bus = InvalidationBus()
+
+
+def invalidate(topic, key=None):
+    """ Invalidate `key` of `topic` everywhere (see `InvalidationBus`). """
+    bus.publish(topic, key)
+
+
+def configure_invalidation(mode, interval=1.0):
+    """ Set the bus's mode; `bus.start()` starts following. """
+    bus.mode = mode
+    bus.interval = interval
+    return bus
+
+
+def metrics():
+    """ Invalidation counters in the Prometheus text format. """
+    lines = [
+        '# TYPE onebase_invalidation_total counter',
+        '# TYPE onebase_invalidation_following gauge',
+    ]
+    for (counter, value) in sorted(bus.counters.items()):
+        lines.append('onebase_invalidation_total{{result="{}"}} {}'.format(
+            counter, value))
+    for mode in (MODE_CHANGE_STREAM, MODE_POLL):
+        lines.append('onebase_invalidation_following{{mode="{}"}} {}'.format(
+            mode, int(bus.following == mode)))
+    return '\n'.join(lines) + '\n'
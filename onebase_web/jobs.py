@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Background jobs for work too large to do inside a request.
+
+Jobs are stored in Mongo so any worker can pick them up. A running job
+refreshes its `heartbeat` after every batch; if a worker dies, the job's
+lease runs out and another worker resumes it from its last `progress`.
+Handlers must therefore be safe to re-run from the last checkpoint. A worker
+whose lease was taken over finds out at its next checkpoint (`LeaseLost`)
+and leaves the job to its new owner.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+
+from datetime import (
+    datetime,
+    timedelta,
+)
+
+from mongoengine import (
+    Document,
+    DateTimeField,
+    DictField,
+    IntField,
+    ObjectIdField,
+    StringField,
+)
+from pymongo import ReturnDocument
+
+from onebase_api.models.main import (
+    Key,
+    Node,
+    Slot,
+    Type,
+)
+from onebase_web.stats import (
+    record_drop,
+    recompute,
+)
+from onebase_web.invalidation import invalidate
+from onebase_web import settings as web_settings
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+JOB_HANDLERS = {}
+
+
+class LeaseLost(Exception):
+    """ Raised by `checkpoint` when another worker has taken the job over.
+    """
+
+
+class Job(Document):
+    """ A unit of background work. """
+
+    kind = StringField(required=True)
+    params = DictField()
+    status = StringField(default=JOB_QUEUED)
+    progress = IntField(default=0)
+    total = IntField(default=0)
+    owner = StringField()
+    user = ObjectIdField()
+    error = StringField()
+    created = DateTimeField(default=datetime.utcnow)
+    heartbeat = DateTimeField()
+    finished = DateTimeField()
+
+    meta = {
+        'collection': 'onebase_web_jobs',
+        'indexes': [('status', 'heartbeat'), ],
+    }
+
+    @property
+    def percent(self):
+        if not self.total:
+            return 100 if self.status == JOB_DONE else 0
+        return min(100, int(100 * self.progress / self.total))
+
+
+def job_handler(kind):
+    """ Register a function as the handler for jobs of `kind`.
+
+    The handler is called with the `Job` and a `checkpoint(progress)`
+    callback it must call after every batch.
+    """
+    def decorator(f):
+        JOB_HANDLERS[kind] = f
+        return f
+    return decorator
+
+
+def enqueue(kind, params, total=0, user=None):
+    """ Queue a job.
+
+    :return: The saved `Job`.
+    """
+    if kind not in JOB_HANDLERS:
+        raise ValueError('No handler for job `{}`'.format(kind))
+    job = Job(kind=kind, params=params, total=total,
+              user=getattr(user, 'id', None))
+    job.save()
+    logger.info('Queued job {} ({})'.format(job.id, kind))
+    return job
+
+
+def drop_rows(node, rows):
+    """ Delete `rows` of `node` with one query and update its statistics.
+
+    :return: Number of rows that were actually dropped.
+    """
+    keys = node.get_keys()
+    query = Slot.objects(key__in=keys, row__in=rows).no_dereference()
+    dropped = {}
+    for slot in query.only('key', 'row', 'value'):
+        key_id = getattr(slot.key, 'id', slot.key)
+        dropped.setdefault(slot.row, {})[str(key_id)] = slot.value
+    query.delete()
+    if dropped:
+        record_drop(node, list(dropped.values()))
+    return len(dropped)
+
+
+@job_handler('drop_rows')
+def _drop_rows_job(job, checkpoint):
+    node = Node.objects(id=job.params['node']).first()
+    rows = job.params['rows']
+    batch_size = web_settings.ONEBASE_JOB_BATCH_SIZE
+    for start in range(job.progress, len(rows), batch_size):
+        drop_rows(node, rows[start:start+batch_size])
+        checkpoint(min(start + batch_size, len(rows)))
+
+
+def type_slots(type):
+    """ Query of the slots of every key of type `type`. """
+    return Slot.objects(key__in=Key.objects(soft_type=type).only('id'))
+
+
+@job_handler('delete_type')
+def _delete_type_job(job, checkpoint):
+    type = Type.objects(id=job.params['type']).first()
+    if type is None:
+        checkpoint(job.total)
+        return
+    # Delete the type's slots in batches first, so the final delete (which
+    # cascades to its keys) is small. `progress` counts deleted slots.
+    collection = Slot._get_collection()
+    key_ids = [k.id for k in Key.objects(soft_type=type).only('id')]
+    node_ids = [n.id for n in Node.objects(keys__in=key_ids).only('id')]
+    batch_size = web_settings.ONEBASE_JOB_BATCH_SIZE
+    progress = job.progress
+    while True:
+        ids = [doc['_id'] for doc in collection.find(
+            {'key': {'$in': key_ids}}, {'_id': 1}).limit(batch_size)]
+        if not ids:
+            break
+        collection.delete_many({'_id': {'$in': ids}})
+        progress += len(ids)
+        checkpoint(progress)
+    type.delete()
+    invalidate('type', type.id)
+    # The nodes lost those keys' rows and values.
+    for node in Node.objects(id__in=node_ids):
+        recompute(node)
+        invalidate('node', node.id)
+    checkpoint(max(progress, job.total))
+
+
+class JobRunner(object):
+    """ Threads that claim and run queued jobs.
+
+    :param workers: Number of jobs run at the same time by this process.
+
+    :param lease: Seconds without a heartbeat after which a running job is
+        considered abandoned and may be resumed by another worker.
+
+    :param pause: Seconds to sleep between batches, so jobs don't starve
+        foreground traffic.
+
+    """
+
+    def __init__(self, workers=1, lease=60, pause=0.1, poll=2):
+        self.workers = workers
+        self.lease = lease
+        self.pause = pause
+        self.poll = poll
+        self._threads = []
+        self._stopping = threading.Event()
+
+    @property
+    def name(self):
+        # Computed each time so a forked worker doesn't pass as its parent.
+        return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def start(self):
+        """ Start the runner threads (idempotent). """
+        if self._threads:
+            return
+        self._stopping.clear()
+        for i in range(0, self.workers):
+            t = threading.Thread(target=self._run, daemon=True,
+                                 name='onebase-job-{}'.format(i))
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=5):
+        """ Stop claiming jobs. A job still running after `timeout` seconds
+        is resumed elsewhere once its lease runs out. """
+        self._stopping.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def claim(self):
+        """ Atomically claim a queued or abandoned job.
+
+        :return: The claimed `Job`, or None.
+        """
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=self.lease)
+        doc = Job._get_collection().find_one_and_update(
+            {'$or': [
+                {'status': JOB_QUEUED},
+                {'status': JOB_RUNNING, 'heartbeat': {'$lt': stale}},
+            ]},
+            {'$set': {'status': JOB_RUNNING, 'owner': self.name,
+                      'heartbeat': now}},
+            sort=[('created', 1)],
+            return_document=ReturnDocument.AFTER)
+        if doc is None:
+            return None
+        return Job._from_son(doc)
+
+    def _checkpoint(self, job):
+        def checkpoint(progress):
+            job.progress = progress
+            updated = Job.objects(id=job.id, owner=self.name,
+                                  status=JOB_RUNNING).update(
+                set__progress=progress, set__heartbeat=datetime.utcnow())
+            if not updated:
+                raise LeaseLost(job.id)
+            if self.pause:
+                time.sleep(self.pause)
+        return checkpoint
+
+    def run_job(self, job):
+        logger.info('Running job {} ({}) from {}'.format(
+            job.id, job.kind, job.progress))
+        owned = Job.objects(id=job.id, owner=self.name, status=JOB_RUNNING)
+        try:
+            JOB_HANDLERS[job.kind](job, self._checkpoint(job))
+        except LeaseLost:
+            logger.warning('Lost the lease on job {}; leaving it to its new '
+                           'owner'.format(job.id))
+            return
+        except Exception as e:
+            logger.exception('Job {} failed'.format(job.id))
+            owned.update(set__status=JOB_FAILED, set__error=str(e),
+                         set__finished=datetime.utcnow())
+            return
+        if not owned.update(set__status=JOB_DONE,
+                            set__finished=datetime.utcnow()):
+            logger.warning('Lost the lease on job {} as it finished'.format(
+                job.id))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                job = self.claim()
+            except Exception:
+                logger.exception('Could not claim a job')
+                job = None
+            if job is None:
+                self._stopping.wait(self.poll)
+                continue
+            self.run_job(job)
+
+
+job_runner = JobRunner(workers=web_settings.ONEBASE_JOB_WORKERS,
+                       lease=web_settings.ONEBASE_JOB_LEASE,
+                       pause=web_settings.ONEBASE_JOB_PAUSE)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Load generator: drives a running 1Base over HTTP with a mix of traffic.
+
+It only talks HTTP and uses nothing from the application; run it from an
+environment where the package is installed, e.g. against a development
+server backed by a local Mongo::
+
+    python -m onebase_web.loadgen --url http://127.0.0.1:5000 \\
+        --email admin@example.com --password secret --setup \\
+        --users 32 --duration 60 --mix search=60,browse=20,add=8,update=8,login=4
+
+`--setup` first creates a seeded dataset under `/loadtest/<seed>`
+(`--nodes` nodes of `--rows` rows, keys of type `--type`); the same seed
+always produces the same paths and values. The user needs the
+`create_node`, `node_modify` and `node_update` permissions for the
+setup and the write traffic.
+
+Traffic kinds:
+
+`search`
+    Anonymous paging through a node's rows with `/node/search`.
+`browse`
+    Anonymous crawling of `/node/browse` and the child path fragments.
+`add`
+    Logged-in row inserts through `/node/slot/add`.
+`update`
+    Logged-in row updates through `/node/slot/update/<row>`.
+`login`
+    A burst of `--login-burst` logins from a fresh session.
+
+At the end, throughput, latency percentiles and error rates are printed
+per endpoint (and written as JSON with `--json`). A response counts as an
+error unless it is what a successful request returns: a page for reads,
+and for writes and logins a redirect that isn't back to `/login`. 429
+responses are counted as throttled, not as errors.
+
+The harness needs `requests` (`pip install onebase_web[loadgen]`).
+"""
+
+import argparse
+import json
+import random
+import re
+import string
+import sys
+import threading
+import time
+
+from collections import defaultdict
+
+import requests
+
+KINDS = ('search', 'browse', 'add', 'update', 'login')
+KEYS = ('name', 'value', 'note')
+
+_ROW = re.compile(r'name="select_row" value="(\d+)"')
+_CHILD = re.compile(r'href="[^"]*/node/browse\?path=([^"&]+)"')
+
+
+class Results(object):
+    """ Latencies and outcomes per endpoint. """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.throttled = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, status, ok):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if status == 429:
+                self.throttled[endpoint] += 1
+            elif status is None or not ok:
+                self.errors[endpoint] += 1
+
+    def summary(self, elapsed):
+        report = {}
+        for (endpoint, latencies) in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            n = len(latencies)
+
+            def pct(p):
+                return latencies[min(n - 1, int(p * n))] * 1000
+
+            report[endpoint] = {
+                'requests': n,
+                'rps': n / elapsed,
+                'p50_ms': pct(0.50),
+                'p90_ms': pct(0.90),
+                'p99_ms': pct(0.99),
+                'max_ms': latencies[-1] * 1000,
+                'error_rate': self.errors[endpoint] / n,
+                'throttle_rate': self.throttled[endpoint] / n,
+            }
+        return report
+
+
+def print_report(report, elapsed, out=sys.stdout):
+    columns = ('requests', 'rps', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms',
+               'error_rate', 'throttle_rate')
+    out.write('{:<28}'.format('endpoint') + ''.join(
+        '{:>14}'.format(c) for c in columns) + '\n')
+    for (endpoint, row) in report.items():
+        out.write('{:<28}'.format(endpoint) + ''.join(
+            '{:>14}'.format(row[c] if c == 'requests' else
+                            '{:.2%}'.format(row[c]) if c.endswith('rate')
+                            else '{:.1f}'.format(row[c]))
+            for c in columns) + '\n')
+    total = sum(r['requests'] for r in report.values())
+    out.write('{} requests in {:.1f}s ({:.1f}/s)\n'.format(
+        total, elapsed, total / elapsed if elapsed else 0))
+
+
+def is_page(response):
+    return response.status_code in (200, 304)
+
+
+def redirects_to(*paths):
+    """ Outcome check: a redirect to one of `paths` (never to the login
+    page, where an expired or missing session ends up). """
+    def check(response):
+        location = response.headers.get('Location', '')
+        return (response.status_code in (301, 302, 303)
+                and '/login' not in location
+                and any(p in location for p in paths))
+    return check
+
+
+# A successful login redirects anywhere but back to the login page.
+logged_in = redirects_to('/')
+
+
+class Dataset(object):
+    """ Seeded paths and row values. """
+
+    def __init__(self, seed, nodes, rows):
+        self.seed = seed
+        self.root = '/loadtest/{}'.format(seed)
+        self.paths = ['{}/node-{}'.format(self.root, i) for i in range(nodes)]
+        self.rows = rows
+        # Row numbers seen per path, for updates.
+        self.known_rows = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def word(self, rng):
+        return ''.join(rng.choice(string.ascii_lowercase)
+                       for i in range(rng.randint(3, 10)))
+
+    def values(self, rng):
+        return {'name': self.word(rng),
+                'value': str(rng.randint(0, 10**6)),
+                'note': ' '.join(self.word(rng)
+                                 for i in range(rng.randint(1, 5)))}
+
+    def remember_rows(self, path, html):
+        rows = {int(r) for r in _ROW.findall(html)}
+        with self._lock:
+            self.known_rows[path].update(rows)
+
+    def pick_row(self, rng, path):
+        with self._lock:
+            rows = self.known_rows.get(path)
+            return rng.choice(sorted(rows)) if rows else None
+
+
+class Client(object):
+    """ One virtual user. """
+
+    def __init__(self, args, dataset, results, rng):
+        self.args = args
+        self.url = args.url.rstrip('/')
+        self.dataset = dataset
+        self.results = results
+        self.rng = rng
+        self.session = requests.Session()
+        self.pages = {}
+
+    def request(self, endpoint, method, path, ok=is_page, record=True,
+                **kwargs):
+        """ Send a request and record its latency and outcome.
+
+        :param ok: Check of a response that counts as a success.
+
+        """
+        kwargs.setdefault('allow_redirects', False)
+        kwargs.setdefault('timeout', self.args.timeout)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url + path,
+                                            **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            (response, status) = (None, None)
+        if record:
+            self.results.record(endpoint, time.perf_counter() - start,
+                                status, response is not None and ok(response))
+        return response
+
+    def login(self, record=True):
+        return self.request('POST /login', 'POST', '/login', ok=logged_in,
+                            record=record,
+                            data={'email': self.args.email,
+                                  'password': self.args.password})
+
+    def search(self):
+        path = self.rng.choice(self.dataset.paths)
+        offset = self.pages.get(path, 0)
+        count = self.args.page_size
+        response = self.request('GET /node/search', 'GET', '/node/search',
+                                params={'path': path, 'offset': offset,
+                                        'count': count})
+        if response is None or response.status_code != 200:
+            return
+        self.dataset.remember_rows(path, response.text)
+        # Page forward like a reader would, starting over at the end.
+        more = offset + count < self.dataset.rows
+        self.pages[path] = offset + count if more else 0
+
+    def browse(self):
+        path = self.dataset.root
+        for depth in range(3):
+            self.request('GET /node/browse', 'GET', '/node/browse',
+                         ok=lambda r: is_page(r) or redirects_to(
+                             '/node/search')(r),
+                         params={'path': path})
+            response = self.request('GET /node/fragment/children', 'GET',
+                                    '/node/fragment/children',
+                                    params={'path': path})
+            if response is None or response.status_code != 200:
+                return
+            children = _CHILD.findall(response.text)
+            if not children:
+                return
+            path = requests.utils.unquote(self.rng.choice(children))
+
+    def add(self):
+        path = self.rng.choice(self.dataset.paths)
+        self.request('POST /node/slot/add', 'POST', '/node/slot/add',
+                     ok=redirects_to('/node/search'), params={'path': path},
+                     data=self.dataset.values(self.rng))
+
+    def update(self):
+        path = self.rng.choice(self.dataset.paths)
+        row = self.dataset.pick_row(self.rng, path)
+        if row is None:
+            return self.search()
+        self.request('POST /node/slot/update/<row>', 'POST',
+                     '/node/slot/update/{}'.format(row),
+                     ok=redirects_to('/node/search'), params={'path': path},
+                     data=self.dataset.values(self.rng))
+
+    def login_burst(self):
+        client = Client(self.args, self.dataset, self.results, self.rng)
+        for i in range(self.args.login_burst):
+            client.login()
+
+
+def setup(args, dataset):
+    """ Create the dataset's nodes and rows. """
+    client = Client(args, dataset, Results(), random.Random(args.seed))
+    log_in(client)
+    for path in dataset.paths:
+        response = _retry(lambda: client.request(
+            'setup', 'POST', '/node/create', params={'path': path},
+            json={'title': path.rsplit('/', 1)[-1],
+                  'description': 'Load test data (seed {})'.format(
+                      args.seed),
+                  'keys': [{'name': k, 'type': args.type} for k in KEYS]}))
+        if response is None or response.status_code != 201:
+            # Most likely left over from an earlier run with this seed.
+            print('{}: not created ({}); reusing it'.format(
+                path, getattr(response, 'status_code', 'no response')),
+                file=sys.stderr)
+            continue
+        added = 0
+        for i in range(args.rows):
+            values = dataset.values(client.rng)
+            response = _retry(lambda: client.request(
+                'setup', 'POST', '/node/slot/add', params={'path': path},
+                data=values))
+            if response is None or not redirects_to('/node/search')(
+                    response):
+                raise SystemExit('Could not add rows to {} ({})'.format(
+                    path, getattr(response, 'status_code', 'no response')))
+            added += 1
+        print('{}: {} rows'.format(path, added), file=sys.stderr)
+
+
+def _retry(send):
+    """ Send a request until it isn't refused with 429. """
+    while True:
+        response = send()
+        if response is None or response.status_code != 429:
+            return response
+        time.sleep(float(response.headers.get('Retry-After', 1)))
+
+
+def log_in(client):
+    """ Log `client` in (waiting out throttling), or stop the run. """
+    response = _retry(lambda: client.login(record=False))
+    if response is None or not logged_in(response):
+        raise SystemExit('Could not log in as {} ({})'.format(
+            client.args.email,
+            getattr(response, 'status_code', 'no response')))
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        (kind, weight) = part.split('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError('Unknown traffic `{}`'.format(
+                kind))
+        weights[kind] = float(weight)
+    return weights
+
+
+def run(args, dataset, results):
+    kinds = list(args.mix)
+    weights = [args.mix[k] for k in kinds]
+    writes = any(args.mix.get(k) for k in ('add', 'update'))
+    clients = []
+    for i in range(args.users):
+        client = Client(args, dataset, results,
+                        random.Random('{}-{}'.format(args.seed, i)))
+        # Writes made without a session would only measure redirects to
+        # the login page, so don't start unless every user is logged in.
+        if writes:
+            log_in(client)
+        clients.append(client)
+    deadline = time.monotonic() + args.duration
+
+    def user(client):
+        rng = client.rng
+        actions = {'search': client.search, 'browse': client.browse,
+                   'add': client.add, 'update': client.update,
+                   'login': client.login_burst}
+        while time.monotonic() < deadline:
+            actions[rng.choices(kinds, weights)[0]]()
+            if args.think:
+                time.sleep(rng.expovariate(1 / args.think))
+
+    threads = [threading.Thread(target=user, args=(c, ), daemon=True)
+               for c in clients]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.monotonic() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Drive a running 1Base with a mix of traffic.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--email', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--setup', action='store_true',
+                        help='Create the dataset before running.')
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--type', default='string',
+                        help='Type (name or id) of the dataset\'s keys.')
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--think', type=float, default=0,
+                        help='Mean pause between a user\'s requests (s).')
+    parser.add_argument('--mix', type=parse_mix,
+                        default=parse_mix('search=60,browse=20,add=8,'
+                                          'update=8,login=4'))
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--login-burst', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--json', help='Also write the report here.')
+    args = parser.parse_args(argv)
+
+    dataset = Dataset(args.seed, args.nodes, args.rows)
+    if args.setup:
+        setup(args, dataset)
+    results = Results()
+    elapsed = run(args, dataset, results)
+    report = results.summary(elapsed)
+    print_report(report, elapsed)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({'elapsed': elapsed, 'users': args.users,
+                       'mix': args.mix, 'endpoints': report}, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
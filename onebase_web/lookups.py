@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Cached lookups of the documents read on nearly every request: the current
+user (whose permissions are checked on the cached copy), the types keys are
+validated against, and paths.
+
+The caches are `DocumentCache`s on the configured backend and are dropped
+through the invalidation bus when the documents change.
+"""
+
+from onebase_api.models.auth import User
+from onebase_api.models.main import (
+    Path,
+    Type,
+)
+from onebase_web.cache import DocumentCache
+from onebase_web.invalidation import bus
+from onebase_web import settings as web_settings
+
+user_cache = DocumentCache('users', User, max_size=4096,
+                           ttl=web_settings.ONEBASE_DOCUMENT_CACHE_TTL)
+type_cache = DocumentCache('types', Type, max_size=1024,
+                           ttl=web_settings.ONEBASE_DOCUMENT_CACHE_TTL)
+path_cache = DocumentCache('paths', Path, max_size=4096,
+                           ttl=web_settings.ONEBASE_DOCUMENT_CACHE_TTL)
+bus.subscribe('user', user_cache.forget)
+bus.subscribe('type', type_cache.forget)
+# Path invalidations carry either a path or a document id, and a move
+# changes every path below it, so drop them all.
+bus.subscribe('path', lambda key: path_cache.clear())
+
+
+def load_user(user_id):
+    """ The user with id `user_id`, or None. """
+    user = user_cache.get(user_id)
+    if user is None:
+        user = User.objects(id=user_id).first()
+        if user is not None:
+            user_cache.set(user_id, user)
+    return user
+
+
+def load_type(type_id):
+    """ The type with id `type_id`, or None. """
+    type = type_cache.get(type_id)
+    if type is None:
+        type = Type.objects(id=type_id).first()
+        if type is not None:
+            type_cache.set(type_id, type)
+    return type
+
+
+def key_type(key):
+    """ The type of `key` (in place of `key.soft_type.fetch()`). """
+    soft_type = key.soft_type
+    return load_type(getattr(soft_type, 'id', soft_type))
+
+
+def find_path(path):
+    """ `Path.find(path)`, cached. """
+    found = path_cache.get(path)
+    if found is None:
+        found = Path.find(path)
+        if found is not None:
+            path_cache.set(path, found)
+    return found
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+class Row(object):
+    """ One rendered row: values are positional, aligned with the page's
+    columns. """
+
+    __slots__ = ('number', 'values', 'html')
+
+    def __init__(self, number, values, html):
+        self.number = number
+        self.values = values
+        self.html = html
+
+
+class Page(object):
+    """ A page of rendered rows.
+
+    The keys are held once for the whole page; each `Row` only holds lists
+    of values and their HTML, one entry per column (None / '' for missing
+    cells).
+    """
+
+    __slots__ = ('keys', 'columns', 'rows')
+
+    def __init__(self, keys, columns, rows):
+        self.keys = keys
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __repr__(self):
+        return '<Page {} rows x {} columns>'.format(len(self.rows),
+                                                    len(self.columns))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Next-page prefetching for node pages.
+
+After `view_node` serves rows `offset` to `offset+count` of a node, the
+following page is selected in the background and kept in a short-lived
+cache, so clicking "next" doesn't wait on the database. Prefetches share a
+small global limit and are skipped entirely while the host is busy; the
+statistics write hooks invalidate a node's cached pages, in every worker,
+whenever it changes.
+"""
+
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from onebase_web.cache import (
+    BACKEND_PROCESS,
+    make_cache,
+)
+from onebase_web.invalidation import bus
+from onebase_web import settings as web_settings
+
+logger = logging.getLogger(__name__)
+
+
+def _host_load():
+    """ 1-minute load average per CPU (0 where it isn't available). """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return 0
+
+
+class PageCache(object):
+    """ Cache of `do_select` results, grouped by node.
+
+    All pages of a node are stored under the node's id so they can be
+    dropped together. Pages hold live documents, so they stay in the
+    process.
+    """
+
+    def __init__(self, max_nodes=256, ttl=30):
+        self.cache = make_cache('pages', max_size=max_nodes, ttl=ttl,
+                                backend=BACKEND_PROCESS)
+        self._lock = threading.Lock()
+        # Bumped by every invalidation (per node, and for all nodes), so a
+        # page selected before one isn't stored after it.
+        self._generations = {}
+        self._generation = 0
+
+    def _token(self, node_id):
+        return (self._generation, self._generations.get(str(node_id), 0))
+
+    def generation(self, node_id):
+        """ Token to pass to `set` for a page about to be selected. """
+        with self._lock:
+            return self._token(node_id)
+
+    def get(self, node_id, offset, count):
+        return self.cache.get(str(node_id), {}).get((offset, count))
+
+    def set(self, node_id, offset, count, query_set, generation=None):
+        """ Store a page, unless the node changed since `generation`. """
+        with self._lock:
+            if generation is not None and generation != self._token(node_id):
+                return False
+            pages = dict(self.cache.get(str(node_id), {}))
+            pages[(offset, count)] = query_set
+            self.cache.set(str(node_id), pages)
+            return True
+
+    def invalidate(self, node_id=None):
+        """ Drop every cached page of a node (or of every node). """
+        with self._lock:
+            if node_id is None:
+                self._generation += 1
+                self.cache.clear()
+            else:
+                key = str(node_id)
+                self._generations[key] = self._generations.get(key, 0) + 1
+                self.cache.delete(key)
+
+
+class Prefetcher(object):
+    """ Select the next page of a node in the background.
+
+    :param workers: Maximum number of prefetches running at once, across
+        every request of this process. Prefetches beyond that are dropped,
+        not queued.
+
+    :param max_load: Skip prefetching while the load average per CPU is
+        above this.
+
+    """
+
+    def __init__(self, page_cache, workers=2, max_load=0.75, enabled=True):
+        self.page_cache = page_cache
+        self.max_load = max_load
+        self.enabled = enabled
+        self._slots = threading.BoundedSemaphore(workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='onebase-prefetch')
+
+    def _select(self, node, offset, count, environment):
+        try:
+            generation = self.page_cache.generation(node.id)
+            query_set = node.do_select(offset=offset,
+                                       limit=count,
+                                       expand_keys=True,
+                                       expand_slots=False,
+                                       environment=environment)
+            self.page_cache.set(node.id, offset, count,
+                                dict(sorted(query_set.items())), generation)
+        except Exception:
+            logger.exception('Prefetch of {} [{}:{}] failed'.format(
+                node.id, offset, offset+count))
+        finally:
+            self._slots.release()
+
+    def prefetch(self, node, offset, count, environment):
+        """ Start selecting rows `offset` to `offset+count` of `node`.
+
+        :return: True if a prefetch was started.
+        """
+        if not self.enabled:
+            return False
+        if self.page_cache.get(node.id, offset, count) is not None:
+            return False
+        if _host_load() > self.max_load:
+            logger.debug('Host busy; not prefetching')
+            return False
+        if not self._slots.acquire(blocking=False):
+            return False
+        self._executor.submit(copy_context().run, self._select, node, offset,
+                              count, environment)
+        return True
+
+
+page_cache = PageCache(ttl=web_settings.ONEBASE_PREFETCH_TTL)
+bus.subscribe('node', page_cache.invalidate)
+prefetcher = Prefetcher(page_cache,
+                        workers=web_settings.ONEBASE_PREFETCH_WORKERS,
+                        max_load=web_settings.ONEBASE_PREFETCH_MAX_LOAD,
+                        enabled=web_settings.ONEBASE_PREFETCH)
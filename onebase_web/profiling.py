@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+On-demand profiling of single requests.
+
+A request carrying a valid profile token (`X-Onebase-Profile` header or
+`_profile` argument, minted with `flask profile-token`) from an admin is
+run under cProfile and a stack sampler. Two files are written per request:
+`<id>.prof` (load with `pstats`/snakeviz) and `<id>.folded` (collapsed
+stacks for flamegraph.pl/speedscope).
+"""
+
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from datetime import datetime
+
+from itsdangerous import (
+    BadSignature,
+    TimestampSigner,
+)
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Onebase-Profile'
+PROFILE_ARG = '_profile'
+_SALT = 'onebase-profile'
+
+
+def make_token(secret):
+    """ Mint a profile token. """
+    return TimestampSigner(secret, salt=_SALT).sign(b'profile').decode()
+
+
+def check_token(secret, token, max_age):
+    """ True if `token` is a valid, unexpired profile token. """
+    try:
+        TimestampSigner(secret, salt=_SALT).unsign(token, max_age=max_age)
+    except BadSignature:
+        return False
+    return True
+
+
+class StackSampler(threading.Thread):
+    """ Sample one thread's stack every `interval` seconds. """
+
+    def __init__(self, thread_id, interval=0.005):
+        super(StackSampler, self).__init__(daemon=True,
+                                           name='onebase-sampler')
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class RequestProfile(object):
+    """ Profile the current thread until `stop` is called. """
+
+    def __init__(self, interval=0.005):
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), interval)
+        self.started = time.time()
+
+    def start(self):
+        self.sampler.start()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        self.sampler.stop()
+
+    def write(self, directory, label):
+        """ Write the `.prof` and `.folded` files.
+
+        :return: The profile id (file name without extension).
+        """
+        os.makedirs(directory, exist_ok=True)
+        profile_id = '{}-{}'.format(
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'),
+            ''.join(c if c.isalnum() else '_' for c in label)[:60])
+        base = os.path.join(directory, profile_id)
+        self.profiler.dump_stats(base + '.prof')
+        with open(base + '.folded', 'w') as fh:
+            for (stack, count) in self.sampler.stacks.most_common():
+                fh.write('{} {}\n'.format(stack, count))
+        return profile_id
+
+
+def prune(directory, keep):
+    """ Keep only the newest `keep` profiles in `directory`. """
+    profiles = {}
+    for f in os.listdir(directory):
+        (name, ext) = os.path.splitext(f)
+        if ext in ('.prof', '.folded'):
+            profiles.setdefault(name, []).append(os.path.join(directory, f))
+    for name in sorted(profiles)[:-keep or None]:
+        for path in profiles[name]:
+            os.remove(path)
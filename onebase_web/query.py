@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Server-side filtering and sorting of node rows.
+
+Filters are given as repeated ``filter=<key>:<op>:<value>`` arguments and
+the sort order as ``sort=<key>`` (ascending) or ``sort=-<key>``
+(descending), e.g.::
+
+    /node/search?path=a/b&filter=name:prefix:Jo&filter=age:gte:30&sort=-age
+
+Slot values are compared as they are stored (form input is stored as
+strings), except that the range operators compare the values of keys with a
+numeric type as numbers. Sorting by a key only lists the rows that have a
+slot for it.
+
+Filtered queries are resolved in one aggregation over the slots: the slots
+matching any filter are grouped by row, and only rows with a match for
+every filtered key are kept, sorted and paged on the server. Sort values
+are only looked up for the rows that passed the filters.
+"""
+
+import logging
+import re
+
+from onebase_api.models.main import (
+    Slot,
+)
+from onebase_web.lookups import key_type
+from onebase_web.routing import (
+    read_collection,
+    reads,
+)
+
+logger = logging.getLogger(__name__)
+
+OPERATORS = ('eq', 'prefix', 'gt', 'gte', 'lt', 'lte')
+# Type names whose values the range operators compare as numbers.
+NUMERIC_TYPES = {'int', 'integer', 'long', 'float', 'double', 'decimal',
+                 'number'}
+
+
+class QueryError(ValueError):
+    """ Raised for a malformed filter or sort argument. """
+
+
+def _is_numeric(key):
+    name = getattr(key_type(key), 'name', None) or ''
+    return name.lower() in NUMERIC_TYPES
+
+
+def _condition(op, value, numeric=False):
+    """ Query condition on a slot for one filter. """
+    if op == 'eq':
+        return {'value': value}
+    if op == 'prefix':
+        return {'value': {'$regex': '^' + re.escape(value)}}
+    if not numeric:
+        return {'value': {'$' + op: value}}
+    try:
+        number = float(value)
+    except ValueError:
+        raise QueryError('`{}` is not a number'.format(value))
+    # Values that aren't numbers convert to null, which never matches.
+    return {'$expr': {'$let': {
+        'vars': {'v': {'$convert': {'input': '$value', 'to': 'double',
+                                    'onError': None, 'onNull': None}}},
+        'in': {'$and': [{'$ne': ['$$v', None]},
+                        {'$' + op: ['$$v', number]}]},
+    }}}
+
+
+class NodeQuery(object):
+    """ Filters and sort order for a node, pushed down to `Slot` queries.
+
+    :param filters: List of `(key_name, op, value)`.
+
+    :param sort: Key name to sort by, or None for row order.
+
+    :param descending: Sort descending.
+
+    """
+
+    def __init__(self, filters=None, sort=None, descending=False):
+        self.filters = filters or []
+        self.sort = sort
+        self.descending = descending
+
+    @classmethod
+    def from_args(cls, args):
+        """ Build a query from request arguments. """
+        filters = []
+        for f in args.getlist('filter'):
+            if not f:
+                continue
+            parts = f.split(':', 2)
+            if len(parts) != 3 or parts[1] not in OPERATORS:
+                raise QueryError('Invalid filter `{}`'.format(f))
+            filters.append(tuple(parts))
+        sort = args.get('sort') or None
+        descending = False
+        if sort is not None and sort.startswith('-'):
+            (sort, descending) = (sort[1:], True)
+        return cls(filters=filters, sort=sort, descending=descending)
+
+    def __bool__(self):
+        return bool(self.filters) or self.sort is not None
+
+    def _key(self, keys_by_name, name):
+        if name not in keys_by_name:
+            raise QueryError('Unknown key `{}`'.format(name))
+        return keys_by_name[name]
+
+    def _filter_clauses(self, keys_by_name):
+        """ One `$match` clause per filtered key, with all of its filters.
+        """
+        conditions = {}
+        for (name, op, value) in self.filters:
+            key = self._key(keys_by_name, name)
+            numeric = op not in ('eq', 'prefix') and _is_numeric(key)
+            conditions.setdefault(key.id, []).append(
+                _condition(op, value, numeric))
+        return [{'key': key_id, '$and': c}
+                for (key_id, c) in conditions.items()]
+
+    def _aggregate(self, clauses, sort_key, offset, count):
+        """ Page of the rows matching every clause, sorted by the value of
+        `sort_key` (or by row number).
+
+        :return: `(total, rows)`.
+        """
+        filter_keys = [c['key'] for c in clauses]
+        group = {
+            '_id': '$row',
+            'matched': {'$sum': 1},
+        }
+        pipeline = [
+            {'$match': {'$or': clauses}},
+            {'$group': group},
+            {'$match': {'matched': len(filter_keys)}},
+        ]
+        order = {'_id': 1}
+        if sort_key is not None:
+            if sort_key.id in filter_keys:
+                # The filter already brought the sort key's slots.
+                group['sort'] = {'$max': {'$cond': [
+                    {'$eq': ['$key', sort_key.id]}, '$value', None]}}
+            else:
+                pipeline += [
+                    {'$lookup': {
+                        'from': Slot._get_collection_name(),
+                        'let': {'row': '$_id'},
+                        'pipeline': [
+                            {'$match': {'key': sort_key.id,
+                                        '$expr': {'$eq': ['$row',
+                                                          '$$row']}}},
+                            {'$limit': 1},
+                            {'$project': {'_id': 0, 'value': 1}},
+                        ],
+                        'as': 'sort',
+                    }},
+                    # Like the sort-only pages, leave out rows without a
+                    # slot for the sort key.
+                    {'$match': {'sort': {'$ne': []}}},
+                    {'$addFields': {'sort': {'$arrayElemAt': ['$sort.value',
+                                                               0]}}},
+                ]
+            order = {'sort': -1 if self.descending else 1, '_id': 1}
+        pipeline.append({'$facet': {
+            'total': [{'$count': 'n'}],
+            'rows': [{'$sort': order},
+                     {'$skip': offset},
+                     {'$limit': count},
+                     {'$project': {'_id': 1}}],
+        }})
+        (result, ) = read_collection(Slot).aggregate(pipeline,
+                                                     allowDiskUse=True)
+        total = result['total'][0]['n'] if result['total'] else 0
+        return (total, [r['_id'] for r in result['rows']])
+
+    def select_rows(self, node, keys, offset, count):
+        """ Resolve the filters and sort order to a page of row numbers.
+
+        :return: `(total, rows)` where `rows` is in display order.
+        """
+        keys_by_name = {k.name: k for k in keys}
+        sort_key = None
+        if self.sort is not None:
+            sort_key = self._key(keys_by_name, self.sort)
+        clauses = self._filter_clauses(keys_by_name)
+        if clauses:
+            return self._aggregate(clauses, sort_key, offset, count)
+        # Sort only: walk the (key, value) index. Only rows with a slot for
+        # the sort key are listed, so they are also what is counted.
+        slots = reads(Slot.objects(key=sort_key))
+        order = '-value' if self.descending else 'value'
+        page = slots.order_by(order).skip(offset).limit(count).scalar('row')
+        return (slots.count(), list(page))
+
+
+def fetch_rows(keys, rows):
+    """ Fetch the slots of `rows` in one query.
+
+    :return: `{row: {col: slot}}` ordered like `rows`, where `col` is the
+        key's position in `keys`.
+    """
+    columns = {k.id: i for (i, k) in enumerate(keys)}
+    query_set = {r: {} for r in rows}
+    if not rows:
+        return query_set
+    slots = reads(Slot.objects(key__in=keys, row__in=list(rows))) \
+        .no_dereference()
+    for slot in slots:
+        col = columns[getattr(slot.key, 'id', slot.key)]
+        # Reuse the already loaded Key rather than dereferencing per slot.
+        slot.key = keys[col]
+        query_set[slot.row][col] = slot
+    return query_set
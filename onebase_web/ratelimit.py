@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class TokenBucket(object):
+    """ Classic token bucket.
+
+    :param rate: Tokens added per second.
+
+    :param capacity: Maximum number of tokens (the allowed burst).
+
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, n=1, now=None):
+        """ Try to take `n` tokens.
+
+        :return: 0 if the tokens were taken, otherwise the number of seconds
+            until enough tokens will be available.
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0
+        return (n - self.tokens) / self.rate
+
+    def wait(self, n=1, now=None):
+        """ Seconds until `n` tokens are available, without taking them. """
+        now = time.monotonic() if now is None else now
+        tokens = min(self.capacity,
+                     self.tokens + (now - self.updated) * self.rate)
+        return max(0, (n - tokens) / self.rate)
+
+
+class RateLimiter(object):
+    """ Token buckets keyed by an arbitrary string (an IP, an email, ...).
+
+    Only the `max_keys` most recently used buckets are kept.
+    """
+
+    def __init__(self, rate, capacity, max_keys=100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, n=1):
+        """ Take `n` tokens from `key`'s bucket.
+
+        :return: 0 if allowed, otherwise the seconds to wait before retrying.
+        """
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return bucket.take(n)
+
+    def wait(self, key, n=1):
+        """ Seconds until `key` may take `n` tokens, without taking any. """
+        with self._lock:
+            bucket = self._buckets.get(key)
+            return 0 if bucket is None else bucket.wait(n)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import threading
+
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    wait,
+)
+
+from markupsafe import escape
+
+from onebase_api.models.main import (
+    Slot,
+)
+from onebase_web.cache import make_cache
+from onebase_web.invalidation import bus
+from onebase_web.page import (
+    Page,
+    Row,
+)
+from onebase_web import settings as web_settings
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+def _type_id(key):
+    soft_type = getattr(key, 'soft_type', None)
+    return str(getattr(soft_type, 'id', soft_type))
+
+
+class ReprEngine(object):
+    """ Render slot representations for a whole page at once.
+
+    Identical (type, value) pairs on a page are only rendered once, distinct
+    ones are rendered concurrently, and results are kept in a TTL cache.
+    Anything not ready after `timeout` seconds falls back to the raw value
+    (and still lands in the cache when it finishes).
+
+    :param workers: Number of concurrent representation fetches.
+
+    :param timeout: Seconds to wait for a page's representations.
+
+    :param ttl: Seconds a representation stays cached.
+
+    """
+
+    def __init__(self, workers=8, timeout=2, ttl=300, max_size=10000):
+        self.timeout = timeout
+        self.cache = make_cache('reprs', max_size=max_size, ttl=ttl)
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='onebase-repr')
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, cache_key, slot, environment):
+        try:
+            html = slot.get_repr(environment=environment)
+            self.cache.set(cache_key, html)
+            return html
+        finally:
+            with self._lock:
+                self._inflight.pop(cache_key, None)
+
+    def _submit(self, cache_key, slot, environment):
+        """ Start rendering `cache_key`, or join a render already running.
+        """
+        with self._lock:
+            future = self._inflight.get(cache_key)
+            if future is None:
+                future = self._executor.submit(self._fetch, cache_key, slot,
+                                               environment)
+                if not future.done():
+                    self._inflight[cache_key] = future
+            return future
+
+    def render(self, slots, environment):
+        """ Render each slot.
+
+        :return: List of HTML strings, in the same order as `slots`.
+        """
+        mimetype = environment.get('return_mimetype')
+        cache_keys = [(_type_id(s.key), str(s.value), mimetype)
+                      for s in slots]
+        return self._render(cache_keys, lambda i: slots[i], environment)
+
+    def _render(self, cache_keys, slot_at, environment):
+        """ Render `(type id, value, mimetype)` cache keys; `slot_at(i)`
+        builds the slot to render the i-th one from, only on a cache miss.
+        Anything not rendered falls back to the escaped raw value. """
+        results = {}
+        pending = {}
+        for (i, cache_key) in enumerate(cache_keys):
+            if cache_key in results or cache_key in pending:
+                continue
+            hit = self.cache.get(cache_key, _MISSING)
+            if hit is not _MISSING:
+                results[cache_key] = hit
+                continue
+            pending[cache_key] = self._submit(cache_key, slot_at(i),
+                                              environment)
+        if pending:
+            (done, not_done) = wait(pending.values(), timeout=self.timeout)
+            if not_done:
+                logger.warning('{} representations timed out'.format(
+                    len(not_done)))
+            for (cache_key, future) in pending.items():
+                if future not in done:
+                    continue
+                if future.exception() is not None:
+                    logger.warning('Representation failed: {}'.format(
+                        future.exception()))
+                    continue
+                results[cache_key] = future.result()
+        return [results[k] if k in results else escape(k[1])
+                for k in cache_keys]
+
+    def expand(self, query_set, environment, keys=None):
+        """ Render an unexpanded `do_select` result into a `Page`.
+
+        :param query_set: `{row: {col: slot}}`, in display order.
+
+        :param keys: The node's keys, kept once on the page. When given,
+            the page has one column per key, even for keys with no cells on
+            this page, so columns always line up with the keys.
+
+        """
+        if keys:
+            columns = list(range(len(keys)))
+        else:
+            columns = sorted({col for row in query_set.values()
+                              for col in row})
+        slots = []
+        for row in query_set.values():
+            for col in columns:
+                cell = row.get(col)
+                if isinstance(cell, (tuple, list)):
+                    cell = cell[0]
+                slots.append(cell)
+        present = [s for s in slots if s is not None]
+        rendered = iter(self.render(present, environment))
+        html = [next(rendered) if s is not None else '' for s in slots]
+        width = len(columns)
+        rows = []
+        for (i, row_num) in enumerate(query_set):
+            start = i * width
+            rows.append(Row(row_num,
+                            [getattr(s, 'value', None)
+                             for s in slots[start:start+width]],
+                            html[start:start+width]))
+        return Page(keys or [], columns, rows)
+
+    def expand_values(self, rows, environment, keys):
+        """ Render plain values (e.g. from a snapshot) into a `Page`.
+
+        :param rows: `{row: [value per key]}`, None for missing cells.
+
+        """
+        mimetype = environment.get('return_mimetype')
+        type_ids = [_type_id(k) for k in keys]
+        cells = [(row, col, value) for (row, values) in rows.items()
+                 for (col, value) in enumerate(values) if value is not None]
+        rendered = iter(self._render(
+            [(type_ids[col], str(value), mimetype)
+             for (row, col, value) in cells],
+            lambda i: Slot(key=keys[cells[i][1]], row=cells[i][0],
+                           value=cells[i][2]),
+            environment))
+        page = []
+        for (row, values) in rows.items():
+            html = [next(rendered) if v is not None else '' for v in values]
+            page.append(Row(row, list(values), html))
+        return Page(keys, list(range(len(keys))), page)
+
+
+repr_engine = ReprEngine(workers=web_settings.ONEBASE_REPR_WORKERS,
+                         timeout=web_settings.ONEBASE_REPR_TIMEOUT,
+                         ttl=web_settings.ONEBASE_REPR_TTL)
+# Representations depend on the type's `repr`, so any type change drops them.
+bus.subscribe('type', lambda type_id: repr_engine.cache.clear())
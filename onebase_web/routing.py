@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Read-preference routing.
+
+GET requests to the endpoints listed in `ONEBASE_READ_ENDPOINTS` may read
+through a second connection (the `onebase-reads` alias) that prefers
+secondaries, bounded by `ONEBASE_READ_MAX_STALENESS`. A client that has
+just written something (any non-GET request) is kept on the primary for
+`ONEBASE_READ_AFTER_WRITE` seconds so it sees its own change.
+
+Only the queries a view explicitly passes through `reads` (or runs on
+`read_collection`, like `stats.read_stats`) are routed; everything else,
+including every write and every read whose result may be written back
+(such as `get_stats`), stays on the primary. The route carries over into
+`concurrency.gather`.
+
+`Node.do_select` (onebase_api) always reads from the primary, since its
+queries can't be passed through `reads`. Unfiltered node pages that aren't
+served from a snapshot or a prefetched page therefore still read their
+slots from the primary; only filtered and sorted pages (`query`), child
+path lists, types and search are fully routed.
+"""
+
+import logging
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import (
+    g,
+    request,
+)
+from mongoengine import (
+    connect,
+    get_db,
+)
+from pymongo.read_preferences import SecondaryPreferred
+
+logger = logging.getLogger(__name__)
+
+READ_ALIAS = 'onebase-reads'
+AFTER_WRITE_COOKIE = 'onebase_primary'
+
+_secondary = ContextVar('onebase_read_secondary', default=False)
+
+
+def reads(queryset):
+    """ `queryset`, on the read connection if the current request is routed.
+
+    Only pass querysets whose results are displayed, never ones whose
+    results are saved again.
+    """
+    if not _secondary.get():
+        return queryset
+    collection = get_db(READ_ALIAS)[queryset._collection_obj.name]
+    return queryset._clone_into(
+        queryset.__class__(queryset._document, collection))
+
+
+def read_collection(document):
+    """ The pymongo collection of `document` to read from. """
+    if not _secondary.get():
+        return document._get_collection()
+    return get_db(READ_ALIAS)[document._get_collection_name()]
+
+
+@contextmanager
+def read_from_secondaries():
+    """ Route the `reads` made inside the block to the read connection.
+    """
+    token = _secondary.set(True)
+    try:
+        yield
+    finally:
+        _secondary.reset(token)
+
+
+class ReadRouter(object):
+    """ Route the reads of selected GET endpoints to secondaries.
+
+    :param endpoints: Endpoint names (`blueprint.view`) to route.
+
+    :param after_write: Seconds a client stays on the primary after a
+        write.
+
+    """
+
+    def __init__(self, endpoints, after_write=10):
+        self.endpoints = set(endpoints)
+        self.after_write = after_write
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+
+    def routed(self):
+        """ True if the current request may read from secondaries. """
+        return (request.method in ('GET', 'HEAD')
+                and request.endpoint in self.endpoints
+                and AFTER_WRITE_COOKIE not in request.cookies)
+
+    def before_request(self):
+        if self.routed():
+            g.read_route = _secondary.set(True)
+
+    def after_request(self, response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            response.set_cookie(AFTER_WRITE_COOKIE, '1',
+                                max_age=self.after_write, httponly=True)
+        return response
+
+    def teardown_request(self, exception):
+        token = g.pop('read_route', None)
+        if token is not None:
+            _secondary.reset(token)
+
+
+def configure_read_routing(app, db, endpoints, host=None, max_staleness=90,
+                           after_write=10):
+    """ Open the read connection and start routing `endpoints` to it. """
+    options = {}
+    if host:
+        options['host'] = host
+    connect(db, alias=READ_ALIAS,
+            read_preference=SecondaryPreferred(max_staleness=max_staleness),
+            **options)
+    router = ReadRouter(endpoints, after_write=after_write)
+    router.init_app(app)
+    logger.info('Routing reads of {} to secondaries'.format(
+        ', '.join(sorted(endpoints))))
+    return router
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Full-text search over nodes.
+
+Every node gets one `SearchEntry` holding its path, title, description and
+key names, covered by a single weighted text index, so a search is one
+indexed query no matter how deep the path tree is. Entries are written when
+a node is created, and refreshed when a node or path document is edited
+(as reported by the invalidation change stream); `flask search-index`
+rebuilds them all.
+"""
+
+import logging
+
+from datetime import datetime
+
+from mongoengine import (
+    Document,
+    DateTimeField,
+    ListField,
+    ObjectIdField,
+    StringField,
+)
+
+from pymongo.errors import OperationFailure
+
+from onebase_api.models.main import (
+    Path,
+)
+from onebase_web.invalidation import (
+    bus,
+    written,
+)
+from onebase_web.routing import read_collection
+
+logger = logging.getLogger(__name__)
+
+
+class SearchEntry(Document):
+    """ The searchable text of one node. """
+
+    node = ObjectIdField(primary_key=True)
+    path = StringField()
+    # The path with its separators replaced by spaces, so every part of it
+    # is a search term.
+    path_terms = StringField()
+    title = StringField()
+    description = StringField()
+    keys = ListField(StringField())
+    modified = DateTimeField()
+
+    meta = {
+        'collection': 'onebase_web_search',
+        'indexes': [{
+            'fields': ['$title', '$path_terms', '$keys', '$description'],
+            'default_language': 'none',
+            'weights': {'title': 10, 'path_terms': 5, 'keys': 3,
+                        'description': 1},
+        }],
+    }
+
+
+_index_ready = False
+
+
+def _ensure_index():
+    """ Create the text index before the first search; `read_collection`
+    bypasses the model, so it isn't created on first use. """
+    global _index_ready
+    if not _index_ready:
+        SearchEntry.ensure_indexes()
+        _index_ready = True
+
+
+def index_node(node, path, keys=None):
+    """ Create or refresh `node`'s search entry.
+
+    :param path: The node's path string.
+
+    :param keys: The node's keys, if already loaded.
+
+    """
+    if keys is None:
+        keys = node.get_keys()
+    SearchEntry(node=node.id,
+                path=path,
+                path_terms=' '.join(p for p in path.split('/') if p),
+                title=node.title or '',
+                description=node.description or '',
+                keys=[k.name for k in keys],
+                modified=datetime.utcnow()).save()
+
+
+def reindex_node(node_id):
+    """ Refresh the search entry of the node `node_id`, or drop it if the
+    node is no longer reachable by a path. """
+    if node_id is None:
+        # Everything may have changed; that is for `flask search-index`.
+        return
+    path = Path.objects(node=node_id).first()
+    if path is None or path.node is None:
+        SearchEntry.objects(node=node_id).delete()
+        return
+    index_node(path.node, path.string2)
+
+
+def reindex_path(path_id):
+    """ Refresh the search entry of the node at the path `path_id`. """
+    if path_id is None:
+        return
+    path = Path.objects(id=path_id).first()
+    if path is not None and path.node is not None:
+        index_node(path.node, path.string2)
+
+
+bus.subscribe(written('node'), reindex_node)
+bus.subscribe(written('path'), reindex_path)
+
+
+def reindex_all():
+    """ Rebuild the search entry of every node reachable by a path.
+
+    :return: Number of nodes indexed.
+    """
+    n = 0
+    for path in Path.objects(node__ne=None):
+        index_node(path.node, path.string2)
+        n += 1
+    return n
+
+
+def search(query, offset=0, count=20):
+    """ Find nodes matching `query`, best match first.
+
+    :return: `(total, entries)`, where each entry has a `score`.
+    """
+    spec = {'$text': {'$search': query}}
+    try:
+        _ensure_index()
+        collection = read_collection(SearchEntry)
+        total = collection.count_documents(spec)
+        cursor = collection.find(
+            spec, {'score': {'$meta': 'textScore'}}).sort(
+                [('score', {'$meta': 'textScore'})]).skip(offset).limit(count)
+        entries = []
+        for doc in cursor:
+            entry = SearchEntry._from_son(doc)
+            entry.score = doc['score']
+            entries.append(entry)
+    except OperationFailure:
+        logger.exception('Search for {!r} failed'.format(query))
+        return (0, [])
+    return (total, entries)
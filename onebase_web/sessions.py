@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from datetime import (
+    datetime,
+    timedelta,
+)
+
+from flask.sessions import (
+    SessionInterface,
+    SessionMixin,
+)
+from werkzeug.datastructures import CallbackDict
+
+logger = logging.getLogger(__name__)
+
+SESSION_MEMORY = 'memory'
+SESSION_SQLITE = 'sqlite'
+
+
+def _new_sid():
+    """ Generate a new, unguessable session id. """
+    return secrets.token_urlsafe(32)
+
+
+def _user_id_of(data, key='user', user_id_field='id'):
+    """ Pull the user id out of the session data (if any). """
+    user = data.get(key) or {}
+    user_id = user.get(user_id_field)
+    return None if user_id is None else str(user_id)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """ Session whose data lives on the server; the cookie only holds `sid`.
+    """
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """ Issue a new session id (e.g. on login to prevent fixation). """
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = _new_sid()
+        self.modified = True
+
+
+class SessionStore(object):
+    """ Base class for server-side session backends. """
+
+    def load(self, sid):
+        """ Load the session data for `sid`.
+
+        :return: dict of session data, or None if missing or expired.
+        """
+        raise NotImplementedError()
+
+    def save(self, sid, data, ttl):
+        """ Store `data` under `sid` for `ttl` seconds. """
+        raise NotImplementedError()
+
+    def delete(self, sid):
+        """ Remove a single session. """
+        raise NotImplementedError()
+
+    def revoke_user(self, user_id):
+        """ Remove every session belonging to `user_id`.
+
+        :return: Number of sessions removed.
+        """
+        raise NotImplementedError()
+
+    def purge(self):
+        """ Remove all expired sessions. """
+        raise NotImplementedError()
+
+
+class MemorySessionStore(SessionStore):
+    """ In-process session store. Only suitable for a single worker. """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            (expires, user_id, data) = entry
+            if expires < time.time():
+                del self._sessions[sid]
+                return None
+            return dict(data)
+
+    def save(self, sid, data, ttl):
+        entry = (time.time() + ttl, _user_id_of(data), dict(data))
+        with self._lock:
+            self._sessions[sid] = entry
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def revoke_user(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            sids = [sid for (sid, (_, uid, _)) in self._sessions.items()
+                    if uid == user_id]
+            for sid in sids:
+                del self._sessions[sid]
+        return len(sids)
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for (sid, (expires, _, _)) in
+                       self._sessions.items() if expires < now]
+            for sid in expired:
+                del self._sessions[sid]
+
+
+class SqliteSessionStore(SessionStore):
+    """ Session store shared by all workers on the host.
+
+    Backed by a local SQLite database in WAL mode so several processes can
+    read and write concurrently. Expired rows are ignored on read and
+    purged every `purge_every` writes.
+    """
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                         "sid TEXT PRIMARY KEY, "
+                         "user_id TEXT, "
+                         "expires REAL NOT NULL, "
+                         "data TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_user_id "
+                         "ON sessions (user_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires "
+                         "ON sessions (expires)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def load(self, sid):
+        row = self._connection().execute(
+            "SELECT data FROM sessions WHERE sid = ? AND expires >= ?",
+            (sid, time.time())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save(self, sid, data, ttl):
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO sessions "
+                         "(sid, user_id, expires, data) VALUES (?, ?, ?, ?)",
+                         (sid, _user_id_of(data), time.time() + ttl,
+                          json.dumps(data)))
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self.purge()
+
+    def delete(self, sid):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid, ))
+
+    def revoke_user(self, user_id):
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute("DELETE FROM sessions WHERE user_id = ?",
+                                  (str(user_id), ))
+        return cursor.rowcount
+
+    def purge(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE expires < ?",
+                         (time.time(), ))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """ Flask session interface that keeps only a session id in the cookie.
+    """
+
+    session_class = ServerSideSession
+
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+
+    def _cookie_name(self, app):
+        return app.config['SESSION_COOKIE_NAME']
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self._cookie_name(app))
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                return self.session_class(data, sid=sid)
+        return self.session_class(sid=_new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self._cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=secure, samesite=samesite,
+                                       httponly=httponly)
+            return
+        if not session.modified:
+            return
+        self.store.save(session.sid, dict(session), self.ttl)
+        response.set_cookie(name, session.sid,
+                            expires=datetime.utcnow() + timedelta(
+                                seconds=self.ttl),
+                            httponly=httponly,
+                            secure=secure,
+                            samesite=samesite,
+                            domain=domain,
+                            path=path)
+
+
+def make_session_interface(backend, ttl, path=None):
+    """ Build the session interface for the configured backend.
+
+    :param backend: One of `SESSION_MEMORY` or `SESSION_SQLITE`.
+
+    :param ttl: Session lifetime in seconds.
+
+    :param path: Database path for the `SESSION_SQLITE` backend.
+
+    """
+    if backend == SESSION_MEMORY:
+        store = MemorySessionStore()
+    elif backend == SESSION_SQLITE:
+        store = SqliteSessionStore(path)
+    else:
+        raise ValueError('Unknown session backend `{}`'.format(backend))
+    logger.debug('Using {} session store'.format(backend))
+    return ServerSideSessionInterface(store, ttl)
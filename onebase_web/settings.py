@@ -34,5 +34,189 @@ TEMPLATES_DIR = os.path.join(HERE, 'templates')
 # IMPORTANT: ONLY USE THIS SETTING FOR DEVELOPMENT!!
 # Nod your head if you understand.
 ONEBASE_PERSIST_USER = None
+
+# Startup checks
+# When the app is imported it makes sure an administrator exists (asking for
+# its password on the terminal) and that the credential indexes exist. Set
+# `ONEBASE_STARTUP_CHECKS=0` to skip both, e.g. for unit tests, or where a
+# deployment step takes care of them (`flask indexes`).
+ONEBASE_STARTUP_CHECKS = os.environ.get(
+    'ONEBASE_STARTUP_CHECKS', '1') not in ('', '0')
 if common_settings.ONEBASE_MODE == common_settings.ONEBASE_DEV:
     ONEBASE_PERSIST_USER = os.environ.get('ONEBASE_PERSIST_USER', None)
+
+# Server-side sessions
+# Only a random session id is sent in the cookie; the session data itself is
+# kept on the server. `memory` keeps sessions in the worker process (fine for
+# the development server), `sqlite` keeps them in a local database shared by
+# every worker on the host.
+ONEBASE_SESSION_BACKEND = os.environ.get('ONEBASE_SESSION_BACKEND', 'memory')
+ONEBASE_SESSION_PATH = os.environ.get(
+    'ONEBASE_SESSION_PATH', os.path.join(HOME, '.onebase', 'sessions.db'))
+ONEBASE_SESSION_TTL = int(os.environ.get('ONEBASE_SESSION_TTL', 60*60*24*7))
+
+# Password hashing & login throttling
+# Hashes run on a small pool; requests beyond `ONEBASE_HASH_PENDING` are
+# refused instead of queued. Login attempts are limited per client IP, and
+# failed attempts per account (email, from any address), with token buckets
+# (rate in attempts/second, burst in attempts).
+ONEBASE_HASH_WORKERS = int(os.environ.get('ONEBASE_HASH_WORKERS', 2))
+ONEBASE_HASH_PENDING = int(os.environ.get('ONEBASE_HASH_PENDING', 16))
+ONEBASE_LOGIN_IP_RATE = float(os.environ.get('ONEBASE_LOGIN_IP_RATE', 1))
+ONEBASE_LOGIN_IP_BURST = int(os.environ.get('ONEBASE_LOGIN_IP_BURST', 20))
+ONEBASE_LOGIN_EMAIL_RATE = float(
+    os.environ.get('ONEBASE_LOGIN_EMAIL_RATE', 1/60))
+ONEBASE_LOGIN_EMAIL_BURST = int(
+    os.environ.get('ONEBASE_LOGIN_EMAIL_BURST', 5))
+
+# JSON API
+# Header carrying the API key, how long (in seconds) a key -> user lookup
+# is cached, and the most rows one search request may ask for.
+ONEBASE_API_KEY_HEADER = os.environ.get('ONEBASE_API_KEY_HEADER',
+                                        'X-Api-Key')
+ONEBASE_API_KEY_TTL = int(os.environ.get('ONEBASE_API_KEY_TTL', 60))
+ONEBASE_API_MAX_COUNT = int(os.environ.get('ONEBASE_API_MAX_COUNT', 1000))
+
+# Concurrent I/O
+# Size of the thread pool used to overlap independent database calls within a
+# request (see `onebase_web.concurrency.gather`).
+ONEBASE_IO_WORKERS = int(os.environ.get('ONEBASE_IO_WORKERS', 16))
+
+# Slot representations
+# Distinct (type, value) pairs on a page are rendered concurrently by
+# `ONEBASE_REPR_WORKERS` threads, waited on for at most `ONEBASE_REPR_TIMEOUT`
+# seconds and cached for `ONEBASE_REPR_TTL` seconds.
+ONEBASE_REPR_WORKERS = int(os.environ.get('ONEBASE_REPR_WORKERS', 8))
+ONEBASE_REPR_TIMEOUT = float(os.environ.get('ONEBASE_REPR_TIMEOUT', 2))
+ONEBASE_REPR_TTL = int(os.environ.get('ONEBASE_REPR_TTL', 300))
+
+# Background jobs
+# Deletes of more than `ONEBASE_JOB_INLINE_ROWS` rows are run as background
+# jobs, `ONEBASE_JOB_BATCH_SIZE` rows at a time with a pause of
+# `ONEBASE_JOB_PAUSE` seconds between batches. A job whose worker hasn't
+# reported progress for `ONEBASE_JOB_LEASE` seconds is resumed elsewhere.
+ONEBASE_JOB_WORKERS = int(os.environ.get('ONEBASE_JOB_WORKERS', 1))
+ONEBASE_JOB_INLINE_ROWS = int(os.environ.get('ONEBASE_JOB_INLINE_ROWS', 100))
+ONEBASE_JOB_BATCH_SIZE = int(os.environ.get('ONEBASE_JOB_BATCH_SIZE', 500))
+ONEBASE_JOB_PAUSE = float(os.environ.get('ONEBASE_JOB_PAUSE', 0.1))
+ONEBASE_JOB_LEASE = int(os.environ.get('ONEBASE_JOB_LEASE', 60))
+
+# History
+# `buffered` queues history Actions and writes them in batches of
+# `ONEBASE_HISTORY_SIZE`, at least every `ONEBASE_HISTORY_INTERVAL` seconds
+# (and at the end of each request if `ONEBASE_HISTORY_FLUSH_ON_REQUEST` is
+# set). `sync` writes each Action as it is saved. While Mongo is failing, at
+# most `ONEBASE_HISTORY_MAX_PENDING` actions stay queued and each is retried
+# `ONEBASE_HISTORY_MAX_RETRIES` times before it is dropped and logged.
+ONEBASE_HISTORY_MODE = os.environ.get('ONEBASE_HISTORY_MODE', 'sync')
+ONEBASE_HISTORY_SIZE = int(os.environ.get('ONEBASE_HISTORY_SIZE', 500))
+ONEBASE_HISTORY_INTERVAL = float(
+    os.environ.get('ONEBASE_HISTORY_INTERVAL', 1))
+ONEBASE_HISTORY_MAX_PENDING = int(
+    os.environ.get('ONEBASE_HISTORY_MAX_PENDING', 100000))
+ONEBASE_HISTORY_MAX_RETRIES = int(
+    os.environ.get('ONEBASE_HISTORY_MAX_RETRIES', 10))
+ONEBASE_HISTORY_FLUSH_ON_REQUEST = os.environ.get(
+    'ONEBASE_HISTORY_FLUSH_ON_REQUEST', '') not in ('', '0')
+
+# Fragments
+# How long browsers and proxies may cache lazily loaded page fragments (such
+# as child path lists), in seconds.
+ONEBASE_FRAGMENT_MAX_AGE = int(os.environ.get('ONEBASE_FRAGMENT_MAX_AGE', 60))
+
+# Compression & static assets
+# Responses of at least `ONEBASE_COMPRESS_MIN_SIZE` bytes are compressed
+# (brotli when installed, otherwise gzip). Assets in `ONEBASE_STATIC_DIR` are
+# served fingerprinted from /assets, or from `ONEBASE_ASSET_URL` if the
+# output of `flask assets` is hosted elsewhere.
+ONEBASE_COMPRESS_MIN_SIZE = int(
+    os.environ.get('ONEBASE_COMPRESS_MIN_SIZE', 1024))
+ONEBASE_STATIC_DIR = os.environ.get('ONEBASE_STATIC_DIR',
+                                    os.path.join(HERE, 'static'))
+ONEBASE_ASSET_URL = os.environ.get('ONEBASE_ASSET_URL', None)
+
+# Profiling
+# Profiles of requests triggered with a profile token are written to
+# `ONEBASE_PROFILE_DIR`, keeping the newest `ONEBASE_PROFILE_KEEP`. Tokens are
+# valid for `ONEBASE_PROFILE_TOKEN_AGE` seconds.
+ONEBASE_PROFILE_DIR = os.environ.get(
+    'ONEBASE_PROFILE_DIR', os.path.join(HOME, '.onebase', 'profiles'))
+ONEBASE_PROFILE_KEEP = int(os.environ.get('ONEBASE_PROFILE_KEEP', 50))
+ONEBASE_PROFILE_TOKEN_AGE = int(
+    os.environ.get('ONEBASE_PROFILE_TOKEN_AGE', 60*60))
+
+# Prefetching
+# With `ONEBASE_PREFETCH` set, the page after the one being viewed is selected
+# in the background by at most `ONEBASE_PREFETCH_WORKERS` threads and kept for
+# `ONEBASE_PREFETCH_TTL` seconds. Nothing is prefetched while the 1-minute
+# load average per CPU is above `ONEBASE_PREFETCH_MAX_LOAD`.
+ONEBASE_PREFETCH = os.environ.get('ONEBASE_PREFETCH', '') not in ('', '0')
+ONEBASE_PREFETCH_WORKERS = int(os.environ.get('ONEBASE_PREFETCH_WORKERS', 2))
+ONEBASE_PREFETCH_TTL = int(os.environ.get('ONEBASE_PREFETCH_TTL', 30))
+ONEBASE_PREFETCH_MAX_LOAD = float(
+    os.environ.get('ONEBASE_PREFETCH_MAX_LOAD', 0.75))
+
+# Cache invalidation
+# How workers learn about each other's writes: `changestream` (needs a replica
+# set), `poll` (every `ONEBASE_INVALIDATION_INTERVAL` seconds), `auto` (change
+# streams when available, polling otherwise) or `local` (single process).
+ONEBASE_INVALIDATION_MODE = os.environ.get('ONEBASE_INVALIDATION_MODE', 'auto')
+ONEBASE_INVALIDATION_INTERVAL = float(
+    os.environ.get('ONEBASE_INVALIDATION_INTERVAL', 1))
+
+# Snapshots
+# Columnar snapshots of read-heavy nodes (see `flask snapshot`) are kept in
+# `ONEBASE_SNAPSHOT_DIR`, which should be local to the host. A snapshot found
+# current is trusted until its node is invalidated, and for at most
+# `ONEBASE_SNAPSHOT_VERIFY` seconds.
+ONEBASE_SNAPSHOT_DIR = os.environ.get(
+    'ONEBASE_SNAPSHOT_DIR', os.path.join(HOME, '.onebase', 'snapshots'))
+ONEBASE_SNAPSHOT_VERIFY = int(os.environ.get('ONEBASE_SNAPSHOT_VERIFY', 30))
+
+# Read routing
+# With `ONEBASE_READ_ROUTING` set, GET requests to `ONEBASE_READ_ENDPOINTS`
+# run their display queries (see `routing.reads`) on secondaries (of
+# `ONEBASE_READ_HOST`, by default the same deployment) that lag the primary
+# by at most `ONEBASE_READ_MAX_STALENESS` seconds (90 or more). Clients
+# stay on the primary for `ONEBASE_READ_AFTER_WRITE` seconds after a write.
+# Unfiltered node pages are selected by onebase_api (`Node.do_select`),
+# which always reads from the primary; only their row counts are routed.
+ONEBASE_READ_ROUTING = os.environ.get('ONEBASE_READ_ROUTING', '') not in (
+    '', '0')
+ONEBASE_READ_ENDPOINTS = [e for e in os.environ.get(
+    'ONEBASE_READ_ENDPOINTS',
+    'node.view_node,node.browse_nodes,node.child_paths,'
+    'type.list_types,type.show_type,search.search_nodes').split(',') if e]
+ONEBASE_READ_HOST = os.environ.get('ONEBASE_READ_HOST', None)
+ONEBASE_READ_MAX_STALENESS = int(
+    os.environ.get('ONEBASE_READ_MAX_STALENESS', 90))
+ONEBASE_READ_AFTER_WRITE = int(os.environ.get('ONEBASE_READ_AFTER_WRITE', 10))
+
+# Write admission control
+# Each write endpoint runs at most `ONEBASE_WRITE_CONCURRENCY` requests at
+# once per worker (`ONEBASE_CREATE_CONCURRENCY` for node creation), and each
+# user may start `ONEBASE_WRITE_RATE` per second with bursts of
+# `ONEBASE_WRITE_BURST`. Counters (and cache statistics) are served at
+# /metrics to the addresses in `ONEBASE_METRICS_ALLOW`.
+ONEBASE_WRITE_CONCURRENCY = int(
+    os.environ.get('ONEBASE_WRITE_CONCURRENCY', 4))
+ONEBASE_CREATE_CONCURRENCY = int(
+    os.environ.get('ONEBASE_CREATE_CONCURRENCY', 2))
+ONEBASE_WRITE_RATE = float(os.environ.get('ONEBASE_WRITE_RATE', 5))
+ONEBASE_WRITE_BURST = int(os.environ.get('ONEBASE_WRITE_BURST', 20))
+ONEBASE_METRICS_ALLOW = os.environ.get(
+    'ONEBASE_METRICS_ALLOW', '127.0.0.1,::1').split(',')
+
+# Caches
+# Backend of the web layer's caches: `process` (per worker), `shared` (a
+# memory-mapped table in `ONEBASE_CACHE_DIR` shared by the workers of a host;
+# entries larger than `ONEBASE_CACHE_SLOT_SIZE` bytes are not cached) or
+# `memcached` (the server at `ONEBASE_CACHE_URL`, needs pymemcache).
+ONEBASE_CACHE_BACKEND = os.environ.get('ONEBASE_CACHE_BACKEND', 'process')
+ONEBASE_CACHE_DIR = os.environ.get('ONEBASE_CACHE_DIR', '/dev/shm')
+ONEBASE_CACHE_SLOT_SIZE = int(os.environ.get('ONEBASE_CACHE_SLOT_SIZE', 4096))
+ONEBASE_CACHE_URL = os.environ.get('ONEBASE_CACHE_URL', '127.0.0.1:11211')
+# Lifetime in seconds of cached users, types and paths. They are also dropped
+# when they change, so this only bounds how long a missed invalidation lasts.
+ONEBASE_DOCUMENT_CACHE_TTL = int(
+    os.environ.get('ONEBASE_DOCUMENT_CACHE_TTL', 60))
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Memory-mapped columnar snapshots of read-heavy nodes.
+
+`flask snapshot PATH` materializes a node into `<node id>.snap` in the
+snapshot directory, and from then on `view_node` pages through the mapped
+file instead of querying slots. Each snapshot records the node's version
+(the modification time of its statistics, which every write updates) and
+its keys; when either no longer matches, the page is served from Mongo and
+the snapshot is rebuilt in the background.
+
+A snapshot is checked against Mongo once, then trusted until the node is
+invalidated (see `invalidation`) or `ONEBASE_SNAPSHOT_VERIFY` seconds have
+passed, so serving a page from a current snapshot queries no slots, keys or
+statistics.
+
+File layout (all integers little-endian, sections 8-byte aligned)::
+
+    b'OBSNAP1\\n' | uint32 header length | JSON header | sections
+
+The header holds the version, the key ids (in `node.get_keys()` order),
+the row count and, per section, its offset. There is one int64 section
+with the row numbers and, per key, a uint8 null mask plus either an int64
+or float64 array, or uint64 offsets (rows + 1) into a UTF-8 string heap.
+Snapshots are written in batches through temporary section files, so
+building one never holds the whole node in memory.
+"""
+
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from onebase_api.models.main import (
+    Slot,
+)
+from onebase_web.invalidation import bus
+from onebase_web.stats import get_stats
+from onebase_web import settings as web_settings
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'OBSNAP1\n'
+# Rebuild locks older than this are assumed to belong to a dead process.
+LOCK_TIMEOUT = 60*60
+
+INT = 'int'
+FLOAT = 'float'
+STR = 'str'
+
+_INT_TYPES = {'int', 'long'}
+_FLOAT_TYPES = {'int', 'long', 'double'}
+
+
+def node_version(stats):
+    """ Version string of a node, from its `NodeStats`. """
+    modified = stats.modified.isoformat() if stats.modified else ''
+    return '{}/{}'.format(modified, stats.row_count)
+
+
+def _kinds(key_ids):
+    """ Column kind of each key, from the BSON types of its values. """
+    types = {k: set() for k in key_ids}
+    for doc in Slot._get_collection().aggregate([
+            {'$match': {'key': {'$in': key_ids}, 'value': {'$ne': None}}},
+            {'$group': {'_id': '$key',
+                        'types': {'$addToSet': {'$type': '$value'}}}},
+    ], allowDiskUse=True):
+        types[doc['_id']] = set(doc['types'])
+    kinds = []
+    for k in key_ids:
+        if types[k] and types[k] <= _INT_TYPES:
+            kinds.append(INT)
+        elif types[k] and types[k] <= _FLOAT_TYPES:
+            kinds.append(FLOAT)
+        else:
+            kinds.append(STR)
+    return kinds
+
+
+class _Section(object):
+    """ A section being written: an in-memory buffer spilled to a
+    temporary file. """
+
+    def __init__(self, name, directory, buffer):
+        self.name = name
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.buffer = buffer
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            del self.buffer[:]
+
+    @property
+    def size(self):
+        return self.file.tell()
+
+
+class _Column(object):
+    """ Sections of one key's column. """
+
+    def __init__(self, i, kind, directory):
+        self.kind = kind
+        self.nulls = _Section('{}.nulls'.format(i), directory, bytearray())
+        self.sections = [self.nulls]
+        if kind == STR:
+            self.offsets = _Section('{}.offsets'.format(i), directory,
+                                    array('Q', [0]))
+            self.heap = _Section('{}.heap'.format(i), directory,
+                                 bytearray())
+            self.heap_size = 0
+            self.sections += [self.offsets, self.heap]
+        else:
+            self.data = _Section('{}.data'.format(i), directory,
+                                 array('q' if kind == INT else 'd'))
+            self.sections.append(self.data)
+
+    def append(self, value):
+        if self.kind == STR:
+            if value is not None:
+                encoded = str(value).encode('utf-8')
+                self.heap.buffer += encoded
+                self.heap_size += len(encoded)
+            self.nulls.buffer.append(1 if value is None else 0)
+            self.offsets.buffer.append(self.heap_size)
+            return
+        try:
+            number = (int if self.kind == INT else float)(value)
+        except (TypeError, ValueError):
+            # Missing, or written with another type while building; the
+            # snapshot's version will be stale anyway.
+            (value, number) = (None, 0)
+        self.nulls.buffer.append(1 if value is None else 0)
+        self.data.buffer.append(number)
+
+
+def build_snapshot(node, path, keys=None, batch_size=10000):
+    """ Write a snapshot of `node` to `path`.
+
+    :return: Number of rows written.
+    """
+    stats = get_stats(node)
+    version = node_version(stats)
+    if keys is None:
+        keys = node.get_keys()
+    key_ids = [k.id for k in keys]
+    col_of = {k: i for (i, k) in enumerate(key_ids)}
+    directory = os.path.dirname(path) or '.'
+    kinds = _kinds(key_ids)
+    rows = _Section('rows', directory, array('q'))
+    columns = [_Column(i, kind, directory) for (i, kind) in enumerate(kinds)]
+    sections = [rows] + [s for c in columns for s in c.sections]
+    n = 0
+
+    def emit(row, cells):
+        rows.buffer.append(row)
+        for (column, value) in zip(columns, cells):
+            column.append(value)
+        if n % batch_size == 0:
+            for section in sections:
+                section.flush()
+
+    cursor = Slot._get_collection().find(
+        {'key': {'$in': key_ids}}, {'key': 1, 'row': 1, 'value': 1},
+        batch_size=batch_size, allow_disk_use=True).sort('row', 1)
+    (row, cells) = (None, None)
+    for doc in cursor:
+        if doc['row'] != row:
+            if row is not None:
+                n += 1
+                emit(row, cells)
+            (row, cells) = (doc['row'], [None] * len(key_ids))
+        cells[col_of[doc['key']]] = doc['value']
+    if row is not None:
+        n += 1
+        emit(row, cells)
+    for section in sections:
+        section.flush()
+
+    layout = {}
+    position = 0
+    for section in sections:
+        layout[section.name] = [position, section.size]
+        position += section.size + (-section.size % 8)
+    header = json.dumps({
+        'version': version,
+        'keys': [str(k) for k in key_ids],
+        'kinds': kinds,
+        'rows': n,
+        'sections': layout,
+    }).encode('utf-8')
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack('<I', len(header)))
+        fh.write(header)
+        _align(fh)
+        for section in sections:
+            section.file.seek(0)
+            shutil.copyfileobj(section.file, fh)
+            section.file.close()
+            _align(fh)
+    os.replace(tmp, path)
+    logger.info('Snapshot of node {}: {} rows, {} keys'.format(
+        node.id, n, len(key_ids)))
+    return n
+
+
+def _align(fh):
+    pad = -fh.tell() % 8
+    if pad:
+        fh.write(b'\0' * pad)
+
+
+class Snapshot(object):
+    """ A mapped snapshot file. Slices of it are read straight from the
+    page cache; nothing is loaded up front except the header. """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, 'rb') as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError('{} is not a snapshot'.format(path))
+        (size, ) = struct.unpack_from('<I', self._map, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(bytes(view[start:start+size]).decode('utf-8'))
+        base = start + size + (-(start + size) % 8)
+        self.version = header['version']
+        self.keys = header['keys']
+        self.kinds = header['kinds']
+        self.rows = header['rows']
+        self._sections = {name: view[base+offset:base+offset+length]
+                          for (name, (offset, length))
+                          in header['sections'].items()}
+        self._row_numbers = self._sections['rows'].cast('q')
+
+    def __len__(self):
+        return self.rows
+
+    def is_current(self, version, keys):
+        return (self.version == version
+                and self.keys == [str(k.id) for k in keys])
+
+    def column(self, col, start, stop):
+        """ Values of column `col` for rows `start` to `stop` (positions,
+        not row numbers); None for missing cells. """
+        nulls = self._sections['{}.nulls'.format(col)][start:stop]
+        kind = self.kinds[col]
+        if kind in (INT, FLOAT):
+            data = self._sections['{}.data'.format(col)].cast(
+                'q' if kind == INT else 'd')[start:stop]
+            return [None if null else v for (null, v) in zip(nulls, data)]
+        offsets = self._sections['{}.offsets'.format(col)].cast('Q')
+        heap = self._sections['{}.heap'.format(col)]
+        values = []
+        for (i, null) in enumerate(nulls):
+            if null:
+                values.append(None)
+                continue
+            (a, b) = (offsets[start+i], offsets[start+i+1])
+            values.append(str(heap[a:b], 'utf-8'))
+        return values
+
+    def select(self, offset, count):
+        """ Rows `offset` to `offset+count` as plain values:
+        `{row: [value per key]}`, None for missing cells. """
+        stop = min(offset + count, self.rows)
+        if offset >= stop:
+            return {}
+        numbers = self._row_numbers[offset:stop].tolist()
+        columns = [self.column(col, offset, stop)
+                   for col in range(len(self.keys))]
+        return {row: [column[i] for column in columns]
+                for (i, row) in enumerate(numbers)}
+
+    def close(self):
+        for section in self._sections.values():
+            section.release()
+        self._row_numbers.release()
+        self._map.close()
+
+
+class SnapshotStore(object):
+    """ The snapshots in `directory`, opened on first use and rebuilt in
+    the background when stale.
+
+    A node is snapshotted only if its file exists, i.e. after it was
+    created with `build` (`flask snapshot PATH`).
+
+    :param verify_every: Seconds a verified snapshot is trusted without
+        checking it against Mongo again, even if no invalidation arrives.
+
+    """
+
+    def __init__(self, directory, verify_every=30):
+        self.directory = directory
+        self.verify_every = verify_every
+        self._open = {}
+        # str(node id) -> (snapshot mtime, verified at, keys)
+        self._verified = {}
+        # Bumped by every invalidation, so a check that raced one isn't
+        # trusted.
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='onebase-snapshot')
+
+    def path(self, node):
+        return os.path.join(self.directory, '{}.snap'.format(node.id))
+
+    def open(self, node):
+        """ The node's snapshot, or None if it has none. """
+        path = self.path(node)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        with self._lock:
+            snapshot = self._open.get(path)
+            if snapshot is None or snapshot.mtime != mtime:
+                try:
+                    snapshot = Snapshot(path)
+                except (OSError, ValueError):
+                    logger.exception('Could not open snapshot {}'.format(path))
+                    return None
+                # The previous mapping may still be in use by a request;
+                # it is released when the last reference goes away.
+                self._open[path] = snapshot
+            return snapshot
+
+    def current(self, node):
+        """ The node's snapshot and keys, if it has a current snapshot.
+
+        Only queries Mongo when the snapshot hasn't been verified since the
+        node last changed; starts a rebuild if it is stale.
+
+        :return: `(snapshot, keys)` or None.
+        """
+        snapshot = self.open(node)
+        if snapshot is None:
+            return None
+        node_id = str(node.id)
+        with self._lock:
+            entry = self._verified.get(node_id)
+            generation = self._generation
+        if (entry is not None and entry[0] == snapshot.mtime
+                and time.monotonic() - entry[1] < self.verify_every):
+            return (snapshot, entry[2])
+        keys = node.get_keys()
+        if not snapshot.is_current(node_version(get_stats(node)), keys):
+            self.refresh(node)
+            return None
+        with self._lock:
+            if self._generation == generation:
+                self._verified[node_id] = (snapshot.mtime, time.monotonic(),
+                                           keys)
+        return (snapshot, keys)
+
+    def changed(self, node_id):
+        """ Stop trusting the snapshot of `node_id` (all if None). """
+        with self._lock:
+            self._generation += 1
+            if node_id is None:
+                self._verified.clear()
+            else:
+                self._verified.pop(str(node_id), None)
+
+    def build(self, node, keys=None):
+        os.makedirs(self.directory, exist_ok=True)
+        return build_snapshot(node, self.path(node), keys)
+
+    def drop(self, node):
+        try:
+            os.remove(self.path(node))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _rebuild(self, node, lock):
+        try:
+            self.build(node)
+        except Exception:
+            logger.exception('Could not rebuild snapshot of {}'.format(
+                node.id))
+        finally:
+            os.remove(lock)
+
+    def refresh(self, node):
+        """ Rebuild the node's snapshot in the background, unless another
+        worker on this host is already doing so. """
+        lock = self.path(node) + '.lock'
+        try:
+            if time.time() - os.stat(lock).st_mtime > LOCK_TIMEOUT:
+                os.remove(lock)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        logger.info('Snapshot of {} is stale; rebuilding'.format(node.id))
+        self._executor.submit(self._rebuild, node, lock)
+        return True
+
+
+snapshot_store = SnapshotStore(
+    web_settings.ONEBASE_SNAPSHOT_DIR,
+    verify_every=web_settings.ONEBASE_SNAPSHOT_VERIFY)
+bus.subscribe('node', snapshot_store.changed)
@@ -0,0 +1,58 @@
+/* Replace every `data-fragment` element with the HTML found at its URL.
+ *
+ * Elements with `data-fragment-when="visible"` (such as "more" links at the
+ * end of a list) are only loaded once scrolled into view, or when clicked
+ * where IntersectionObserver isn't available.
+ */
+(function () {
+    var observer = null;
+    if ('IntersectionObserver' in window) {
+        observer = new IntersectionObserver(function (entries) {
+            entries.forEach(function (entry) {
+                if (entry.isIntersecting) {
+                    observer.unobserve(entry.target);
+                    loadFragment(entry.target);
+                }
+            });
+        }, {rootMargin: '200px'});
+    }
+
+    function loadFragment(el) {
+        var url = el.getAttribute('data-fragment');
+        if (url === null) {
+            return;
+        }
+        el.removeAttribute('data-fragment');
+        fetch(url).then(function (response) {
+            return response.text();
+        }).then(function (html) {
+            el.innerHTML = html;
+            loadFragments(el);
+        });
+    }
+
+    function loadWhenVisible(el) {
+        el.addEventListener('click', function (event) {
+            event.preventDefault();
+            if (observer !== null) {
+                observer.unobserve(el);
+            }
+            loadFragment(el);
+        });
+        if (observer !== null) {
+            observer.observe(el);
+        }
+    }
+
+    function loadFragments(root) {
+        var elements = root.querySelectorAll('[data-fragment]');
+        Array.prototype.forEach.call(elements, function (el) {
+            if (el.getAttribute('data-fragment-when') === 'visible') {
+                loadWhenVisible(el);
+            } else {
+                loadFragment(el);
+            }
+        });
+    }
+    loadFragments(document);
+})();
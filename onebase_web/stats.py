@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Incrementally maintained node statistics.
+
+Counting a node's rows means counting its slots, so instead the insert,
+update and drop paths keep a per-node `NodeStats` document up to date with
+atomic `$inc` updates. `recompute` rebuilds a node's statistics from its
+slots (see the `node-stats` command).
+
+Every update also invalidates the node's cached pages. Updates and drops
+are recorded after the slots are written; an insert is recorded first (to
+reserve its row number), so callers must call `row_inserted` once the new
+row's slots are saved, or a page read in between could be cached stale.
+"""
+
+import logging
+
+from datetime import datetime
+
+from mongoengine import (
+    Document,
+    DictField,
+    DateTimeField,
+    IntField,
+    ObjectIdField,
+)
+from pymongo import ReturnDocument
+
+from onebase_api.models.main import (
+    Node,
+    Slot,
+)
+from onebase_web.invalidation import invalidate
+from onebase_web.routing import read_collection
+
+logger = logging.getLogger(__name__)
+
+
+def is_null(value):
+    return value is None or value == ''
+
+
+class NodeStats(Document):
+    """ Statistics for a single node. """
+
+    node = ObjectIdField(primary_key=True)
+    # Number of live rows.
+    row_count = IntField(default=0)
+    # Next row number to hand out; never decreases so dropped rows aren't
+    # reused.
+    next_row = IntField(default=0)
+    # str(key id) -> number of rows with a non-null value for that key.
+    key_counts = DictField()
+    modified = DateTimeField()
+
+    meta = {'collection': 'onebase_web_node_stats'}
+
+
+def recompute(node):
+    """ Rebuild `node`'s statistics from its slots. """
+    key_ids = [k.id for k in node.get_keys()]
+    slots = Slot._get_collection()
+    match = {'$match': {'key': {'$in': key_ids}}}
+    rows = list(slots.aggregate([
+        match,
+        {'$group': {'_id': '$row'}},
+        {'$group': {'_id': None, 'count': {'$sum': 1},
+                    'last': {'$max': '$_id'}}},
+    ], allowDiskUse=True))
+    counts = slots.aggregate([
+        match,
+        {'$match': {'value': {'$nin': [None, '']}}},
+        {'$group': {'_id': '$key', 'count': {'$sum': 1}}},
+    ], allowDiskUse=True)
+    key_counts = {str(k): 0 for k in key_ids}
+    for c in counts:
+        key_counts[str(c['_id'])] = c['count']
+    (row_count, next_row) = (0, 0)
+    if rows:
+        (row_count, next_row) = (rows[0]['count'], rows[0]['last'] + 1)
+    stats = NodeStats(node=node.id,
+                      row_count=row_count,
+                      next_row=next_row,
+                      key_counts=key_counts,
+                      modified=datetime.utcnow())
+    stats.save()
+    return stats
+
+
+def recompute_all():
+    """ Rebuild the statistics of every node.
+
+    :return: Number of nodes processed.
+    """
+    n = 0
+    for node in Node.objects.all():
+        recompute(node)
+        n += 1
+    return n
+
+
+def get_stats(node):
+    """ Get `node`'s statistics, computing them the first time. """
+    stats = NodeStats.objects(node=node.id).first()
+    if stats is None:
+        logger.info('No statistics for node {}; computing'.format(node.id))
+        stats = recompute(node)
+    return stats
+
+
+def read_stats(node):
+    """ `node`'s statistics for display: read through `read_collection`, so
+    they may lag the primary when the request is routed. Only falls back to
+    `get_stats` (on the primary) if they don't exist yet. """
+    doc = read_collection(NodeStats).find_one({'_id': node.id})
+    if doc is None:
+        return get_stats(node)
+    return NodeStats._from_son(doc)
+
+
+def _update(node, update):
+    invalidate('node', node.id)
+    update.setdefault('$set', {})['modified'] = datetime.utcnow()
+    return NodeStats._get_collection().find_one_and_update(
+        {'_id': node.id}, update, return_document=ReturnDocument.AFTER)
+
+
+def _key_counts_inc(values, sign=1):
+    """ `$inc` clause for the non-null values in `{key_id: value}`. """
+    return {'key_counts.{}'.format(k): sign
+            for (k, v) in values.items() if not is_null(v)}
+
+
+def record_insert(node, values):
+    """ Reserve a row number for a new row.
+
+    :param values: `{key_id: value}` of the row being inserted.
+
+    :return: The row number to insert at.
+    """
+    get_stats(node)
+    inc = {'row_count': 1, 'next_row': 1, }
+    inc.update(_key_counts_inc(values))
+    stats = _update(node, {'$inc': inc})
+    return stats['next_row'] - 1
+
+
+def row_inserted(node):
+    """ Invalidate `node`'s pages again once a row reserved with
+    `record_insert` has been written. """
+    invalidate('node', node.id)
+
+
+def record_update(node, old_values, new_values):
+    """ Account for a row update.
+
+    :param old_values: `{key_id: value}` before the update.
+
+    :param new_values: `{key_id: value}` after the update.
+
+    """
+    record_updates(node, [(old_values, new_values), ])
+
+
+def record_updates(node, changes):
+    """ Account for several row updates with one write.
+
+    :param changes: List of `(old_values, new_values)`, one per row.
+
+    """
+    get_stats(node)
+    inc = {}
+    for (old_values, new_values) in changes:
+        for (k, new) in new_values.items():
+            old = old_values.get(k)
+            field = 'key_counts.{}'.format(k)
+            if is_null(old) and not is_null(new):
+                inc[field] = inc.get(field, 0) + 1
+            elif not is_null(old) and is_null(new):
+                inc[field] = inc.get(field, 0) - 1
+    inc = {k: v for (k, v) in inc.items() if v}
+    _update(node, {'$inc': inc} if inc else {})
+
+
+def record_drop(node, rows):
+    """ Account for dropped rows.
+
+    :param rows: List of `{key_id: value}`, one per dropped row.
+
+    """
+    get_stats(node)
+    inc = {'row_count': -len(rows), }
+    for values in rows:
+        for (k, v) in _key_counts_inc(values, sign=-1).items():
+            inc[k] = inc.get(k, 0) + v
+    _update(node, {'$inc': inc})
@@ -1,29 +1,1858 @@
- #!/usr/bin/env python3
+#!/usr/bin/env python3
 """
-This file is part of << PROJECT NAME >>.
+This file is part of 1Base.
 
-Foobar is free software: you can redistribute it and/or modify
+1Base is free software: you can redistribute it and/or modify
 it under the terms of the GNU General Public License as published by
 the Free Software Foundation, either version 3 of the License, or
 (at your option) any later version.
 
-Foobar is distributed in the hope that it will be useful,
+1Base is distributed in the hope that it will be useful,
 but WITHOUT ANY WARRANTY; without even the implied warranty of
 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.
 
 You should have received a copy of the GNU General Public License
-along with << PROJECT NAME >>.  If not, see <http://www.gnu.org/licenses/>.
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+
+Unit tests of the web layer.
+
+Importing `onebase_web` builds the app; its startup checks (admin account,
+credential indexes) are switched off below, so the only database access is
+through collections the tests replace with mocks.
 """
 
+import argparse
+import gzip
+import io
+import os
+import pstats
+import random
+import shutil
+import smtplib
+import tempfile
+import threading
+import time
 import unittest
 
-class TestSomething(unittest.TestCase):
-    
+from types import SimpleNamespace
+from unittest import mock
+
+from bson import ObjectId
+from flask import (
+    Flask,
+    request,
+)
+from pymongo.errors import (
+    BulkWriteError,
+    DuplicateKeyError,
+)
+from werkzeug.datastructures import MultiDict
+
+# Before anything imports the app.
+os.environ.setdefault('ONEBASE_STARTUP_CHECKS', '0')
+
+from onebase_web import admission
+from onebase_web import app
+from onebase_web import cache as cache_module
+from onebase_web import compression
+from onebase_web import email as onebase_email
+from onebase_web import forms
+from onebase_web import history
+from onebase_web import indexes
+from onebase_web import invalidation
+from onebase_web import prefetch
+from onebase_web import profiling
+from onebase_web import jobs
+from onebase_web import query
+from onebase_web import routing
+from onebase_web import search
+from onebase_web import settings as web_settings
+from onebase_web import snapshots
+from onebase_web import stats
+from onebase_web.cache import (
+    SharedMemoryCache,
+    TTLCache,
+)
+from onebase_web.ratelimit import (
+    RateLimiter,
+    TokenBucket,
+)
+from onebase_web.reprs import ReprEngine
+from onebase_web.sessions import (
+    MemorySessionStore,
+    SqliteSessionStore,
+)
+from onebase_web.views import (
+    api,
+    auth,
+    main,
+)
+from onebase_web.views import jobs as job_views
+from onebase_web.views import node as node_views
+
+try:
+    # Needs the `loadgen` extra (requests).
+    from onebase_web import loadgen
+except ImportError:
+    loadgen = None
+
+
+def _session(user_id):
+    return {'user': {'id': user_id}}
+
+
+class TestMemorySessionStore(unittest.TestCase):
+
     def setUp(self):
         """ Set up the test """
-        pass
-    
+        self.store = self.make_store()
+
+    def make_store(self):
+        return MemorySessionStore()
+
+    def test_save_and_load(self):
+        self.store.save('a', _session('u1'), 60)
+        self.assertEqual(self.store.load('a'), _session('u1'))
+        self.assertIsNone(self.store.load('missing'))
+
+    def test_expired(self):
+        self.store.save('a', _session('u1'), -1)
+        self.assertIsNone(self.store.load('a'))
+
+    def test_delete(self):
+        self.store.save('a', _session('u1'), 60)
+        self.store.delete('a')
+        self.assertIsNone(self.store.load('a'))
+
+    def test_revoke_user(self):
+        self.store.save('a', _session('u1'), 60)
+        self.store.save('b', _session('u1'), 60)
+        self.store.save('c', _session('u2'), 60)
+        self.assertEqual(self.store.revoke_user('u1'), 2)
+        self.assertIsNone(self.store.load('a'))
+        self.assertIsNone(self.store.load('b'))
+        self.assertEqual(self.store.load('c'), _session('u2'))
+
+    def test_purge(self):
+        self.store.save('a', _session('u1'), -1)
+        self.store.save('b', _session('u1'), 60)
+        self.store.purge()
+        self.assertEqual(self.store.revoke_user('u1'), 1)
+
+
+class TestSqliteSessionStore(TestMemorySessionStore):
+
+    def make_store(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        return SqliteSessionStore(os.path.join(self.directory, 's.db'))
+
+    def test_shared_between_stores(self):
+        self.store.save('a', _session('u1'), 60)
+        other = SqliteSessionStore(self.store.path)
+        self.assertEqual(other.load('a'), _session('u1'))
+
+
+class TestClosedAccounts(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        patcher = mock.patch.object(auth.ClosedAccount, 'objects')
+        self.objects = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_active_user_is_not_closed(self):
+        user = mock.Mock(id=ObjectId(), is_active=True)
+        self.assertFalse(auth.is_closed(user))
+        self.objects.assert_not_called()
+
+    def test_unverified_user_is_not_closed(self):
+        self.objects.return_value.first.return_value = None
+        user = mock.Mock(id=ObjectId(), is_active=False)
+        self.assertFalse(auth.is_closed(user))
+
+    def test_deactivated_user_is_closed(self):
+        user = mock.Mock(id=ObjectId(), is_active=False)
+        self.objects.return_value.first.return_value = mock.Mock()
+        self.assertTrue(auth.is_closed(user))
+        self.objects.assert_called_with(pk=user.id)
+        self.assertFalse(auth.login_user(user))
+
+
+class TestEmailQueue(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.queue = onebase_email.EmailQueue({'workers': 1,
+                                               'max_retries': 2,
+                                               'retry_backoff': 1})
+        self.queue.pool = mock.Mock()
+        self.conn = self.queue.pool.acquire.return_value
+
+    def job(self, to):
+        message = {'To': to}
+        return (mock.Mock(return_value=message), (), {}, 0)
+
+    def delayed(self):
+        return sorted((attempt, factory()['To']) for (_, _, (
+            factory, args, kwargs, attempt)) in self.queue._delayed)
+
+    def test_sent_over_one_connection(self):
+        self.queue._send_batch([self.job('a'), self.job('b')])
+        self.assertEqual(self.conn.send_message.call_count, 2)
+        self.queue.pool.release.assert_called_once_with(self.conn)
+        self.assertEqual(self.queue._delayed, [])
+
+    def test_connection_failure_retries_batch(self):
+        self.queue.pool.acquire.side_effect = OSError('refused')
+        self.queue._send_batch([self.job('a'), self.job('b')])
+        self.assertEqual(self.delayed(), [(1, 'a'), (1, 'b')])
+
+    def test_send_failure_retries_rest_on_new_connection(self):
+        self.conn.send_message.side_effect = [None,
+                                              smtplib.SMTPServerDisconnected()]
+        self.queue._send_batch([self.job('a'), self.job('b'),
+                                self.job('c')])
+        self.assertEqual(self.delayed(), [(1, 'b'), (1, 'c')])
+        self.queue.pool.discard.assert_called_once_with(self.conn)
+        self.queue.pool.release.assert_not_called()
+
+    def test_refused_recipient_is_not_retried(self):
+        self.conn.send_message.side_effect = smtplib.SMTPRecipientsRefused(
+            {})
+        self.queue._send_batch([self.job('a')])
+        self.assertEqual(self.queue._delayed, [])
+        self.queue.pool.release.assert_called_once_with(self.conn)
+
+    def test_backoff_doubles_then_gives_up(self):
+        (factory, args, kwargs, attempt) = self.job('a')
+        with mock.patch.object(onebase_email.time, 'time',
+                               return_value=100):
+            self.queue._retry((factory, args, kwargs, 0))
+            self.queue._retry((factory, args, kwargs, 1))
+            self.queue._retry((factory, args, kwargs, 2))
+        self.assertEqual([(due, job[3]) for (due, _, job)
+                          in sorted(self.queue._delayed)],
+                         [(101, 1), (102, 2)])
+
+    def test_due_retries_are_requeued(self):
+        with mock.patch.object(onebase_email.time, 'time',
+                               return_value=100):
+            self.queue._retry(self.job('a'))
+            self.assertAlmostEqual(self.queue._release_due(), 1)
+        self.assertTrue(self.queue._queue.empty())
+        with mock.patch.object(onebase_email.time, 'time',
+                               return_value=101):
+            self.assertIsNone(self.queue._release_due())
+        self.assertEqual(self.queue._queue.get_nowait()[3], 1)
+
+
+class TestSMTPPool(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.pool = onebase_email.SMTPPool({}, size=1)
+        patcher = mock.patch.object(self.pool, '_connect')
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuses_live_connection(self):
+        conn = mock.Mock()
+        conn.noop.return_value = (250, b'OK')
+        self.pool.release(conn)
+        self.assertIs(self.pool.acquire(), conn)
+        self.connect.assert_not_called()
+
+    def test_replaces_dead_connection(self):
+        conn = mock.Mock()
+        conn.noop.side_effect = smtplib.SMTPServerDisconnected()
+        self.pool.release(conn)
+        self.assertIs(self.pool.acquire(), self.connect.return_value)
+        conn.quit.assert_called_once_with()
+
+    def test_full_pool_discards(self):
+        (first, second) = (mock.Mock(), mock.Mock())
+        self.pool.release(first)
+        self.pool.release(second)
+        second.quit.assert_called_once_with()
+        first.quit.assert_not_called()
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=1, capacity=2)
+        now = bucket.updated
+        self.assertEqual(bucket.take(now=now), 0)
+        self.assertEqual(bucket.take(now=now), 0)
+        self.assertAlmostEqual(bucket.take(now=now), 1)
+        self.assertEqual(bucket.take(now=now+1), 0)
+
+    def test_capacity_caps_refill(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        now = bucket.updated + 100
+        self.assertEqual(bucket.take(2, now=now), 0)
+        self.assertGreater(bucket.take(now=now), 0)
+
+    def test_wait_takes_nothing(self):
+        bucket = TokenBucket(rate=1, capacity=1)
+        now = bucket.updated
+        self.assertEqual(bucket.wait(now=now), 0)
+        self.assertEqual(bucket.wait(now=now), 0)
+        bucket.take(now=now)
+        self.assertAlmostEqual(bucket.wait(now=now), 1)
+
+    def test_limiter_keys_are_independent(self):
+        limiter = RateLimiter(rate=0.001, capacity=1)
+        self.assertEqual(limiter.take('a'), 0)
+        self.assertGreater(limiter.take('a'), 0)
+        self.assertEqual(limiter.take('b'), 0)
+        self.assertEqual(limiter.wait('c'), 0)
+
+    def test_limiter_keeps_recent_keys(self):
+        limiter = RateLimiter(rate=0.001, capacity=1, max_keys=2)
+        for key in ('a', 'b', 'c'):
+            limiter.take(key)
+        # `a` was evicted, so it starts with a full bucket again.
+        self.assertEqual(limiter.take('a'), 0)
+        self.assertGreater(limiter.take('c'), 0)
+
+
+class ViewTestCase(unittest.TestCase):
+    """ Base for tests going through the app, without its background
+    threads. """
+
+    def setUp(self):
+        """ Set up the test """
+        patcher = mock.patch.object(main, 'start_background')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+
+    def patch(self, target, name, **kwargs):
+        patcher = mock.patch.object(target, name, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+
+class TestLoginThrottling(ViewTestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        super(TestLoginThrottling, self).setUp()
+        self.patch(auth, 'User')
+        self.hasher = self.patch(auth, 'password_hasher')
+        self.patch(auth, 'login_ip_limiter', new=RateLimiter(100, 100))
+        self.patch(auth, 'login_email_limiter', new=RateLimiter(0.001, 2))
+
+    def log_in(self, email, addr, valid=False):
+        self.hasher.verify.return_value = valid
+        return self.client.post('/login', data={'email': email,
+                                                'password': 'secret'},
+                                environ_base={'REMOTE_ADDR': addr})
+
+    def test_failures_count_per_account_from_any_address(self):
+        self.assertEqual(self.log_in('a@example.com', '10.0.0.1').status_code,
+                         200)
+        self.assertEqual(self.log_in('A@example.com', '10.0.0.2').status_code,
+                         200)
+        response = self.log_in('a@example.com', '10.0.0.3')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        # Nothing was hashed for the refused attempt.
+        self.assertEqual(self.hasher.verify.call_count, 2)
+        self.assertEqual(self.log_in('b@example.com', '10.0.0.3').status_code,
+                         200)
+
+    def test_successes_do_not_count(self):
+        self.patch(auth, 'login_user', return_value=True)
+        for i in range(3):
+            response = self.log_in('a@example.com', '10.0.0.1', valid=True)
+            self.assertEqual(response.status_code, 302)
+
+
+class TestAuthIndexes(unittest.TestCase):
+
+    @mock.patch.object(auth, 'ensure_indexes')
+    def test_failure_is_logged(self, ensure_indexes):
+        ensure_indexes.side_effect = DuplicateKeyError('E11000')
+        with self.assertLogs(auth.logger, 'ERROR'):
+            auth.ensure_auth_indexes()
+
+
+
+def _keys(*names):
+    return [SimpleNamespace(name=n, id=ObjectId(), size=None,
+                            soft_type=SimpleNamespace(id='t'))
+            for n in names]
+
+
+class TestNodeApi(ViewTestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        super(TestNodeApi, self).setUp()
+        self.keys = _keys('name', 'age')
+        self.node = mock.Mock(title='People', description='')
+        self.node.get_keys.return_value = self.keys
+        path = mock.Mock(node=self.node, string2='people')
+        self.patch(api, 'find_path', return_value=path)
+        self.patch(api, 'user_for_api_key', return_value=mock.Mock())
+        self.patch(api, 'get_stats',
+                   return_value=SimpleNamespace(row_count=2))
+
+    def get(self, **args):
+        return self.client.get('/api/v1/node/search',
+                               query_string=dict(path='people', **args),
+                               headers={'X-Api-Key': 'k'})
+
+    def add(self, values):
+        return self.client.post('/api/v1/node/slot/add',
+                                query_string={'path': 'people'},
+                                json=values, headers={'X-Api-Key': 'k'})
+
+    def test_sparse_rows_keep_their_columns(self):
+        self.node.do_select.return_value = {
+            1: {0: SimpleNamespace(value='Jo'),
+                1: SimpleNamespace(value='30')},
+            2: {1: SimpleNamespace(value='40')},
+        }
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['rows'],
+                         [[1, 'Jo', '30'], [2, None, '40']])
+
+    def test_bad_paging_is_a_client_error(self):
+        self.assertEqual(self.get(offset='x').status_code, 400)
+        self.assertEqual(self.get(count='-1').status_code, 400)
+        self.node.do_select.assert_not_called()
+
+    def test_count_is_capped(self):
+        self.node.do_select.return_value = {}
+        response = self.get(count=10**9)
+        self.assertEqual(response.get_json()['count'],
+                         web_settings.ONEBASE_API_MAX_COUNT)
+        self.node.do_select.assert_called_once_with(
+            offset=0, limit=web_settings.ONEBASE_API_MAX_COUNT)
+
+    def test_values_are_saved_as_text(self):
+        Slot = self.patch(api, 'Slot')
+        key_type = self.patch(api, 'key_type')
+        self.patch(api, 'record_insert', return_value=3)
+        self.patch(api, 'row_inserted')
+        response = self.add({'name': 'Jo', 'age': 30})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json(), {'row': 3})
+        saved = sorted((c[1]['key'].name, c[1]['value'])
+                       for c in Slot.call_args_list)
+        self.assertEqual(saved, [('age', '30'), ('name', 'Jo')])
+        key_type.return_value.validate_value.assert_any_call('30', None)
+
+    def test_unknown_keys_are_refused(self):
+        response = self.add({'height': 2})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('height', response.get_json()['message'])
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = TTLCache()
+        cache.set('a', [1])
+        self.assertEqual(cache.get('a'), [1])
+        self.assertEqual(cache.get('b', 'default'), 'default')
+        self.assertEqual(cache.stats.hits, 1)
+        self.assertEqual(cache.stats.misses, 1)
+
+    def test_expiry(self):
+        cache = TTLCache()
+        cache.set('a', 1, ttl=-1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats.evictions, 1)
+
+    def test_delete_and_clear(self):
+        cache = TTLCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+        self.assertIsNone(cache.get('b'))
+
+
+def _slot(key, value):
+    return SimpleNamespace(
+        key=key, value=value,
+        get_repr=mock.Mock(return_value='<b>{}</b>'.format(value)))
+
+
+class TestReprRender(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.engine = ReprEngine(workers=2, timeout=5)
+        self.addCleanup(self.engine._executor.shutdown)
+        self.environment = {'return_mimetype': 'text/html'}
+
+    def test_identical_values_render_once(self):
+        (key, ) = _keys('a')
+        slots = [_slot(key, 'x') for i in range(3)] + [_slot(key, 'y')]
+        self.assertEqual(self.engine.render(slots, self.environment),
+                         ['<b>x</b>'] * 3 + ['<b>y</b>'])
+        self.assertEqual(sum(s.get_repr.call_count for s in slots), 2)
+
+    def test_cached_between_pages(self):
+        (key, ) = _keys('a')
+        self.engine.render([_slot(key, 'x')], self.environment)
+        slot = _slot(key, 'x')
+        self.assertEqual(self.engine.render([slot], self.environment),
+                         ['<b>x</b>'])
+        slot.get_repr.assert_not_called()
+
+    def test_failed_repr_falls_back_to_value(self):
+        (key, ) = _keys('a')
+        slot = _slot(key, '<i>')
+        slot.get_repr.side_effect = RuntimeError('broken')
+        self.assertEqual(self.engine.render([slot], self.environment),
+                         ['&lt;i&gt;'])
+
+
+class TestNodeQuery(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        patcher = mock.patch.object(query, 'read_collection')
+        self.collection = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.collection.aggregate.return_value = iter([
+            {'total': [{'n': 3}], 'rows': [{'_id': 5}, {'_id': 2}]}])
+        # `age` is a number, everything else text.
+        patcher = mock.patch.object(query, 'key_type', side_effect=lambda k: (
+            SimpleNamespace(name='Int' if k.name == 'age' else 'string')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pipeline(self):
+        (pipeline, ) = self.collection.aggregate.call_args[0]
+        return pipeline
+
+    def test_from_args(self):
+        q = query.NodeQuery.from_args(MultiDict([
+            ('filter', 'name:prefix:Jo'), ('filter', 'age:gte:30'),
+            ('sort', '-age')]))
+        self.assertEqual(q.filters, [('name', 'prefix', 'Jo'),
+                                     ('age', 'gte', '30')])
+        self.assertEqual((q.sort, q.descending), ('age', True))
+        self.assertTrue(q)
+        self.assertFalse(query.NodeQuery.from_args(MultiDict()))
+
+    def test_invalid_filter(self):
+        for f in ('name', 'name:like:x'):
+            with self.assertRaises(query.QueryError):
+                query.NodeQuery.from_args(MultiDict([('filter', f)]))
+
+    def test_unknown_key(self):
+        q = query.NodeQuery(sort='missing')
+        with self.assertRaises(query.QueryError):
+            q.select_rows(None, _keys('name'), 0, 10)
+
+    def test_conditions(self):
+        self.assertEqual(query._condition('eq', 'a'), {'value': 'a'})
+        self.assertEqual(query._condition('prefix', 'a.b'),
+                         {'value': {'$regex': r'^a\.b'}})
+        self.assertEqual(query._condition('lt', '5'),
+                         {'value': {'$lt': '5'}})
+        with self.assertRaises(query.QueryError):
+            query._condition('lt', 'five', numeric=True)
+
+    def test_numeric_ranges_compare_numbers(self):
+        q = query.NodeQuery(filters=[('age', 'gte', '30'),
+                                     ('name', 'gte', '30')])
+        q.select_rows(None, _keys('name', 'age'), 0, 10)
+        (age, name) = self.pipeline()[0]['$match']['$or']
+        (condition, ) = age['$and']
+        compare = condition['$expr']['$let']['in']['$and'][1]
+        self.assertEqual(compare, {'$gte': ['$$v', 30.0]})
+        self.assertEqual(name['$and'], [{'value': {'$gte': '30'}}])
+
+    def test_filters_run_one_aggregation(self):
+        (name, city) = keys = _keys('name', 'city')
+        q = query.NodeQuery(filters=[('name', 'prefix', 'Jo'),
+                                     ('city', 'eq', 'Oslo')],
+                            sort='city', descending=True)
+        self.assertEqual(q.select_rows(None, keys, 20, 10), (3, [5, 2]))
+        pipeline = self.pipeline()
+        self.assertEqual(pipeline[0]['$match']['$or'], [
+            {'key': name.id, '$and': [{'value': {'$regex': '^Jo'}}]},
+            {'key': city.id, '$and': [{'value': 'Oslo'}]},
+        ])
+        # Rows must match both filtered keys; the sort value comes with the
+        # filtered slots.
+        self.assertEqual(pipeline[2], {'$match': {'matched': 2}})
+        self.assertIn('sort', pipeline[1]['$group'])
+        rows = pipeline[3]['$facet']['rows']
+        self.assertEqual(rows[:3], [{'$sort': {'sort': -1, '_id': 1}},
+                                    {'$skip': 20}, {'$limit': 10}])
+
+    def test_sort_values_only_for_filtered_rows(self):
+        (name, city) = keys = _keys('name', 'city')
+        q = query.NodeQuery(filters=[('name', 'eq', 'Jo')], sort='city')
+        q.select_rows(None, keys, 0, 10)
+        pipeline = self.pipeline()
+        # Only the filtered key's slots are scanned ...
+        self.assertEqual(pipeline[0]['$match']['$or'],
+                         [{'key': name.id, '$and': [{'value': 'Jo'}]}])
+        # ... and the sort key's slot is looked up per remaining row.
+        lookup = pipeline[3]['$lookup']
+        self.assertEqual(lookup['pipeline'][0]['$match']['key'], city.id)
+
+    def test_no_matches(self):
+        self.collection.aggregate.return_value = iter([
+            {'total': [], 'rows': []}])
+        q = query.NodeQuery(filters=[('name', 'eq', 'x')])
+        self.assertEqual(q.select_rows(None, _keys('name'), 0, 10),
+                         (0, []))
+
+    @mock.patch.object(query, 'reads')
+    @mock.patch.object(query, 'Slot')
+    def test_sort_only_counts_the_rows_it_lists(self, Slot, reads):
+        (name, ) = keys = _keys('name')
+        slots = reads.return_value
+        slots.count.return_value = 7
+        slots.order_by.return_value.skip.return_value.limit.return_value \
+            .scalar.return_value = [4, 1]
+        q = query.NodeQuery(sort='name', descending=True)
+        self.assertEqual(q.select_rows(None, keys, 0, 2), (7, [4, 1]))
+        Slot.objects.assert_called_once_with(key=name)
+        slots.order_by.assert_called_once_with('-value')
+
+
+class TestIndexes(unittest.TestCase):
+
+    def model(self, plan):
+        model = mock.Mock()
+        cursor = model._get_collection.return_value.find.return_value
+        cursor.sort.return_value = cursor
+        cursor.explain.return_value = {'queryPlanner': {'winningPlan': plan}}
+        return model
+
+    def test_stages_walk_the_plan(self):
+        plan = {'stage': 'FETCH', 'inputStage': {
+            'stage': 'OR', 'inputStages': [{'stage': 'IXSCAN'},
+                                           {'stage': 'COLLSCAN'}]}}
+        self.assertEqual(list(indexes._stages(plan)),
+                         ['FETCH', 'OR', 'IXSCAN', 'COLLSCAN'])
+
+    def test_explain_flags_scans_and_sorts(self):
+        shapes = (
+            ('indexed', self.model({'stage': 'FETCH',
+                                    'inputStage': {'stage': 'IXSCAN'}}),
+             {}, None),
+            ('scan', self.model({'stage': 'COLLSCAN'}), {}, None),
+            ('sort', self.model({'stage': 'SORT',
+                                 'inputStage': {'stage': 'COLLSCAN'}}),
+             {}, [('value', 1)]),
+        )
+        with mock.patch.object(indexes, 'QUERY_SHAPES', shapes):
+            report = indexes.explain_queries()
+        self.assertEqual([(name, problems) for (name, _, problems)
+                          in report],
+                         [('indexed', []), ('scan', ['COLLSCAN']),
+                          ('sort', ['COLLSCAN', 'in-memory SORT'])])
+        shapes[2][1]._get_collection.return_value.find.return_value \
+            .sort.assert_called_once_with([('value', 1)])
+
+    def test_ensure_only_given_models(self):
+        (first, second) = (mock.Mock(), mock.Mock())
+        declared = ((first, ['a'], {}), (second, ['b', 'c'], {'unique': True}))
+        collection = second._get_collection.return_value
+        collection.name = 'second'
+        collection.create_index.return_value = 'b_1_c_1'
+        with mock.patch.object(indexes, 'INDEXES', declared):
+            self.assertEqual(indexes.ensure_indexes(second),
+                             [('second', 'b_1_c_1')])
+        first._get_collection.assert_not_called()
+        collection.create_index.assert_called_once_with(
+            [('b', 1), ('c', 1)], background=True, unique=True)
+
+
+class TestNodeStats(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.node = SimpleNamespace(id=ObjectId())
+        for name in ('get_stats', 'invalidate'):
+            patcher = mock.patch.object(stats, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(stats.NodeStats, '_get_collection')
+        self.collection = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.collection.find_one_and_update.return_value = {'next_row': 8}
+
+    def update(self):
+        ((query, update), _) = self.collection.find_one_and_update.call_args
+        self.assertEqual(query, {'_id': self.node.id})
+        stats.invalidate.assert_called_with('node', self.node.id)
+        return update
+
+    def test_insert_reserves_a_row(self):
+        self.assertEqual(stats.record_insert(self.node, {'a': 'x', 'b': ''}),
+                         7)
+        self.assertEqual(self.update()['$inc'], {
+            'row_count': 1, 'next_row': 1, 'key_counts.a': 1})
+
+    def test_updates_count_null_changes(self):
+        stats.record_updates(self.node, [
+            ({'a': '', 'b': 'x'}, {'a': 'y', 'b': ''}),
+            ({'a': '', 'b': 'x'}, {'a': 'z', 'b': 'w'}),
+        ])
+        self.assertEqual(self.update()['$inc'], {'key_counts.a': 2,
+                                                 'key_counts.b': -1})
+
+    def test_update_without_count_changes(self):
+        stats.record_update(self.node, {'a': 'x'}, {'a': 'y'})
+        self.assertNotIn('$inc', self.update())
+
+    def test_drop(self):
+        stats.record_drop(self.node, [{'a': 'x', 'b': None}, {'a': 'y'}])
+        self.assertEqual(self.update()['$inc'], {'row_count': -2,
+                                                 'key_counts.a': -2})
+
+
+class TestJobLease(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        patcher = mock.patch.object(jobs.Job, 'objects')
+        self.objects = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.runner = jobs.JobRunner(pause=0)
+        self.job = jobs.Job(id=ObjectId(), kind='test', progress=0)
+
+    def run_with(self, handler):
+        with mock.patch.dict(jobs.JOB_HANDLERS, {'test': handler}):
+            self.runner.run_job(self.job)
+
+    def test_checkpoint_keeps_lease(self):
+        self.objects.return_value.update.return_value = 1
+        self.runner._checkpoint(self.job)(10)
+        self.assertEqual(self.job.progress, 10)
+        self.objects.assert_called_with(id=self.job.id,
+                                        owner=self.runner.name,
+                                        status=jobs.JOB_RUNNING)
+
+    def test_checkpoint_raises_when_lease_lost(self):
+        self.objects.return_value.update.return_value = 0
+        with self.assertRaises(jobs.LeaseLost):
+            self.runner._checkpoint(self.job)(10)
+
+    def test_lost_lease_leaves_job_alone(self):
+        def handler(job, checkpoint):
+            raise jobs.LeaseLost(job.id)
+        self.run_with(handler)
+        self.objects.return_value.update.assert_not_called()
+
+    def test_done(self):
+        self.run_with(lambda job, checkpoint: None)
+        (kwargs, ) = [c[1] for c in
+                      self.objects.return_value.update.call_args_list]
+        self.assertEqual(kwargs['set__status'], jobs.JOB_DONE)
+
+    def test_failed(self):
+        def handler(job, checkpoint):
+            raise ValueError('bad')
+        self.run_with(handler)
+        kwargs = self.objects.return_value.update.call_args[1]
+        self.assertEqual(kwargs['set__status'], jobs.JOB_FAILED)
+        self.assertEqual(kwargs['set__error'], 'bad')
+
+    def test_percent_is_capped(self):
+        job = jobs.Job(kind='test', progress=150, total=100)
+        self.assertEqual(job.percent, 100)
+
+
+class TestDeleteTypeJob(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.mocks = {}
+        for name in ('Key', 'Node', 'Slot', 'Type', 'invalidate',
+                     'recompute'):
+            patcher = mock.patch.object(jobs, name)
+            self.mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.type = self.mocks['Type'].objects.return_value.first.return_value
+        self.key_ids = [ObjectId(), ObjectId()]
+        self.mocks['Key'].objects.return_value.only.return_value = [
+            SimpleNamespace(id=k) for k in self.key_ids]
+        self.nodes = [SimpleNamespace(id=ObjectId()) for i in range(2)]
+        self.mocks['Node'].objects.side_effect = lambda **kwargs: (
+            mock.Mock(only=mock.Mock(return_value=self.nodes))
+            if 'keys__in' in kwargs else self.nodes)
+        collection = self.mocks['Slot']._get_collection.return_value
+        collection.find.return_value.limit.side_effect = [
+            [{'_id': 1}, {'_id': 2}], [{'_id': 3}], []]
+        self.collection = collection
+
+    def test_deletes_slots_then_type_and_refreshes_nodes(self):
+        checkpoint = mock.Mock()
+        job = jobs.Job(kind='delete_type', params={'type': 't'}, total=3)
+        jobs._delete_type_job(job, checkpoint)
+        self.assertEqual(self.collection.delete_many.call_count, 2)
+        self.assertEqual([c[0][0] for c in checkpoint.call_args_list],
+                         [2, 3, 3])
+        self.type.delete.assert_called_once_with()
+        self.mocks['Node'].objects.assert_any_call(keys__in=self.key_ids)
+        self.assertEqual([c[0][0] for c in
+                          self.mocks['recompute'].call_args_list],
+                         self.nodes)
+        invalidated = self.mocks['invalidate'].call_args_list
+        self.assertIn(mock.call('type', self.type.id), invalidated)
+        for node in self.nodes:
+            self.assertIn(mock.call('node', node.id), invalidated)
+
+
+class TestShowJob(ViewTestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        super(TestShowJob, self).setUp()
+        self.owner = SimpleNamespace(id=ObjectId(), groups=[])
+        job = jobs.Job(id=ObjectId(), kind='drop_rows', user=self.owner.id)
+        Job = self.patch(job_views, 'Job')
+        Job.objects.return_value.first.return_value = job
+        self.patch(job_views, 'render_template', return_value='status')
+        self.url = '/job/{}'.format(job.id)
+
+    def show_as(self, user):
+        self.patch(auth, 'get_user', return_value=user)
+        self.patch(job_views, 'get_user', return_value=user)
+        return self.client.get(self.url)
+
+    def test_owner(self):
+        self.assertEqual(self.show_as(self.owner).status_code, 200)
+
+    def test_admin(self):
+        admin = SimpleNamespace(id=ObjectId(),
+                                groups=[SimpleNamespace(name='admin')])
+        self.assertEqual(self.show_as(admin).status_code, 200)
+
+    def test_other_user(self):
+        other = SimpleNamespace(id=ObjectId(), groups=[])
+        self.assertEqual(self.show_as(other).status_code, 403)
+
+
+class TestParseSchemaHeader(unittest.TestCase):
+
+    def test_names_types_and_sizes(self):
+        self.assertEqual(forms.parse_schema_header(
+            ' title:string:200, year : integer\n'), [
+                {'name': 'title', 'type': 'string', 'size': 200},
+                {'name': 'year', 'type': 'integer', 'size': None}])
+
+    def test_invalid_columns(self):
+        for header in ('title', 'title:', 'a:b:c:d', 'title:string:big'):
+            with self.assertRaises(forms.SchemaError):
+                forms.parse_schema_header(header)
+
+
+class TestCreateKeys(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.mocks = {}
+        for name in ('Action', 'Key', 'Type', 'save_actions'):
+            patcher = mock.patch.object(forms, name)
+            self.mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.string = SimpleNamespace(id=ObjectId(), name='string')
+        self.mocks['Type'].objects.return_value = [self.string]
+        self.mocks['Key'].side_effect = lambda **kwargs: SimpleNamespace(
+            id=None, **kwargs)
+        self.ids = [ObjectId(), ObjectId()]
+        self.mocks['Key'].objects.insert.return_value = self.ids
+        self.user = SimpleNamespace(id=ObjectId())
+
+    def test_keys_and_actions_are_inserted_in_bulk(self):
+        keys = forms.create_keys([
+            {'name': 'title', 'type': 'string', 'size': 200},
+            {'name': 'tag', 'type': str(self.string.id)}], self.user)
+        self.assertEqual([k.id for k in keys], self.ids)
+        self.assertEqual([k.soft_type for k in keys], [self.string] * 2)
+        self.mocks['Key'].objects.insert.assert_called_once()
+        self.mocks['save_actions'].assert_called_once()
+        self.assertEqual(
+            [c[1]['user'] for c in self.mocks['Action'].call_args_list],
+            [self.user] * 2)
+
+    def test_unknown_type(self):
+        with self.assertRaises(forms.SchemaError):
+            forms.create_keys([{'name': 'a', 'type': 'blob'}], self.user)
+        self.mocks['Key'].objects.insert.assert_not_called()
+
+    def test_malformed_specs(self):
+        for specs in ({'name': 'a'}, ['a'], [{'type': 'string'}],
+                      [{'name': 'a', 'type': 'string', 'size': '5'}],
+                      [{'name': 'a', 'type': 'string'},
+                       {'name': 'a', 'type': 'string'}]):
+            with self.assertRaises(forms.SchemaError):
+                forms.create_keys(specs, self.user)
+        self.mocks['save_actions'].assert_not_called()
+
+
+def _bulk_error(*errors):
+    return BulkWriteError({'writeErrors': [{'index': i, 'code': code}
+                                           for (i, code) in errors]})
+
+
+class TestHistoryBuffer(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        patcher = mock.patch.object(history, 'Action')
+        self.Action = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.collection = self.Action._get_collection.return_value
+        self.buffer = history.HistoryBuffer(size=100, max_retries=1)
+
+    def add(self, n):
+        actions = [mock.Mock(id=None) for i in range(n)]
+        for a in actions:
+            self.buffer.add(a)
+        return actions
+
+    def test_flush_writes_everything(self):
+        actions = self.add(3)
+        self.assertEqual(self.buffer.flush(), 3)
+        (docs, ) = self.collection.insert_many.call_args[0]
+        self.assertEqual(docs, [a.to_mongo() for a in actions])
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_duplicates_are_not_retried(self):
+        actions = self.add(3)
+        self.collection.insert_many.side_effect = _bulk_error(
+            (0, history.DUPLICATE_KEY), (2, 121))
+        self.assertEqual(self.buffer.flush(), 1)
+        self.collection.insert_many.side_effect = None
+        self.assertEqual(self.buffer.flush(), 1)
+        (docs, ) = self.collection.insert_many.call_args[0]
+        self.assertEqual(docs, [actions[2].to_mongo()])
+
+    def test_failed_batch_is_retried_then_dropped(self):
+        self.add(2)
+        self.collection.insert_many.side_effect = RuntimeError('down')
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(len(self.buffer._pending), 2)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(self.buffer._pending, [])
+
+    def test_pending_is_bounded(self):
+        self.buffer.max_pending = 2
+        self.buffer.max_retries = 10
+        self.add(3)
+        self.collection.insert_many.side_effect = RuntimeError('down')
+        self.buffer.flush()
+        self.assertEqual(len(self.buffer._pending), 2)
+
+
+
+    def test_install_routes_saves_through_the_buffer(self):
+        original = self.Action.save
+        with mock.patch.object(history.threading, 'Thread'), \
+                mock.patch.object(history.atexit, 'register'):
+            self.buffer.install()
+        action = mock.Mock(id=None)
+        self.Action.save(action)
+        self.assertEqual(self.buffer._pending, [action])
+        self.collection.insert_many.assert_not_called()
+        self.buffer.uninstall()
+        self.assertIs(self.Action.save, original)
+        self.collection.insert_many.assert_called_once_with(
+            [action.to_mongo()], ordered=False)
+
+
+class TestChildPaths(ViewTestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        super(TestChildPaths, self).setUp()
+        self.patch(node_views, 'Path')
+        self.patch(node_views, 'find_path')
+        self.query = self.patch(node_views, 'reads').return_value \
+            .order_by.return_value
+
+    def get(self, children, **args):
+        self.query.skip.return_value.limit.return_value = [
+            SimpleNamespace(string2='a/{}'.format(c)) for c in children]
+        return self.client.get('/node/fragment/children',
+                               query_string=dict(path='a', **args))
+
+    def test_pages_in_a_stable_order(self):
+        response = self.get('xyz', offset=4, count=2)
+        self.assertEqual(response.status_code, 200)
+        html = response.get_data(as_text=True)
+        self.assertIn('a/x', html)
+        self.assertIn('a/y', html)
+        # The extra child only says there is a next page.
+        self.assertNotIn('a/z<', html)
+        self.assertIn('offset=6', html)
+        self.query.skip.assert_called_once_with(4)
+        self.query.skip.return_value.limit.assert_called_once_with(3)
+        self.assertIn('max-age', response.headers['Cache-Control'])
+
+    def test_last_page(self):
+        html = self.get('x', count=2).get_data(as_text=True)
+        self.assertNotIn('data-fragment=', html)
+
+    def test_unchanged_page_is_not_sent_again(self):
+        etag = self.get('xy').headers['ETag']
+        self.query.skip.return_value.limit.return_value = [
+            SimpleNamespace(string2='a/x'), SimpleNamespace(string2='a/y')]
+        response = self.client.get('/node/fragment/children',
+                                   query_string={'path': 'a'},
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_unknown_path(self):
+        node_views.find_path.return_value = None
+        self.assertEqual(self.get('').status_code, 404)
+
+
+class TestCompressor(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        test_app = Flask(__name__)
+        compression.Compressor(test_app, min_size=10)
+        self.body = 'x' * 100
+
+        @test_app.route('/<int:status>')
+        def page(status):
+            headers = {}
+            if status == 206:
+                headers['Content-Range'] = 'bytes 0-99/200'
+            return (self.body, status, headers)
+
+        self.client = test_app.test_client()
+
+    def get(self, accept, status=200, brotli=None):
+        with mock.patch.object(compression, 'brotli', brotli):
+            return self.client.get('/{}'.format(status),
+                                   headers={'Accept-Encoding': accept})
+
+    def test_gzip(self):
+        response = self.get('gzip, deflate')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()).decode(),
+                         self.body)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+    def test_refused_encodings(self):
+        for accept in ('gzip;q=0', 'gzip;q=0.0, identity', '*;q=0'):
+            response = self.get(accept)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.get_data(as_text=True), self.body)
+
+    def test_preferred_encoding(self):
+        brotli = mock.Mock()
+        brotli.compress.return_value = b'br'
+        self.assertEqual(self.get('br;q=0, gzip', brotli=brotli)
+                         .headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self.get('br;q=0.5, gzip', brotli=brotli)
+                         .headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self.get('br, gzip', brotli=brotli)
+                         .headers['Content-Encoding'], 'br')
+
+    def test_only_complete_responses(self):
+        for status in (206, 404, 500):
+            response = self.get('gzip', status=status)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.get_data(as_text=True), self.body)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_tokens(self):
+        token = profiling.make_token('secret')
+        self.assertTrue(profiling.check_token('secret', token, 60))
+        self.assertFalse(profiling.check_token('other', token, 60))
+        self.assertFalse(profiling.check_token('secret', token, -1))
+        self.assertFalse(profiling.check_token('secret', 'junk', 60))
+
+    def test_writes_pstats_and_folded_stacks(self):
+        profile = profiling.RequestProfile(interval=0.001)
+        profile.start()
+        deadline = time.time() + 0.05
+        while time.time() < deadline:
+            sum(range(1000))
+        profile.stop()
+        profile_id = profile.write(self.directory, 'GET /node/search?x')
+        self.assertTrue(profile_id.endswith('GET__node_search_x'))
+        base = os.path.join(self.directory, profile_id)
+        stats = pstats.Stats(base + '.prof')
+        self.assertTrue(stats.total_calls)
+        with open(base + '.folded') as fh:
+            lines = fh.read().splitlines()
+        self.assertTrue(lines)
+        (stack, count) = lines[0].rsplit(' ', 1)
+        self.assertIn('test_writes_pstats_and_folded_stacks', stack)
+        self.assertGreater(int(count), 0)
+
+    def test_prune_keeps_newest(self):
+        for name in ('1', '2', '3'):
+            for ext in ('.prof', '.folded'):
+                open(os.path.join(self.directory, name + ext), 'w').close()
+        profiling.prune(self.directory, 2)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['2.folded', '2.prof', '3.folded', '3.prof'])
+
+
+class TestReprExpand(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.engine = ReprEngine(workers=2, timeout=5)
+        self.addCleanup(self.engine._executor.shutdown)
+        self.environment = {'return_mimetype': 'text/html'}
+
+    def test_columns_follow_keys(self):
+        keys = _keys('a', 'b', 'c')
+        page = self.engine.expand({
+            1: {0: _slot(keys[0], 'x'), 2: _slot(keys[2], 'y')},
+            2: {1: _slot(keys[1], 'z')},
+        }, self.environment, keys=keys)
+        self.assertEqual(page.keys, keys)
+        self.assertEqual(page.columns, [0, 1, 2])
+        self.assertEqual([r.number for r in page], [1, 2])
+        self.assertEqual(page.rows[0].values, ['x', None, 'y'])
+        self.assertEqual(page.rows[0].html, ['<b>x</b>', '', '<b>y</b>'])
+        self.assertEqual(page.rows[1].html, ['', '<b>z</b>', ''])
+
+    def test_columns_without_keys(self):
+        keys = _keys('a', 'b', 'c')
+        page = self.engine.expand({1: {2: _slot(keys[2], 'y')}},
+                                  self.environment)
+        self.assertEqual(page.columns, [2])
+        self.assertEqual(page.rows[0].values, ['y'])
+
+    @mock.patch('onebase_web.reprs.Slot')
+    def test_values(self, Slot):
+        Slot.side_effect = lambda key, row, value: _slot(key, value)
+        keys = _keys('a', 'b')
+        page = self.engine.expand_values({3: ['x', None], 4: [None, 'y']},
+                                         self.environment, keys)
+        self.assertEqual(repr(page), '<Page 2 rows x 2 columns>')
+        self.assertEqual([(r.number, r.values, r.html) for r in page], [
+            (3, ['x', None], ['<b>x</b>', '']),
+            (4, [None, 'y'], ['', '<b>y</b>']),
+        ])
+        self.assertEqual(Slot.call_count, 2)
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.pages = prefetch.PageCache()
+        self.prefetcher = prefetch.Prefetcher(self.pages, workers=1,
+                                              max_load=float('inf'))
+        self.addCleanup(self.prefetcher._executor.shutdown)
+        self.node = mock.Mock(id=ObjectId())
+        self.node.do_select.return_value = {2: 'b', 1: 'a'}
+
+    def select(self):
+        self.assertTrue(self.prefetcher._slots.acquire(blocking=False))
+        self.prefetcher._select(self.node, 10, 10, {})
+
+    def test_prefetched_page_is_cached(self):
+        self.select()
+        self.assertEqual(list(self.pages.get(self.node.id, 10, 10).items()),
+                         [(1, 'a'), (2, 'b')])
+        # Already cached: nothing more to do.
+        self.assertFalse(self.prefetcher.prefetch(self.node, 10, 10, {}))
+
+    def test_page_selected_across_an_invalidation_is_dropped(self):
+        for node_id in (self.node.id, None):
+            self.node.do_select.side_effect = lambda **kwargs: (
+                self.pages.invalidate(node_id) or {1: 'a'})
+            self.select()
+            self.assertIsNone(self.pages.get(self.node.id, 10, 10))
+
+    def test_other_nodes_do_not_interfere(self):
+        self.node.do_select.side_effect = lambda **kwargs: (
+            self.pages.invalidate(ObjectId()) or {1: 'a'})
+        self.select()
+        self.assertIsNotNone(self.pages.get(self.node.id, 10, 10))
+
+    def test_invalidate_drops_the_node_pages(self):
+        self.pages.set(self.node.id, 0, 10, {})
+        self.pages.set(self.node.id, 10, 10, {})
+        self.pages.invalidate(self.node.id)
+        self.assertIsNone(self.pages.get(self.node.id, 0, 10))
+        self.assertIsNone(self.pages.get(self.node.id, 10, 10))
+
+    def test_busy_host_is_left_alone(self):
+        self.prefetcher.max_load = -1
+        self.assertFalse(self.prefetcher.prefetch(self.node, 10, 10, {}))
+        self.node.do_select.assert_not_called()
+
+
+class TestInvalidationBus(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.bus = invalidation.InvalidationBus(mode=invalidation.MODE_POLL,
+                                                interval=0)
+        self.collection = mock.Mock()
+        self.bus._collection = lambda: self.collection
+        self.bus._ready = True
+        self.received = []
+        self.bus.subscribe('node', self.received.append)
+
+    def poll(self, *batches):
+        """ Poll once per batch of documents, then stop. """
+        self.collection.find.return_value.sort.side_effect = batches
+        self.bus._stopping = mock.Mock()
+        self.bus._stopping.wait.side_effect = [False] * len(batches) + [True]
+        self.assertTrue(self.bus._poll())
+
+    def test_poll_delivers_other_workers_invalidations(self):
+        docs = [{'_id': ObjectId(), 'topic': 'node', 'key': 'a',
+                 'origin': 'elsewhere:1'},
+                {'_id': ObjectId(), 'topic': 'node', 'key': 'b',
+                 'origin': self.bus.origin},
+                {'_id': ObjectId(), 'topic': 'type', 'key': 'c',
+                 'origin': 'elsewhere:1'}]
+        self.poll(docs, [])
+        self.assertEqual(self.received, ['a'])
+        self.assertEqual(self.bus.following, invalidation.MODE_POLL)
+        # The next poll only asks for what came after.
+        (query, ) = self.collection.find.call_args[0]
+        self.assertEqual(query, {'_id': {'$gt': docs[2]['_id']}})
+
+    def test_poll_survives_errors(self):
+        self.collection.find.side_effect = invalidation.PyMongoError('down')
+        with self.assertLogs(invalidation.logger, 'ERROR'):
+            self.assertFalse(self.bus._poll(until=time.monotonic()))
+
+    def test_publish_runs_local_handlers_and_shares(self):
+        self.bus._peers = (True, time.monotonic())
+        self.bus.publish('node', ObjectId('5' * 24))
+        self.assertEqual(self.received, ['5' * 24])
+        (doc, ) = self.collection.insert_one.call_args[0]
+        self.assertEqual((doc['topic'], doc['key'], doc['origin']),
+                         ('node', '5' * 24, self.bus.origin))
+
+    def test_nothing_shared_without_peers(self):
+        self.bus._peers = (False, time.monotonic())
+        self.bus.publish('node', 'a')
+        self.assertEqual(self.received, ['a'])
+        self.collection.insert_one.assert_not_called()
+        self.assertEqual(self.bus.counters['unshared'], 1)
+
+    def test_failing_handler_does_not_stop_the_others(self):
+        self.bus.subscribe('node', mock.Mock(side_effect=ValueError))
+        self.bus.subscribe('node', self.received.append)
+        with self.assertLogs(invalidation.logger, 'ERROR'):
+            self.bus.dispatch('node', 'a')
+        self.assertEqual(self.received, ['a', 'a'])
+
+    def test_auto_mode_falls_back_to_polling(self):
+        self.bus.mode = invalidation.MODE_AUTO
+        with mock.patch.object(self.bus, '_watch', side_effect=(
+                invalidation.OperationFailure('not a replica set'))), \
+                mock.patch.object(self.bus, '_poll') as poll:
+            self.bus._run()
+        poll.assert_called_once_with()
+        self.assertEqual(self.bus.counters['follow_failures'], 1)
+
+    def test_failed_change_stream_polls_until_retry(self):
+        self.bus.mode = invalidation.MODE_CHANGE_STREAM
+        with mock.patch.object(self.bus, '_watch', side_effect=(
+                invalidation.OperationFailure('stepped down'))), \
+                mock.patch.object(self.bus, '_poll',
+                                  side_effect=[False, True]) as poll, \
+                self.assertLogs(invalidation.logger, 'ERROR'):
+            self.bus._run()
+        # Polled between retries, for a window that doubles each time.
+        self.assertEqual(poll.call_count, 2)
+        self.assertEqual(self.bus.counters['follow_failures'], 2)
+        # Handlers were asked to drop everything, as writes may be missed.
+        self.assertEqual(self.received, [None, None])
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.mocks = {}
+        for name in ('Path', 'SearchEntry', 'index_node', 'read_collection'):
+            patcher = mock.patch.object(search, name)
+            self.mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(search, '_index_ready', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.collection = self.mocks['read_collection'].return_value
+
+    def test_index_is_ensured_once(self):
+        self.collection.count_documents.return_value = 0
+        self.collection.find.return_value.sort.return_value.skip \
+            .return_value.limit.return_value = []
+        self.assertEqual(search.search('people'), (0, []))
+        self.assertEqual(search.search('people'), (0, []))
+        self.mocks['SearchEntry'].ensure_indexes.assert_called_once_with()
+
+    def test_failed_search_is_empty(self):
+        self.collection.count_documents.side_effect = (
+            search.OperationFailure('text index required for $text query'))
+        with self.assertLogs(search.logger, 'ERROR'):
+            self.assertEqual(search.search('people'), (0, []))
+
+    def test_edited_node_is_reindexed(self):
+        path = self.mocks['Path'].objects.return_value.first.return_value
+        search.reindex_node('n')
+        self.mocks['Path'].objects.assert_called_with(node='n')
+        self.mocks['index_node'].assert_called_once_with(path.node,
+                                                         path.string2)
+
+    def test_unreachable_node_is_dropped(self):
+        self.mocks['Path'].objects.return_value.first.return_value = None
+        search.reindex_node('n')
+        self.mocks['SearchEntry'].objects.assert_called_once_with(node='n')
+        self.mocks['SearchEntry'].objects.return_value.delete \
+            .assert_called_once_with()
+        self.mocks['index_node'].assert_not_called()
+
+    def test_edited_path_is_reindexed(self):
+        path = self.mocks['Path'].objects.return_value.first.return_value
+        search.reindex_path('p')
+        self.mocks['Path'].objects.assert_called_with(id='p')
+        self.mocks['index_node'].assert_called_once_with(path.node,
+                                                         path.string2)
+
+    def test_written_topics_are_followed(self):
+        self.assertIn(search.reindex_node, invalidation.bus._handlers[
+            invalidation.written('node')])
+        self.assertIn(search.reindex_path, invalidation.bus._handlers[
+            invalidation.written('path')])
+
+
+class TestChangeStream(unittest.TestCase):
+
+    @mock.patch.object(invalidation, 'Type')
+    def test_direct_writes_are_dispatched_as_written(self, Type):
+        bus = invalidation.InvalidationBus()
+        (received, written) = ([], [])
+        bus.subscribe('node', received.append)
+        bus.subscribe(invalidation.written('node'), written.append)
+        node_id = ObjectId()
+        stream = Type._get_db.return_value.watch.return_value.__enter__ \
+            .return_value
+        stream.__iter__.return_value = [
+            {'ns': {'coll': invalidation.Node._get_collection_name()},
+             'operationType': 'update', 'documentKey': {'_id': node_id}},
+            {'ns': {'coll': invalidation.INVALIDATION_COLLECTION},
+             'operationType': 'insert',
+             'fullDocument': {'topic': 'node', 'key': 'published',
+                              'origin': 'elsewhere:1'}},
+        ]
+        bus._watch()
+        self.assertEqual(received, [str(node_id), 'published'])
+        self.assertEqual(written, [str(node_id)])
+
+
+class TestApplyGridEdits(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.keys = _keys('name', 'age')
+        self.node = mock.Mock(id=ObjectId())
+        self.node.get_keys.return_value = self.keys
+        for (name, kwargs) in (
+                ('Slot', {}),
+                ('key_type', {}),
+                ('record_updates', {})):
+            patcher = mock.patch.object(forms, name, **kwargs)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.Slot.side_effect = lambda **kw: mock.Mock(
+            to_mongo=mock.Mock(return_value={'key': kw['key'].id,
+                                             'row': kw['row'],
+                                             'value': kw['value']}))
+        self.collection = self.Slot._get_collection.return_value
+
+    def stored(self, *cells):
+        return [{'row': row, 'key': self.keys[col].id, 'value': value}
+                for (row, col, value) in cells]
+
+    def written(self, modified=0, upserted=0):
+        return mock.Mock(modified_count=modified, upserted_count=upserted)
+
+    def edit(self, edits):
+        return forms.apply_grid_edits(self.node, {
+            row: {str(self.keys[col].id): change
+                  for (col, change) in cells.items()}
+            for (row, cells) in edits.items()})
+
+    def test_old_values_compare_as_text(self):
+        self.collection.find.return_value = self.stored((1, 1, '30'))
+        self.collection.bulk_write.return_value = self.written(modified=1)
+        result = self.edit({1: {1: (30, '31')}})
+        self.assertEqual(result['updated'], [1])
+        self.assertEqual(result['conflicts'], {})
+        (ops, ) = self.collection.bulk_write.call_args[0]
+        self.assertEqual(ops[0]._filter, {'key': self.keys[1].id, 'row': 1,
+                                          'value': '30'})
+
+    def test_conflict_skips_row(self):
+        self.collection.find.return_value = self.stored((1, 0, 'Bob'))
+        result = self.edit({1: {0: ('Alice', 'Carol')}})
+        self.assertEqual(result['conflicts'], {1: ['name']})
+        self.collection.bulk_write.assert_not_called()
+        self.record_updates.assert_not_called()
+
+    def test_new_cell_is_upserted(self):
+        self.collection.find.return_value = self.stored((1, 0, 'Bob'))
+        self.collection.bulk_write.return_value = self.written(upserted=1)
+        result = self.edit({1: {1: ('', '30')}})
+        self.assertEqual(result['updated'], [1])
+        (ops, ) = self.collection.bulk_write.call_args[0]
+        self.assertEqual(ops[0]._filter, {'key': self.keys[1].id, 'row': 1})
+        self.assertEqual(ops[0]._doc, {'$setOnInsert': {'value': '30'}})
+        self.assertTrue(ops[0]._upsert)
+
+    def test_lost_race_is_a_conflict(self):
+        self.collection.find.side_effect = [
+            self.stored((1, 0, 'Bob')),
+            self.stored((1, 0, 'Bob'), (1, 1, '29')),
+        ]
+        self.collection.bulk_write.return_value = self.written()
+        result = self.edit({1: {1: ('', '30')}})
+        self.assertEqual(result['conflicts'], {1: ['age']})
+        self.assertEqual(result['updated'], [])
+
+    def test_missing_row(self):
+        self.collection.find.return_value = []
+        result = self.edit({7: {0: ('', 'x')}})
+        self.assertEqual(result['errors'], {7: {'row': 'No such row'}})
+
+
+
+    def test_unknown_key_is_reported_by_name(self):
+        self.collection.find.return_value = self.stored((1, 0, 'Bob'))
+        key_id = str(ObjectId())
+        result = forms.apply_grid_edits(self.node,
+                                        {1: {key_id: ('', 'x')}})
+        self.assertEqual(result['errors'],
+                         {1: {'key': 'Unknown key `{}`'.format(key_id)}})
+        self.collection.bulk_write.assert_not_called()
+
+
+class TestParseGridForm(unittest.TestCase):
+
+    def test_changed_cells(self):
+        self.assertEqual(forms.parse_grid_form(MultiDict([
+            ('cell-1-k1', 'new'), ('orig-1-k1', 'old'),
+            ('cell-1-k2', 'same'), ('orig-1-k2', 'same'),
+            ('cell-2-k1', 'x'),
+            ('other', 'y'),
+        ])), {1: {'k1': ('old', 'new')}, 2: {'k1': ('', 'x')}})
+
+    def test_malformed_names_are_ignored(self):
+        self.assertEqual(forms.parse_grid_form(MultiDict([
+            ('cell-x-k1', 'a'), ('cell-1', 'b'), ('cell-', 'c'),
+            ('cell-3-k1', 'd'),
+        ])), {3: {'k1': ('', 'd')}})
+
+
+# A cell with no slot at all (unlike a slot holding None).
+_ABSENT = object()
+
+
+def _bson_type(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int' if -2**31 <= value < 2**31 else 'long'
+    if isinstance(value, float):
+        return 'double'
+    return 'string'
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.keys = _keys('ints', 'floats', 'text', 'mixed', 'empty')
+        self.docs = []
+        patcher = mock.patch.object(snapshots, 'Slot')
+        collection = patcher.start()._get_collection.return_value
+        self.addCleanup(patcher.stop)
+        collection.aggregate.side_effect = self.aggregate
+        collection.find.return_value.sort.side_effect = lambda *args: sorted(
+            self.docs, key=lambda d: d['row'])
+        patcher = mock.patch.object(snapshots, 'get_stats',
+                                    return_value=SimpleNamespace(
+                                        modified=None, row_count=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def aggregate(self, pipeline, **kwargs):
+        # The `$type` grouping of `_kinds`.
+        types = {}
+        for d in self.docs:
+            if d['value'] is not None:
+                types.setdefault(d['key'], set()).add(_bson_type(d['value']))
+        return [{'_id': k, 'types': list(t)} for (k, t) in types.items()]
+
+    def add(self, row, values):
+        for (key, value) in zip(self.keys, values):
+            if value is not _ABSENT:
+                self.docs.append({'key': key.id, 'row': row, 'value': value})
+
+    def build(self, **kwargs):
+        path = os.path.join(self.directory, 'node.snap')
+        n = snapshots.build_snapshot(SimpleNamespace(id=ObjectId()), path,
+                                     self.keys, **kwargs)
+        snapshot = snapshots.Snapshot(path)
+        self.addCleanup(snapshot.close)
+        return (n, snapshot)
+
+    def test_round_trip(self):
+        rows = {
+            0: [1, 1.5, 'a', 'x', _ABSENT],
+            3: [2**40, 2, 'café', 5, _ABSENT],
+            4: [_ABSENT] * 5,
+            7: [-3, None, '', True, _ABSENT],
+            9: [None, -0.25, None, 2.5, _ABSENT],
+        }
+        for (row, values) in rows.items():
+            self.add(row, values)
+        (n, snapshot) = self.build()
+        self.assertEqual(n, 4)
+        self.assertEqual(snapshot.kinds, ['int', 'float', 'str', 'str',
+                                          'str'])
+        self.assertEqual(snapshot.select(0, 10), {
+            0: [1, 1.5, 'a', 'x', None],
+            3: [2**40, 2.0, 'café', '5', None],
+            7: [-3, None, '', 'True', None],
+            9: [None, -0.25, None, '2.5', None],
+        })
+        self.assertEqual(list(snapshot.select(1, 2)), [3, 7])
+        self.assertEqual(snapshot.select(4, 10), {})
+        self.assertTrue(snapshot.is_current('/0', self.keys))
+        self.assertFalse(snapshot.is_current('/0', self.keys[:2]))
+
+    def test_build_spans_several_batches(self):
+        expected = {}
+        for row in range(0, 50, 2):
+            values = [row, row / 4, 'r{}'.format(row) * (row % 5),
+                      None if row % 3 else row, _ABSENT]
+            self.add(row, values)
+            expected[row] = [
+                row, row / 4, 'r{}'.format(row) * (row % 5),
+                None if row % 3 else row, None]
+        (n, snapshot) = self.build(batch_size=4)
+        self.assertEqual(n, 25)
+        self.assertEqual(snapshot.select(0, 100), expected)
+        self.assertEqual(list(snapshot.select(20, 3)), [40, 42, 44])
+
+    def test_empty_node(self):
+        (n, snapshot) = self.build()
+        self.assertEqual((n, len(snapshot)), (0, 0))
+        self.assertEqual(snapshot.select(0, 10), {})
+
+
+class TestReadRouting(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.document = mock.Mock()
+        self.document._get_collection_name.return_value = 'slots'
+        patcher = mock.patch.object(routing, 'get_db')
+        self.get_db = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_primary_unless_routed(self):
+        self.assertIs(routing.read_collection(self.document),
+                      self.document._get_collection.return_value)
+        queryset = mock.Mock()
+        self.assertIs(routing.reads(queryset), queryset)
+        self.get_db.assert_not_called()
+
+    def test_routed_block_reads_from_secondaries(self):
+        with routing.read_from_secondaries():
+            collection = routing.read_collection(self.document)
+        self.get_db.assert_called_once_with(routing.READ_ALIAS)
+        self.assertIs(collection,
+                      self.get_db.return_value.__getitem__.return_value)
+        self.get_db.return_value.__getitem__.assert_called_once_with('slots')
+        # Back on the primary after the block.
+        routing.read_collection(self.document)
+        self.assertEqual(self.get_db.call_count, 1)
+
+    def test_router_picks_endpoints(self):
+        router = routing.ReadRouter(['node.view_node'])
+        cases = (
+            ('/node/search', 'GET', {}, True),
+            ('/node/search', 'POST', {}, False),
+            ('/node/browse', 'GET', {}, False),
+            ('/node/search', 'GET', {'Cookie': '{}=1'.format(
+                routing.AFTER_WRITE_COOKIE)}, False),
+        )
+        for (url, method, headers, routed) in cases:
+            with app.test_request_context(url, method=method,
+                                          headers=headers):
+                self.assertEqual(router.routed(), routed, (url, method))
+
+    @mock.patch.object(stats, 'get_stats')
+    @mock.patch.object(stats, 'read_collection')
+    def test_stats_are_read_from_the_read_connection(self, read_collection,
+                                                     get_stats):
+        node = SimpleNamespace(id=ObjectId())
+        read_collection.return_value.find_one.return_value = {
+            '_id': node.id, 'row_count': 3}
+        self.assertEqual(stats.read_stats(node).row_count, 3)
+        get_stats.assert_not_called()
+        # Missing statistics are computed (and saved) on the primary.
+        read_collection.return_value.find_one.return_value = None
+        self.assertIs(stats.read_stats(node), get_stats.return_value)
+
+
+class TestAdmission(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.app = Flask(__name__)
+        self.app.secret_key = 'test'
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        name = 'test-{}'.format(id(self))
+        self.addCleanup(admission.CONTROLLERS.pop, name, None)
+
+        @self.app.route('/write', methods=['GET', 'POST'])
+        @admission.admission_required(name, concurrency=1, rate=0.001,
+                                      burst=2)
+        def write():
+            if request.args.get('block'):
+                self.entered.set()
+                self.release.wait(5)
+            return 'ok'
+
+        self.controller = admission.CONTROLLERS[name]
+        self.client = self.app.test_client()
+
+    def post(self, addr='10.0.0.1', **args):
+        return self.client.post('/write', query_string=args,
+                                environ_base={'REMOTE_ADDR': addr})
+
+    def test_rate_limit_per_client(self):
+        self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(self.post().status_code, 200)
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+        self.assertEqual(self.post(addr='10.0.0.2').status_code, 200)
+        self.assertEqual(self.controller.counters[admission.REJECTED_RATE],
+                         1)
+        self.assertEqual(self.controller.in_flight, 0)
+
+    def test_busy_endpoint_refuses_without_spending_tokens(self):
+        worker = threading.Thread(target=self.post, kwargs={'block': 1})
+        worker.start()
+        self.assertTrue(self.entered.wait(5))
+        try:
+            response = self.post(addr='10.0.0.2')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '1')
+        finally:
+            self.release.set()
+            worker.join(5)
+        self.assertEqual(self.controller.counters[admission.REJECTED_BUSY],
+                         1)
+        # The refused client still has its whole burst.
+        self.assertEqual(self.post(addr='10.0.0.2').status_code, 200)
+        self.assertEqual(self.post(addr='10.0.0.2').status_code, 200)
+
+    def test_reads_are_not_limited(self):
+        for i in range(5):
+            self.assertEqual(self.client.get('/write').status_code, 200)
+
+    def test_metrics(self):
+        self.post()
+        text = admission.metrics()
+        self.assertIn('onebase_admission_total{{endpoint="{}",'
+                      'result="admitted"}} 1'.format(self.controller.name),
+                      text)
+
+
+class TestSharedMemoryCache(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_cache(self, **kwargs):
+        kwargs.setdefault('max_size', 16)
+        kwargs.setdefault('slot_size', 256)
+        return SharedMemoryCache('test', directory=self.directory, **kwargs)
+
+    def test_round_trip_as_json(self):
+        cache = self.make_cache()
+        oid = ObjectId()
+        cache.set(('a', 1), {'id': oid, 'values': (1, 2)})
+        # Tuples come back as lists.
+        self.assertEqual(cache.get(('a', 1)),
+                         {'id': oid, 'values': [1, 2]})
+        self.assertIsNone(cache.get(('a', 2)))
+
+    def test_rejects_objects(self):
+        cache = self.make_cache()
+        with self.assertRaises(TypeError):
+            cache.set('a', object())
+
+    def test_shared_between_instances(self):
+        (first, second) = (self.make_cache(), self.make_cache())
+        first.set('a', 'value')
+        self.assertEqual(second.get('a'), 'value')
+        second.delete('a')
+        self.assertIsNone(first.get('a'))
+
+    def test_too_large(self):
+        cache = self.make_cache()
+        cache.set('a', 'small')
+        cache.set('a', 'x' * 1000)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats.rejected, 1)
+
+    def test_expiry(self):
+        cache = self.make_cache()
+        cache.set('a', 1, ttl=-1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_full_set_evicts(self):
+        cache = self.make_cache(max_size=4, ways=4)
+        for i in range(5):
+            cache.set(i, i)
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.stats.evictions, 1)
+
+    def test_clear(self):
+        cache = self.make_cache()
+        cache.set('a', 1)
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+
+class TestMakeCache(unittest.TestCase):
+
+    def setUp(self):
+        """ Set up the test """
+        self.addCleanup(cache_module.CACHES.pop, 'test', None)
+
+    def test_backends(self):
+        cache = cache_module.make_cache('test', backend='process')
+        self.assertIsInstance(cache, TTLCache)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with mock.patch.object(web_settings, 'ONEBASE_CACHE_DIR', directory):
+            cache = cache_module.make_cache('test', backend='shared')
+        self.assertIsInstance(cache, SharedMemoryCache)
+        self.assertIs(cache_module.CACHES['test'], cache)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            cache_module.make_cache('test', backend='nope')
+
+
+@unittest.skipIf(loadgen is None, 'requests is not installed')
+class TestLoadgen(unittest.TestCase):
+
+    def response(self, status, location=None, **headers):
+        if location is not None:
+            headers['Location'] = location
+        return SimpleNamespace(status_code=status, headers=headers)
+
+    def test_summary(self):
+        results = loadgen.Results()
+        for i in range(1, 11):
+            results.record('GET /a', i / 1000, 200, True)
+        results.record('GET /a', 0.5, 429, False)
+        results.record('GET /a', 0.5, None, False)
+        report = results.summary(2.0)['GET /a']
+        self.assertEqual(report['requests'], 12)
+        self.assertEqual(report['rps'], 6)
+        self.assertEqual(report['p50_ms'], 7)
+        self.assertEqual(report['max_ms'], 500)
+        self.assertEqual(report['error_rate'], 1 / 12)
+        self.assertEqual(report['throttle_rate'], 1 / 12)
+        out = io.StringIO()
+        loadgen.print_report({'GET /a': report}, 2.0, out=out)
+        self.assertIn('12 requests in 2.0s (6.0/s)', out.getvalue())
+
+    def test_redirects_to(self):
+        check = loadgen.redirects_to('/node/search')
+        self.assertTrue(check(self.response(302, '/node/search?path=a')))
+        self.assertFalse(check(self.response(200)))
+        self.assertFalse(check(self.response(302, '/login?next=/')))
+        self.assertFalse(loadgen.logged_in(self.response(302, '/login')))
+
+    def test_parse_mix(self):
+        self.assertEqual(loadgen.parse_mix('search=3,add=1'),
+                         {'search': 3.0, 'add': 1.0})
+        with self.assertRaises(argparse.ArgumentTypeError):
+            loadgen.parse_mix('delete=1')
+
+    def test_known_rows(self):
+        dataset = loadgen.Dataset(1, nodes=2, rows=10)
+        rng = random.Random(0)
+        path = dataset.paths[0]
+        self.assertIsNone(dataset.pick_row(rng, path))
+        dataset.remember_rows(path, '<input name="select_row" value="3">'
+                                    '<input name="select_row" value="4">')
+        self.assertIn(dataset.pick_row(rng, path), (3, 4))
+
+    def test_retry_waits_out_throttling(self):
+        responses = [self.response(429, **{'Retry-After': '2'}),
+                     self.response(200)]
+        with mock.patch.object(loadgen.time, 'sleep') as sleep:
+            response = loadgen._retry(lambda: responses.pop(0))
+        self.assertEqual(response.status_code, 200)
+        sleep.assert_called_once_with(2.0)
+
+    def test_failed_request_is_an_error(self):
+        args = SimpleNamespace(url='http://test/', timeout=1)
+        results = loadgen.Results()
+        client = loadgen.Client(args, loadgen.Dataset(1, 1, 1), results,
+                                random.Random(0))
+        with mock.patch.object(client.session, 'request',
+                               side_effect=loadgen.requests.ConnectionError):
+            self.assertIsNone(client.request('GET /', 'GET', '/'))
+        self.assertEqual(results.errors['GET /'], 1)
+
 
 if __name__ == '__main__':
     unittest.main()
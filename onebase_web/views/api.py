@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import logging
+
+from functools import (
+    wraps
+)
+
+from flask import (
+    Blueprint,
+    Response,
+    request,
+    g,
+)
+
+from onebase_api.models.auth import (
+    User,
+)
+from onebase_api.models.main import (
+    Path,
+    Slot,
+)
+from onebase_api.exceptions import (
+    OneBaseException,
+)
+from onebase_web.admission import admission_required
+from onebase_web.cache import make_cache
+from onebase_web.invalidation import (
+    bus,
+    invalidate,
+)
+from onebase_web.lookups import (
+    find_path,
+    key_type,
+    load_user,
+)
+from onebase_web.stats import (
+    get_stats,
+    record_insert,
+    row_inserted,
+)
+from onebase_web import settings as web_settings
+
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj, default=str)
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, default=str, separators=(',', ':'))
+
+logger = logging.getLogger(__name__)
+
+api_views = Blueprint('api', __name__, url_prefix='/api/v1')
+
+api_key_cache = make_cache('api_keys', max_size=4096,
+                           ttl=web_settings.ONEBASE_API_KEY_TTL)
+bus.subscribe('api_key', lambda key: api_key_cache.delete(key)
+              if key else api_key_cache.clear())
+bus.subscribe('user', lambda user_id: api_key_cache.clear())
+
+
+def json_response(data, status=200, headers=None):
+    """ Serialize `data` to a JSON response (no template rendering). """
+    return Response(_dumps(data), status=status, headers=headers,
+                    mimetype='application/json')
+
+
+def json_error(status, message, code=None):
+    return json_response({'error': code or status, 'message': message},
+                         status=status)
+
+
+def user_for_api_key(api_key):
+    """ Look up the active user owning `api_key`.
+
+    Only the key -> user id mapping is cached; the user is loaded for every
+    request (through the user cache, which is invalidated when the user
+    changes), so no `User` instance is shared between requests.
+    """
+    user_id = api_key_cache.get(api_key)
+    if user_id is not None:
+        user = load_user(user_id)
+        # The key may have been changed since it was cached.
+        if user is not None and user.api_key == api_key:
+            return user if getattr(user, 'is_active', True) else None
+    user = User.objects(api_key=api_key).first()
+    if user is None:
+        return None
+    api_key_cache.set(api_key, str(user.id))
+    return user if getattr(user, 'is_active', True) else None
+
+
+def forget_api_key(api_key):
+    """ Drop `api_key` from every worker's cache (e.g. after it is
+    changed). """
+    if api_key:
+        invalidate('api_key', api_key)
+
+
+def api_key_required(f):
+    """ Authenticate the request by its API key header. """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        api_key = request.headers.get(web_settings.ONEBASE_API_KEY_HEADER)
+        user = user_for_api_key(api_key) if api_key else None
+        if user is None or not getattr(user, 'is_active', True):
+            return json_error(401, 'Invalid or missing API key')
+        g.user = user
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def api_permissions_required(*permissions):
+    """ Require the API user to have all `permissions`. """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not g.user.can_all(*permissions):
+                return json_error(403, 'Permission denied')
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def _cell_value(cell):
+    """ Reduce a `do_select` cell to its raw value. """
+    if isinstance(cell, (tuple, list)):
+        cell = cell[0]
+    return getattr(cell, 'value', cell)
+
+
+def _slot_value(value):
+    """ Store a JSON value as the form views would: as text. """
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _key_json(key):
+    soft_type = getattr(key, 'soft_type', None)
+    return {
+        'name': key.name,
+        'size': key.size,
+        'type': str(soft_type.id) if soft_type is not None else None,
+    }
+
+
+def _find_node(path):
+    current = find_path(path) if path else None
+    node = getattr(current, 'node', None)
+    return (current, node)
+
+
+@api_views.errorhandler(OneBaseException)
+def handle_onebase_exception(error):
+    return json_error(400, str(error), code=error.error_code)
+
+
+@api_views.route('/node/search', methods=['GET', ])
+@api_key_required
+def search_node():
+    """ Get a page of rows from the node at `path`. """
+    (current, node) = _find_node(request.args.get('path'))
+    if node is None:
+        return json_error(404, 'Node not found')
+    try:
+        offset = int(request.args.get('offset', 0))
+        count = int(request.args.get('count', 100))
+    except ValueError:
+        return json_error(400, 'offset and count must be integers')
+    if offset < 0 or count < 0:
+        return json_error(400, 'offset and count must not be negative')
+    count = min(count, web_settings.ONEBASE_API_MAX_COUNT)
+    node_keys = node.get_keys()
+    query_set = node.do_select(offset=offset, limit=count)
+    rows = []
+    for (row_num, row) in sorted(query_set.items()):
+        # Cells are keyed by key index; a row may lack some of them.
+        rows.append([row_num, ] + [_cell_value(row.get(col))
+                                   for col in range(len(node_keys))])
+    return json_response({
+        'path': current.string2,
+        'title': node.title,
+        'description': node.description,
+        'keys': [_key_json(k) for k in node_keys],
+        'offset': offset,
+        'count': count,
+        'total': get_stats(node).row_count,
+        'rows': rows,
+    })
+
+
+@api_views.route('/node/browse', methods=['GET', ])
+@api_key_required
+def browse_nodes():
+    """ List the child paths of `path` (or the root paths). """
+    path = request.args.get('path', '')
+    if not path:
+        children = Path.objects(parent=None).all()
+        node = None
+    else:
+        (current, node) = _find_node(path)
+        if current is None:
+            return json_error(404, 'Path not found')
+        children = current.paths()
+    return json_response({
+        'path': path,
+        'has_node': node is not None,
+        'children': [c.string2 for c in children],
+    })
+
+
+@api_views.route('/node/slot/add', methods=['POST', ])
+@api_key_required
+@api_permissions_required('node_modify')
+@admission_required('slot_add')
+def add_slot_row():
+    """ Insert one row, given as a JSON object of key name -> value. """
+    (current, node) = _find_node(request.args.get('path'))
+    if node is None:
+        return json_error(404, 'Node not found')
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict):
+        return json_error(400, 'Expected a JSON object of key -> value')
+    keys = {k.name: k for k in node.get_keys()}
+    unknown = sorted(set(values) - set(keys))
+    if unknown:
+        return json_error(400, 'Unknown keys: {}'.format(', '.join(unknown)))
+    values = {name: _slot_value(value) for (name, value) in values.items()}
+    errors = {}
+    for (name, value) in values.items():
+        key = keys[name]
+        try:
+            key_type(key).validate_value(value, key.size)
+        except OneBaseException as e:
+            errors[name] = '{} - {}'.format(e.error_code, e)
+    if errors:
+        return json_response({'error': 400, 'errors': errors}, status=400)
+    row = record_insert(node, {str(keys[name].id): value
+                               for (name, value) in values.items()})
+    for (name, value) in values.items():
+        Slot(key=keys[name], row=row, value=value).save(g.user)
+    row_inserted(node)
+    return json_response({'row': row}, status=201)
@@ -19,6 +19,7 @@ along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
 import logging
 import os
 
+from datetime import datetime
 from functools import (
     wraps
 )
@@ -39,10 +40,44 @@ from onebase_common.util import (
     is_safe_url,
     hashpass,
 )
+from mongoengine import (
+    DateTimeField,
+    Document,
+    ObjectIdField,
+)
+from mongoengine.errors import NotUniqueError
+from pymongo.errors import PyMongoError
+
+from onebase_web.email import (
+    send_verification_email,
+)
+from onebase_web.indexes import (
+    ensure_indexes,
+)
+from onebase_web.hashing import (
+    PasswordHasher,
+    HashingOverloaded,
+)
+from onebase_web.admission import (
+    ADMITTED,
+    REJECTED_BUSY,
+    REJECTED_RATE,
+    controller,
+    retry_after,
+)
+from onebase_web.ratelimit import (
+    RateLimiter,
+)
+from onebase_web.views.api import (
+    forget_api_key,
+)
+from onebase_web.invalidation import invalidate
+from onebase_web.lookups import load_user
 from onebase_web.forms import (
     LoginForm,
     RegisterForm,
     ChangeApiKeyForm,
+    ChangePasswordForm,
     # CreateNodeForm,
 )
 from onebase_api.models.auth import (
@@ -60,6 +95,16 @@ _tpl_folder = os.path.join(web_settings.TEMPLATES_DIR, 'auth')
 auth_views = Blueprint('auth', __name__,
                        template_folder=_tpl_folder)
 
+password_hasher = PasswordHasher(workers=web_settings.ONEBASE_HASH_WORKERS,
+                                 max_pending=web_settings.ONEBASE_HASH_PENDING)
+login_ip_limiter = RateLimiter(web_settings.ONEBASE_LOGIN_IP_RATE,
+                               web_settings.ONEBASE_LOGIN_IP_BURST)
+login_email_limiter = RateLimiter(web_settings.ONEBASE_LOGIN_EMAIL_RATE,
+                                  web_settings.ONEBASE_LOGIN_EMAIL_BURST)
+# Login and registration have their own limits; these only count outcomes.
+login_admission = controller('login')
+register_admission = controller('register')
+
 
 def _create_password():
     import getpass
@@ -95,20 +140,93 @@ def ensure_admin_exists():
     logger.debug('Done!')
 
 
+def ensure_auth_indexes():
+    """ Index credential lookups (unique email, API key, ...).
+
+    Failures (such as duplicate emails blocking the unique index) are
+    logged rather than raised, so they don't keep the app from starting.
+    """
+    try:
+        ensure_indexes(User)
+    except PyMongoError:
+        logger.exception('Could not create the user indexes; resolve the '
+                         'problem and run `flask indexes`')
+
+
+class ClosedAccount(Document):
+    """ An account closed with `deactivate_user`.
+
+    A closed account has `is_active` False, like one whose email isn't
+    verified yet; only closed accounts are refused at login.
+    """
+
+    user = ObjectIdField(primary_key=True)
+    closed = DateTimeField(default=datetime.utcnow)
+
+    meta = {'collection': 'onebase_web_closed_accounts'}
+
+
+def is_closed(user):
+    """ Whether `user`'s account was closed with `deactivate_user`. """
+    if getattr(user, 'is_active', True) is not False:
+        return False
+    return ClosedAccount.objects(pk=user.id).first() is not None
+
+
 def login_user(user):
     """ Log in the user.
 
-    :return: True if the user has been logged in, False otherwise.
+    Only the user's id and email are kept in the (server-side) session;
+    everything else is loaded from the database by `get_user`.
+
+    :return: True if the user has been logged in, False otherwise (unknown
+        user or closed account).
 
     """
-    if user is None:
+    if user is None or is_closed(user):
         return False
     logger.debug('User {} logged in'.format(user.id))
     g.user = user
-    session['user'] = user.to_json()
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
+    session['user'] = {'id': str(user.id), 'email': user.email, }
     return True
 
 
+def revoke_user_sessions(user):
+    """ Log the user out everywhere by dropping all of their sessions.
+
+    :return: Number of sessions revoked.
+
+    """
+    store = getattr(app.session_interface, 'store', None)
+    if store is None:
+        return 0
+    n = store.revoke_user(user.id)
+    logger.info('Revoked {} sessions of user {}'.format(n, user.id))
+    return n
+
+
+def deactivate_user(user):
+    """ Deactivate the user's account and end all of their sessions.
+
+    :return: Number of sessions revoked.
+
+    """
+    user.is_active = False
+    user.save()
+    ClosedAccount.objects(pk=user.id).update_one(
+        set__closed=datetime.utcnow(), upsert=True)
+    invalidate('user', user.id)
+    return revoke_user_sessions(user)
+
+
+def is_admin(user):
+    """ Whether `user` is in the admin group. """
+    return user is not None and any(getattr(grp, 'name', None) == 'admin'
+                                    for grp in user.groups)
+
+
 def login_required(f):
     """ Require a user to log in to perform an action. """
     @wraps(f)
@@ -147,11 +265,6 @@ def permissions_required(*permissions, **orig_kwargs):
     return decorator
 
 
-def load_user(user_id):
-    """ Load the user based on the user_id. """
-    return User.objects(id=user_id).first()
-
-
 def get_user(key='user', user_id_field='id'):
     """ Get the current user based on the session. """
     logger.debug("current user: {}".format(session.get('user')))
@@ -170,23 +283,62 @@ def account_api():
     if request.method == 'POST':
         logger.debug("Request form: {}".format(request.form.get('clear')))
         logger.debug("Request form: {}".format(request.form.get('change')))
+        forget_api_key(getattr(user, 'api_key', None))
         if 'change' in request.form:
             user.generate_api_key()
         elif 'clear' in request.form:
             user.api_key = None
         user.save()
+        invalidate('user', user.id)
 
     form = ChangeApiKeyForm(api_key=getattr(user, 'api_key'))
     return render_template('details/api.html', form=form,
                            title='Change API Key')
 
 
+@auth_views.route('/account/password', methods=['GET', 'POST'])
+@login_required
+def account_password():
+    """ Change the current user's password and log out their other
+    sessions. """
+    user = get_user()
+    title = 'Change Password'
+    template = 'details/password.html'
+    form = ChangePasswordForm()
+    if request.method == 'POST':
+        form = ChangePasswordForm(formdata=request.form)
+        if not form.validate():
+            return render_template(template, form=form, title=title)
+        try:
+            valid = password_hasher.verify(form.data['current_password'],
+                                           user.password)
+            if valid:
+                password = password_hasher.hash(form.data['password'])
+        except HashingOverloaded:
+            errors = ['The server is busy. Try again shortly.', ]
+            return (render_template(template, form=form, errors=errors,
+                                    title=title),
+                    429, retry_after(1))
+        if not valid:
+            errors = ['Current password is incorrect', ]
+            return render_template(template, form=form, errors=errors,
+                                   title=title)
+        user.password = password
+        user.save()
+        invalidate('user', user.id)
+        revoke_user_sessions(user)
+        # Keep this browser logged in, under a new session id.
+        login_user(user)
+        return redirect(url_for('auth.account'))
+    return render_template(template, form=form, title=title)
+
+
 @auth_views.route('/account', methods=['GET', 'POST'])
 @login_required
 def account():
     """ Get the current user's account. """
     user = get_user()
-    return render_template('account.html', title='Account')
+    return render_template('account.html', title='Account', user=user)
 
 
 @auth_views.route('/login', methods=['GET', 'POST'])
@@ -205,12 +357,35 @@ def login():
     form = LoginForm()
     if request.method == 'POST':
         form = LoginForm(formdata=request.form)
-        pw = hashpass(form.data['password'])
-        user = User.objects(email=form.data['email'],
-                            password=pw).first()
+        email = form.data['email'] or ''
+        # Shed credential-stuffing bursts before doing any hashing. Failures
+        # count against the account whatever address they come from, so a
+        # distributed attack on one account is throttled too; successful
+        # logins don't spend its tokens.
+        email_key = email.strip().lower()
+        wait = max(login_ip_limiter.take(request.remote_addr),
+                   login_email_limiter.wait(email_key))
+        if wait:
+            login_admission.count(REJECTED_RATE)
+            errors = ['Too many login attempts. Try again later.', ]
+            return (render_template(template, form=form, errors=errors,
+                                    title=title),
+                    429, retry_after(wait))
+        user = User.objects(email=email).first()
+        try:
+            valid = password_hasher.verify(form.data['password'],
+                                           getattr(user, 'password', None))
+        except HashingOverloaded:
+            login_admission.count(REJECTED_BUSY)
+            errors = ['The server is busy. Try again shortly.', ]
+            return (render_template(template, form=form, errors=errors,
+                                    title=title),
+                    429, retry_after(1))
+        login_admission.count(ADMITTED)
         # Login and validate the user.
         # user should be an instance of your `User` class
-        if not login_user(user):
+        if not valid or not login_user(user):
+            login_email_limiter.take(email_key)
             errors = ['Invalid Username or Password', ]
             return render_template(template,
                                    form=form,
@@ -236,23 +411,36 @@ def register():
     if request.method == 'POST':
         logger.debug('method is post')
         form = RegisterForm(request.form)
-        existing = User.objects(email=form.data['email']).first()
         if not form.validate():
             logger.debug('form did not validate')
             return render_template(template, title=title, form=form)
-        if existing:
+        email = form.data['email']
+        errors = [
+            'User with email {} already exists'.format(email),
+        ]
+        if User.objects(email=email).only('id').first():
             logger.debug('user already exists')
-            errors = [
-                'User with email {} already exists'.format(existing.email),
-            ]
             return render_template(template, errors=errors,
                                    title=title, form=form)
-        user = User(email=form.data['email'],
-                    password=hashpass(form.data['password']))
-        user.save()
-        u = '/validate?key={}'.format(user.verification)
-        # TODO: send email to user
-        logger.info('Verification URL: http://localhost:5000{}'.format(u))
+        try:
+            password = password_hasher.hash(form.data['password'])
+        except HashingOverloaded:
+            register_admission.count(REJECTED_BUSY)
+            errors = ['The server is busy. Try again shortly.', ]
+            return (render_template(template, errors=errors,
+                                    title=title, form=form),
+                    429, retry_after(1))
+        register_admission.count(ADMITTED)
+        user = User(email=email, password=password)
+        try:
+            user.save()
+        except NotUniqueError:
+            logger.debug('user already exists')
+            return render_template(template, errors=errors,
+                                   title=title, form=form)
+        u = url_for('auth.validate', key=user.verification, _external=True)
+        send_verification_email(user, u)
+        logger.info('Verification URL: {}'.format(u))
         return render_template(template, email=form.email,
                                title=title)
     return render_template(template, title=title, form=form)
@@ -261,8 +449,11 @@ def register():
 @auth_views.route('/logout', methods=['GET', ])
 @login_required
 def logout():
-    """ End a user session. """
-    del session['user']
+    """ End a user session, or with `everywhere=1` all of their sessions.
+    """
+    if request.args.get('everywhere') == '1':
+        revoke_user_sessions(get_user())
+    session.clear()
     return redirect(url_for('index'))
 
 
@@ -273,9 +464,11 @@ def validate():
     user = User.objects(verification=key).first()
     template = 'validate.html'
     title = 'User Account Verification'
-    if user is None:
+    # An old verification link must not reopen a closed account.
+    if user is None or is_closed(user):
         errors = ['Verification key invalid.', ]
         return render_template(template, errors=errors, title=title)
     user.is_active = True
     user.save()
+    invalidate('user', user.id)
     return render_template(template, title=title, email=user.email)
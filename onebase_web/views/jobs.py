@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import logging
+
+from flask import (
+    Blueprint,
+    render_template,
+    abort,
+)
+
+from onebase_web.views.auth import (
+    get_user,
+    is_admin,
+    login_required,
+)
+from onebase_web.jobs import (
+    Job,
+    JOB_QUEUED,
+    JOB_RUNNING,
+)
+from onebase_web import settings as web_settings
+
+logger = logging.getLogger(__name__)
+
+_tpl_dir = os.path.join(web_settings.TEMPLATES_DIR, 'job')
+
+job_views = Blueprint('jobs', __name__, url_prefix='/job',
+                      template_folder=_tpl_dir)
+
+
+@job_views.route('/<job_id>', methods=['GET', ])
+@login_required
+def show_job(job_id):
+    """ Show the status and progress of a background job. """
+    job = Job.objects(id=job_id).first()
+    if job is None:
+        return abort(404)
+    user = get_user()
+    if job.user != user.id and not is_admin(user):
+        return abort(403)
+    return render_template('status.html', job=job,
+                           active=job.status in (JOB_QUEUED, JOB_RUNNING),
+                           title='Job {}'.format(job.kind))
@@ -16,13 +16,20 @@ You should have received a copy of the GNU General Public License
 along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import atexit
 import logging
+import os
+import threading
+
 from onebase_common.log.setup import configure_logging
 
 from mongoengine import connect
 
 from flask import (
     Flask,
+    Response,
+    abort,
+    g,
     request,
     render_template,
     session,
@@ -42,18 +49,54 @@ from onebase_api.models.auth import (
 )
 from onebase_web.views.auth import (
     ensure_admin_exists,
+    ensure_auth_indexes,
     auth_views,
+    get_user,
+    is_admin,
+    login_user,
     permissions_required,
     login_required,
 )
 from onebase_web.views.node import node_views
 from onebase_web.views.types import type_views
+from onebase_web.views.api import api_views
+from onebase_web.views.jobs import job_views
+from onebase_web.views.search import search_views
+from onebase_web.assets import (
+    asset_manifest,
+    asset_views,
+)
+from onebase_web.compression import Compressor
+from onebase_web.profiling import (
+    PROFILE_ARG,
+    PROFILE_HEADER,
+    RequestProfile,
+    check_token,
+    prune,
+)
+from onebase_web.jobs import job_runner
+from onebase_web.history import (
+    configure_history,
+    flush_history,
+    start_history,
+    stop_history,
+)
+from onebase_web.invalidation import (
+    bus,
+    configure_invalidation,
+)
+from onebase_web import invalidation
+from onebase_web.routing import configure_read_routing
+from onebase_web import admission
+from onebase_web import cache
 
 from onebase_common.settings import CONFIG
 from onebase_web import settings as web_settings
 
 from onebase_web import app
 
+import onebase_web.commands
+
 
 """ Set up logging
 """
@@ -62,16 +105,81 @@ logger = logging.getLogger()
 
 connect(CONFIG['collection'][CONFIG['mode']])
 
+configure_history(web_settings.ONEBASE_HISTORY_MODE,
+                  size=web_settings.ONEBASE_HISTORY_SIZE,
+                  interval=web_settings.ONEBASE_HISTORY_INTERVAL,
+                  max_pending=web_settings.ONEBASE_HISTORY_MAX_PENDING,
+                  max_retries=web_settings.ONEBASE_HISTORY_MAX_RETRIES)
+configure_invalidation(web_settings.ONEBASE_INVALIDATION_MODE,
+                       interval=web_settings.ONEBASE_INVALIDATION_INTERVAL)
+if web_settings.ONEBASE_READ_ROUTING:
+    configure_read_routing(
+        app, CONFIG['collection'][CONFIG['mode']],
+        web_settings.ONEBASE_READ_ENDPOINTS,
+        host=web_settings.ONEBASE_READ_HOST,
+        max_staleness=web_settings.ONEBASE_READ_MAX_STALENESS,
+        after_write=web_settings.ONEBASE_READ_AFTER_WRITE)
+
 BLUEPRINTS = (
     auth_views,
     node_views,
     type_views,
+    api_views,
+    job_views,
+    search_views,
+    asset_views,
 )
 
 for bp in BLUEPRINTS:
     app.register_blueprint(bp)
 
-ensure_admin_exists()
+app.jinja_env.globals['asset_url'] = asset_manifest.url
+Compressor(app, min_size=web_settings.ONEBASE_COMPRESS_MIN_SIZE)
+
+if web_settings.ONEBASE_STARTUP_CHECKS:
+    ensure_auth_indexes()
+    ensure_admin_exists()
+
+# Pid that started the background threads.
+_background_pid = None
+_background_lock = threading.Lock()
+
+
+def start_background():
+    """ Start this worker's background threads: history flushing, the
+    invalidation follower and the job runner.
+
+    Threads don't survive a fork, so they are not started at import (which
+    may happen in a preloading master) but before each worker's first
+    request. Servers with a post-fork hook may call this from it instead;
+    calling it again in the same process does nothing.
+    """
+    global _background_pid
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        _background_pid = os.getpid()
+    start_history()
+    bus.start()
+    job_runner.start()
+    atexit.register(stop_background)
+
+
+def stop_background():
+    """ Stop the background threads and write any buffered history. """
+    global _background_pid
+    with _background_lock:
+        if _background_pid != os.getpid():
+            return
+        _background_pid = None
+    job_runner.stop()
+    bus.stop()
+    stop_history()
+
+
+@app.before_request
+def start_background_threads():
+    start_background()
 
 
 @app.before_request
@@ -82,12 +190,64 @@ def before_request():
         if 'user' in session:
             return
         user = User.objects(email=web_settings.ONEBASE_PERSIST_USER).first()
-        session['user'] = user.to_json()
+        login_user(user)
+
+
+@app.before_request
+def start_profile():
+    """ Profile this request if it carries a valid token from an admin. """
+    token = (request.headers.get(PROFILE_HEADER)
+             or request.args.get(PROFILE_ARG))
+    if token is None:
+        return
+    if not check_token(app.secret_key, token,
+                       web_settings.ONEBASE_PROFILE_TOKEN_AGE):
+        logger.warning('Invalid profile token')
+        return
+    if not is_admin(get_user()):
+        logger.warning('Profiling requested by a non-admin')
+        return
+    g.profile = RequestProfile()
+    g.profile.start()
+
+
+@app.after_request
+def finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    profile.stop()
+    profile_id = profile.write(web_settings.ONEBASE_PROFILE_DIR,
+                               request.endpoint or request.path)
+    prune(web_settings.ONEBASE_PROFILE_DIR, web_settings.ONEBASE_PROFILE_KEEP)
+    logger.info('Wrote profile {}'.format(profile_id))
+    response.headers['X-Onebase-Profile-Id'] = profile_id
+    return response
+
+
+@app.teardown_request
+def teardown_request(exception):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.stop()
+    if web_settings.ONEBASE_HISTORY_FLUSH_ON_REQUEST:
+        flush_history()
+
 
 @app.errorhandler(OneBaseException)
 def handle_onebase_exception(error):
     return render_template('error.html', error=error, title=error.error_code)
 
+@app.route('/metrics', methods=['GET', ])
+def show_metrics():
+    """ Admission, cache and invalidation counters of this worker, for
+    monitoring. """
+    if request.remote_addr not in web_settings.ONEBASE_METRICS_ALLOW:
+        return abort(403)
+    return Response(admission.metrics() + cache.metrics() +
+                    invalidation.metrics(), mimetype='text/plain')
+
+
 @app.route('/', methods=['GET', ])
 def index():
     """ Index landing page. """
@@ -21,6 +21,7 @@ import logging
 
 from flask import (
     Blueprint,
+    make_response,
     render_template,
     request,
     redirect,
@@ -50,10 +51,40 @@ from onebase_web.views.auth import (
     permissions_required,
     get_user,
 )
+from onebase_web.admission import admission_required
+from onebase_web.lookups import find_path
 from onebase_web.forms import (
     CreateNodeForm,
     SlotInsertForm,
+    SchemaError,
+    apply_grid_edits,
+    create_node_from_schema,
+    parse_grid_form,
 )
+from onebase_web.views.api import (
+    json_error,
+    json_response,
+)
+from onebase_web.concurrency import gather
+from onebase_web.reprs import repr_engine
+from onebase_web.prefetch import (
+    page_cache,
+    prefetcher,
+)
+from onebase_web.snapshots import snapshot_store
+from onebase_web.stats import (
+    read_stats,
+)
+from onebase_web.jobs import (
+    enqueue,
+    drop_rows,
+)
+from onebase_web.query import (
+    NodeQuery,
+    QueryError,
+    fetch_rows,
+)
+from onebase_web.routing import reads
 from onebase_common.util import (
     reconstruct_url,
 )
@@ -71,20 +102,51 @@ node_views = Blueprint('node', __name__, url_prefix='/node',
                        template_folder=_tpl_dir)
 
 
+def _select_page(node, offset, count, environment):
+    """ Unfiltered page of `node`: from its snapshot if it has a current
+    one, else from the prefetched pages, else from the database.
+
+    :return: `(total, keys, page)`.
+    """
+    current = snapshot_store.current(node)
+    if current is not None:
+        (snapshot, node_keys) = current
+        page = repr_engine.expand_values(snapshot.select(offset, count),
+                                         environment, node_keys)
+        return (len(snapshot), node_keys, page)
+    query_set = page_cache.get(node.id, offset, count)
+    if query_set is not None:
+        (total, node_keys) = gather(lambda: read_stats(node).row_count,
+                                    node.get_keys)
+    else:
+        (total, node_keys, query_set) = gather(
+            lambda: read_stats(node).row_count,
+            node.get_keys,
+            lambda: node.do_select(offset=offset,
+                                   limit=count,
+                                   expand_keys=True,
+                                   expand_slots=False,
+                                   environment=environment))
+        query_set = dict(sorted(query_set.items()))
+    if offset + count < total:
+        prefetcher.prefetch(node, offset + count, count, environment)
+    return (total, node_keys,
+            repr_engine.expand(query_set, environment, keys=node_keys))
+
+
 @node_views.route('/search', methods=['GET', 'POST', ])
 def view_node():
     """ Find a node by a given path. """
     search = request.args.get('path')
-    node = getattr(Path.find(search), 'node', None)
+    path = find_path(search)
+    node = getattr(path, 'node', None)
     title = 'No Node'
     offset = int(request.args.get('offset', 0))
     count = int(request.args.get('count', 100))
-    query_set = []
-    start=None
-    end=None
-    total=None
+    page = None
+    total = None
     node_keys = []
-    if Path.find(search) is not None and node is None:
+    if path is not None and node is None:
         return redirect(url_for('node.browse_nodes', path=search))
     if node is not None:
         if request.method == 'POST' and 'DELETE' in request.form:
@@ -99,60 +161,117 @@ def view_node():
             'static_url': common_settings.CONFIG['static'][
                 common_settings.ONEBASE_MODE],
         }
-        total = node.row_count
         title = 'Node: {}'.format(node.title)
-        total = node.row_count
-        node_keys = node.get_keys()
-        query_set = node.do_select(offset=offset,
-                                   limit=count,
-                                   expand_keys=True,
-                                   expand_slots=True,
-                                   environment=environment)
-        import pprint
-        logger.debug("Query set: {}".format(pprint.pformat(query_set)))
+        try:
+            node_query = NodeQuery.from_args(request.args)
+        except QueryError as e:
+            logger.debug('Bad query: {}'.format(e))
+            return abort(400)
+        if node_query:
+            node_keys = node.get_keys()
+            try:
+                (total, rows) = node_query.select_rows(node, node_keys,
+                                                       offset, count)
+            except QueryError as e:
+                logger.debug('Bad query: {}'.format(e))
+                return abort(400)
+            page = repr_engine.expand(fetch_rows(node_keys, rows),
+                                      environment, keys=node_keys)
+        else:
+            (total, node_keys, page) = _select_page(node, offset, count,
+                                                    environment)
+        logger.debug('Rendering {!r}'.format(page))
     return render_template("search.html", node=node,
-                           path=Path.find(search),
+                           path=path,
                            title=title,
                            node_keys=node_keys,
-                           query_set=query_set,
+                           page=page,
                            start=offset,
                            end=offset+count,
-                           total=total)
+                           total=total,
+                           filters=[f for f in request.args.getlist('filter')
+                                    if f],
+                           sort=request.args.get('sort'),
+                           edit=request.args.get('edit') == '1')
 
 
 @node_views.route('/slot/drop/', methods=['GET', 'POST'])
 @login_required
 @permissions_required('slot_drop')
+@admission_required('slot_drop')
 def drop_slot():
     path = request.args['path']
     row_nums = [int(i) for i in request.args['rows'].split(",")]
-    node = Path.find(path).node
-    rows = []
+    node = find_path(path).node
+    if request.method == 'POST':
+        if 'YES' in request.form:
+            if len(row_nums) > web_settings.ONEBASE_JOB_INLINE_ROWS:
+                job = enqueue('drop_rows',
+                              {'node': str(node.id), 'rows': row_nums, },
+                              total=len(row_nums), user=get_user())
+                return redirect(url_for('jobs.show_job', job_id=job.id))
+            drop_rows(node, row_nums)
+        return redirect(url_for('node.view_node', path=path))
     e = {'return_mimetype': 'application/html',
          'static_url': common_settings.CONFIG['static'][
              common_settings.ONEBASE_MODE], }
-    to_delete = []
-    for row_num in row_nums:
-        row = []
-        for key in node.get_keys():
-            slot = Slot.objects(key=key, row=row_num).first()
-            to_delete.append(slot)
-            row.append(slot.get_repr(environment=e))
-        rows.append(row)
-    if request.method == 'GET':
-        return render_template('drop.html', rows=rows)
-    elif request.method == 'POST' and 'YES' in request.form:
-        for s in to_delete:
-            Slot.objects(id=s.id).delete()
-    return redirect(url_for('node.view_node', path=request.args['path']))
+    preview = row_nums[:web_settings.ONEBASE_JOB_INLINE_ROWS]
+    page = repr_engine.expand(fetch_rows(node.get_keys(), preview), e)
+    rows = [row.html for row in page]
+    return render_template('drop.html', rows=rows,
+                           more=len(row_nums) - len(preview))
+
+
+@node_views.route('/slot/edit', methods=['POST', ])
+@login_required
+@permissions_required('node_update')
+@admission_required('slot_update')
+def edit_rows():
+    """ Update many rows of a node in one request.
+
+    Takes the grid form of `view_node` (with `edit=1`), or a JSON body of
+    `{"<row>": {"<key name>": {"old": ..., "new": ...}}}`, where `old` is
+    the value the change was based on. Rows whose values no longer match
+    `old` are reported as conflicts and left alone.
+    """
+    path = request.args['path']
+    node = find_path(path).node
+    if node is None:
+        return abort(404)
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return json_error(400, 'Expected a JSON object of row -> cells')
+        key_ids = {k.name: str(k.id) for k in node.get_keys()}
+        try:
+            edits = {int(row): {key_ids.get(name, name):
+                                (cell.get('old', ''), cell['new'])
+                                for (name, cell) in cells.items()}
+                     for (row, cells) in data.items()}
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return json_error(400, 'Invalid edit')
+        result = apply_grid_edits(node, edits)
+        return json_response({
+            'updated': result['updated'],
+            'conflicts': {str(r): c for (r, c) in result['conflicts'].items()},
+            'errors': {str(r): e for (r, e) in result['errors'].items()},
+        })
+    result = apply_grid_edits(node, parse_grid_form(request.form))
+    if not result['conflicts'] and not result['errors']:
+        return redirect(url_for('node.view_node', path=path,
+                                offset=request.args.get('offset', 0),
+                                count=request.args.get('count', 100)))
+    return render_template('edited.html', result=result, path=path,
+                           title='Edit {}'.format(node.title))
 
 
 @node_views.route('/slot/update/<row>', methods=['GET', 'POST'])
 @login_required
 @permissions_required('node_update')
+@admission_required('slot_update')
 def update_slow_row(row):
     path = request.args['path']
-    node = Path.find(path).node
+    node = find_path(path).node
     if node is None:
         return abort(404)
 
@@ -177,9 +296,10 @@ def update_slow_row(row):
 @node_views.route('/slot/add', methods=['GET', 'POST'])
 @login_required
 @permissions_required('node_modify')
+@admission_required('slot_add')
 def add_slot_row():
     path = request.args['path']
-    node = Path.find(path).node
+    node = find_path(path).node
     if node is None:
         return abort(500)
 
@@ -203,35 +323,83 @@ def add_slot_row():
 
 @node_views.route('/browse', methods=['GET', ])
 def browse_nodes():
-    """ Browse the nodes, one after another. """
+    """ Browse the nodes, one after another.
+
+    The children are loaded separately from `child_paths`.
+    """
     path = request.args.get('path', '')
     current = None
     node = None
-    children = []
-    if path is None or path == '':
-        children = Path.objects(parent=None).all()
-    else:
-        current = Path.find(path)
+    if path:
+        current = find_path(path)
         if current:
             node = current.node
-            children = current.paths()
     if node is not None:
         return redirect(url_for('node.view_node', path=path))
     return render_template('browse.html',
                            title=(path or 'Browse Paths & Nodes'),
                            node=node,
-                           current=current,
-                           children=children)
+                           current=current)
+
+
+@node_views.route('/fragment/children', methods=['GET', ])
+def child_paths():
+    """ HTML fragment listing a page of the child paths of `path`. """
+    path = request.args.get('path', '')
+    offset = int(request.args.get('offset', 0))
+    count = int(request.args.get('count', 100))
+    parent = None
+    if path:
+        parent = find_path(path)
+        if parent is None:
+            return abort(404)
+    # A stable order, or pages could overlap or skip paths.
+    children = list(reads(Path.objects(parent=parent)).order_by('string2')
+                    .skip(offset).limit(count+1))
+    next_url = None
+    if len(children) > count:
+        next_url = url_for('node.child_paths', path=path,
+                           offset=offset+count, count=count)
+    response = make_response(render_template('children.html',
+                                              children=children[:count],
+                                              next_url=next_url))
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(
+        web_settings.ONEBASE_FRAGMENT_MAX_AGE)
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @node_views.route('/create', methods=['GET', 'POST', ])
 @login_required
 @permissions_required('create_node')
+@admission_required('node_create',
+                    concurrency=web_settings.ONEBASE_CREATE_CONCURRENCY)
 def create_node(*args, **kwargs):
-    """ Create a new Node. """
+    """ Create a new Node.
+
+    Besides the form, a JSON body of the form
+    `{"title": ..., "description": ..., "keys": [{"name": ..., "type": ...,
+    "size": ...}, ...]}` creates the node and all of its keys in one request.
+    """
+    if request.method == 'POST' and request.is_json:
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return json_error(400, 'Expected a JSON object')
+        path = data.get('path') or request.args.get('path')
+        if not path:
+            return json_error(400, 'A path is required')
+        try:
+            create_node_from_schema(get_user(), path, data.get('title'),
+                                    data.get('description'),
+                                    data.get('keys', []))
+        except SchemaError as e:
+            return json_error(400, str(e))
+        return json_response({'path': path}, status=201)
+
     class FieldedNodeForm(CreateNodeForm):
         pass
     key_count = int(request.values.get('keyCount', 1))
+    type_choices = Type.as_select()
     logger.debug("begin adding {} fields".format(key_count))
     for i in range(0, key_count):
         f1 = 'key_{}_name'.format(i)
@@ -243,7 +411,7 @@ def create_node(*args, **kwargs):
         setattr(FieldedNodeForm, f1, StringField('Key {} Name'.format(i),
                                                  default=key_name))
         setattr(FieldedNodeForm, f2, SelectField(default=key_type,
-                                                 choices=Type.as_select()))
+                                                 choices=type_choices))
         setattr(FieldedNodeForm, f3, IntegerField())
         logger.debug("FieldedNodeForm now has {} fields".format(
             len(
@@ -252,15 +420,19 @@ def create_node(*args, **kwargs):
             )
         ))
 
+    errors = []
     if request.method == 'POST':
         logger.debug("Form data: {}".format(dict(request.form)))
         assert len(request.form['path']) > 1
         form = FieldedNodeForm(request.form)
         if form.validate():
             u = get_user()
-            created_node = form.submit(u)
-            return redirect(url_for('node.view_node',
-                                    path=request.args['path']))
+            try:
+                created_node = form.submit(u)
+                return redirect(url_for('node.view_node',
+                                        path=request.args['path']))
+            except SchemaError as e:
+                errors.append(str(e))
         logger.debug('{} did not validate'.format(form))
 
     logger.debug('arguments: {}'.format(args))
@@ -274,7 +446,8 @@ def create_node(*args, **kwargs):
     add_key_url = reconstruct_url(request, updated_kw)
     return render_template(template, form=form, path=path,
                            pathparts=path.split("/"),
-                           add_key_url=add_key_url)
+                           add_key_url=add_key_url,
+                           errors=errors)
 
 
 @node_views.route('/', methods=['GET', ])
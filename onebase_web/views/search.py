@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+This file is part of 1Base.
+
+1Base is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+1Base is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with 1Base.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import logging
+
+from flask import (
+    Blueprint,
+    render_template,
+    request,
+)
+
+from onebase_web.search import search
+from onebase_web import settings as web_settings
+
+logger = logging.getLogger(__name__)
+
+_tpl_dir = os.path.join(web_settings.TEMPLATES_DIR, 'search')
+
+search_views = Blueprint('search', __name__, url_prefix='/search',
+                         template_folder=_tpl_dir)
+
+
+@search_views.route('', methods=['GET', ])
+def search_nodes():
+    """ Search node titles, descriptions, paths and key names. """
+    query = request.args.get('q', '').strip()
+    offset = max(int(request.args.get('offset', 0)), 0)
+    count = min(max(int(request.args.get('count', 20)), 1), 100)
+    (total, results) = (0, [])
+    if query:
+        (total, results) = search(query, offset, count)
+    return render_template('results.html',
+                           title='Search' if not query else
+                           'Search: {}'.format(query),
+                           query=query,
+                           results=results,
+                           total=total,
+                           start=offset,
+                           end=offset+count,
+                           count=count)
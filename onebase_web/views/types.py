@@ -42,6 +42,12 @@ from onebase_web.forms import (
     CreateNodeForm,
     CreateTypeForm,
 )
+from onebase_web.jobs import (
+    enqueue,
+    type_slots,
+)
+from onebase_web.invalidation import invalidate
+from onebase_web.routing import reads
 from onebase_common import settings as common_settings
 from onebase_web import settings as web_settings
 
@@ -56,7 +62,7 @@ type_views = Blueprint('type', __name__, url_prefix='/type',
 @type_views.route('/', methods=['GET', ])
 def list_types():
     """ List types. """
-    return render_template("list.html", types=Type.objects.all(),
+    return render_template("list.html", types=reads(Type.objects.all()),
                            title="Types")
 
 
@@ -76,6 +82,7 @@ def create_type():
                         is_primitive=form.data['is_primitive'],
                         validator=form.data['validator'][0])
             if type.save(get_user()):
+                invalidate('type', type.id)
                 return redirect(url_for('type.show_type',
                                         type_id=type.id))
     return render_template('type/create_type.html', form=form,
@@ -85,7 +92,8 @@ def create_type():
 @type_views.route('/<type_id>')
 def show_type(type_id):
     """ Show a type. """
-    return render_template('show.html', type=Type.objects(id=type_id).first())
+    return render_template('show.html',
+                           type=reads(Type.objects(id=type_id)).first())
 
 
 @type_views.route('/<type_id>/update', methods=['GET', 'POST', ])
@@ -107,6 +115,7 @@ def update_type(type_id):
                 if hasattr(type, k):
                     setattr(type, k, v)
             if type.save():
+                invalidate('type', type.id)
                 return redirect(url_for('type.show_type',
                                         type_id=type.id))
     return render_template('type/modify.html', form=form)
@@ -120,7 +129,9 @@ def delete_type(type_id):
     type = Type.objects(id=type_id).first()
     if 'confirm' in request.args:
         if int(request.args['confirm']) == 1:
-            type.delete()
+            job = enqueue('delete_type', {'type': str(type.id), },
+                          total=type_slots(type).count(), user=get_user())
+            return redirect(url_for('jobs.show_job', job_id=job.id))
         return render_template('type/delete.html',
                                confirm=request.args['confirm'],
                                title="Delete {}".format(type.name),
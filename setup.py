@@ -26,6 +26,10 @@ setup(
     # Project uses reStructuredText, so ensure that the docutils get
     # installed or upgraded on the target machine
     install_requires=['docutils>=0.3'],
+    extras_require={
+        # python -m onebase_web.loadgen
+        'loadgen': ['requests'],
+    },
 
     # metadata for upload to PyPI
     author="Jordan Hewitt",